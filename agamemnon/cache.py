@@ -0,0 +1,143 @@
+"""
+A read-through cache of node attributes for DataStore.get_node and get_nodes.
+"""
+import threading
+import time
+from heapq import heappop, heappush
+from ordereddict import OrderedDict
+
+
+def _size(value):
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_size(key) + _size(item) for key, item in value.iteritems())
+    return 8
+
+
+class NodeCache(object):
+    """
+    An LRU cache of node attributes keyed by (type, key), bounded by max_entries and/or by max_bytes, an estimate
+    of the size of the cached attributes.  Entries older than ttl seconds are not served.
+
+    Nodes are invalidated when they are written through the same DataStore.  A read of a node which was started
+    before the node was invalidated isn't cached, so a stale read can't be cached after the write it raced with.
+    The last invalidation_window invalidations are remembered for that; a read started before any of those which
+    have been forgotten isn't cached either.
+
+    A node written with a ttl through the same DataStore isn't served once it has expired.  Nodes given a ttl
+    elsewhere are only bounded by ttl.
+    """
+
+    invalidation_window = 10000
+
+    def __init__(self, max_entries=None, max_bytes=None, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.generation = 0
+        self._invalidated = OrderedDict()
+        self._forgotten = 0
+        self._expiries = {}
+        self._expiring = []
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, type, key):
+        """
+        Returns a copy of the cached attributes, or None.
+        """
+        with self._lock:
+            entry = self._entries.pop((type, key), None)
+            if entry is None:
+                self.misses += 1
+                return None
+            values, size, expires = entry
+            if expires is not None and expires <= time.time():
+                self._bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+            # moved to the most recently used end
+            self._entries[(type, key)] = entry
+            self.hits += 1
+            return OrderedDict(values)
+
+    def put(self, type, key, values, generation):
+        """
+        Caches the attributes read for a node, unless the node was invalidated since generation was read.
+        """
+        size = _size(type) + _size(key) + _size(values)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        now = time.time()
+        expires = now + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if self._invalidated.get((type, key), self._forgotten) > generation:
+                return
+            self._expire(now)
+            node_expires = self._expiries.get((type, key))
+            if node_expires is not None:
+                expires = min(node_expires) if expires is None else min(expires, min(node_expires))
+            old = self._entries.pop((type, key), None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[(type, key)] = (OrderedDict(values), size, expires)
+            self._bytes += size
+            while self._entries and ((self.max_entries is not None and len(self._entries) > self.max_entries) or
+                                     (self.max_bytes is not None and self._bytes > self.max_bytes)):
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted[1]
+                self.evictions += 1
+
+    def invalidate(self, type, key, ttl=None):
+        """
+        Drops a node which has been written.  If ttl is given, the columns written expire after that many seconds,
+        and the node is cached no longer than that from then on.
+        """
+        with self._lock:
+            self.generation += 1
+            self._invalidated.pop((type, key), None)
+            self._invalidated[(type, key)] = self.generation
+            if len(self._invalidated) > self.invalidation_window:
+                self._forgotten = self._invalidated.popitem(last=False)[1]
+            entry = self._entries.pop((type, key), None)
+            if entry is not None:
+                self._bytes -= entry[1]
+            if ttl is not None:
+                expires = time.time() + ttl
+                self._expiries.setdefault((type, key), []).append(expires)
+                heappush(self._expiring, (expires, (type, key)))
+
+    def _expire(self, now):
+        # forgets the ttls which have passed; called with the lock held
+        while self._expiring and self._expiring[0][0] <= now:
+            expires, node = heappop(self._expiring)
+            expiries = self._expiries[node]
+            expiries.remove(expires)
+            if not expiries:
+                del self._expiries[node]
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._invalidated = OrderedDict()
+            self._forgotten = self.generation
+            self._entries = OrderedDict()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
@@ -1,26 +1,433 @@
 import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
+from itertools import chain
+from Queue import Queue
 import pycassa
 from pycassa.batch import Mutator
-from pycassa.cassandra.ttypes import NotFoundException, InvalidRequestException
-from agamemnon.graph_constants import OUTBOUND_RELATIONSHIP_CF, INBOUND_RELATIONSHIP_CF, RELATIONSHIP_INDEX, RELATIONSHIP_CF
+from pycassa.cassandra.ttypes import ConsistencyLevel, NotFoundException, InvalidRequestException, KeyRange
+from agamemnon.graph_constants import OUTBOUND_RELATIONSHIP_CF, INBOUND_RELATIONSHIP_CF, RELATIONSHIP_INDEX, RELATIONSHIP_CF, RELATIONSHIP_COUNTS
 import pycassa.columnfamily as cf
 from agamemnon.delegate import Delegate
+from agamemnon.exceptions import BatchError
+from agamemnon.hedging import HedgePolicy
+
+log = logging.getLogger(__name__)
+
+RELATIONSHIP_CFS = frozenset([OUTBOUND_RELATIONSHIP_CF, INBOUND_RELATIONSHIP_CF, RELATIONSHIP_INDEX, RELATIONSHIP_CF,
+                              RELATIONSHIP_COUNTS])
+
+# weakest to strongest, to pick one level for a batch which writes to column families with different levels
+_LEVEL_ORDER = [
+    ConsistencyLevel.ANY,
+    ConsistencyLevel.ONE,
+    ConsistencyLevel.TWO,
+    ConsistencyLevel.THREE,
+    ConsistencyLevel.LOCAL_QUORUM,
+    ConsistencyLevel.QUORUM,
+    ConsistencyLevel.EACH_QUORUM,
+    ConsistencyLevel.ALL,
+]
+
+
+def consistency_level(level):
+    """
+    Accepts a ConsistencyLevel or its name, such as 'QUORUM'.
+    """
+    if level is None or isinstance(level, (int, long)):
+        return level
+    return getattr(ConsistencyLevel, level.upper())
+
+
+class ConsistencyProfiles(object):
+    """
+    Read and write consistency levels by class of operation: 'relationship' for the relationship column families
+    and 'node' for all the others.  A column family can also be configured by name, and 'default' applies to all of
+    them, e.g.
+
+        consistency: {default: {read: QUORUM, write: QUORUM}, node: {read: ONE}, relationship: {read: ONE}}
+
+    Levels which aren't configured are pycassa's defaults.  override changes the levels of every operation in the
+    current thread.
+    """
+
+    def __init__(self, profiles=None):
+        self._profiles = dict(profiles or {})
+        self._local = threading.local()
+
+    def levels(self, cf_name):
+        operation = 'relationship' if cf_name in RELATIONSHIP_CFS else 'node'
+        levels = {}
+        for name in ['default', operation, cf_name]:
+            for kind, level in self._profiles.get(name, {}).iteritems():
+                levels[kind] = consistency_level(level)
+        return levels.get('read'), levels.get('write')
+
+    @property
+    def read_override(self):
+        return getattr(self._local, 'read', None)
+
+    @property
+    def write_override(self):
+        return getattr(self._local, 'write', None)
+
+    @contextmanager
+    def override(self, read=None, write=None):
+        previous = self.read_override, self.write_override
+        if read is not None:
+            self._local.read = consistency_level(read)
+        if write is not None:
+            self._local.write = consistency_level(write)
+        try:
+            yield
+        finally:
+            self._local.read, self._local.write = previous
+
+
+class ProfiledColumnFamily(cf.ColumnFamily):
+    """
+    A ColumnFamily which reads and writes at the levels of its profile, or of the current thread's override.
+    on_schema_error, if given, is called with the name of the column family whenever cassandra rejects an
+    operation on it with an InvalidRequestException, as it does once the column family has been dropped.
+    """
+
+    def __init__(self, profiles, pool, name, on_schema_error=None, **kwargs):
+        super(ProfiledColumnFamily, self).__init__(pool, name, **kwargs)
+        self._profiles = profiles
+        self._on_schema_error = on_schema_error
+        read, write = profiles.levels(name)
+        if read is not None:
+            self.read_consistency_level = read
+        if write is not None:
+            self.write_consistency_level = write
+
+    @contextmanager
+    def _schema_errors(self):
+        try:
+            yield
+        except InvalidRequestException:
+            if self._on_schema_error is not None:
+                self._on_schema_error(self.column_family)
+            raise
+
+    def _read(self, kwargs):
+        level = self._profiles.read_override
+        if level is not None:
+            kwargs.setdefault('read_consistency_level', level)
+        return kwargs
+
+    def read_level(self):
+        """
+        Returns the level a read sent now from the current thread goes at, for reads which don't go through the
+        methods below.
+        """
+        return self._read({}).get('read_consistency_level', self.read_consistency_level)
+
+    def _write(self, kwargs):
+        level = self._profiles.write_override
+        if level is not None:
+            kwargs.setdefault('write_consistency_level', level)
+        return kwargs
+
+    def get(self, *args, **kwargs):
+        with self._schema_errors():
+            return super(ProfiledColumnFamily, self).get(*args, **self._read(kwargs))
+
+    def multiget(self, *args, **kwargs):
+        with self._schema_errors():
+            return super(ProfiledColumnFamily, self).multiget(*args, **self._read(kwargs))
+
+    def get_count(self, *args, **kwargs):
+        with self._schema_errors():
+            return super(ProfiledColumnFamily, self).get_count(*args, **self._read(kwargs))
+
+    def get_range(self, *args, **kwargs):
+        with self._schema_errors():
+            return super(ProfiledColumnFamily, self).get_range(*args, **self._read(kwargs))
+
+    def get_indexed_slices(self, *args, **kwargs):
+        with self._schema_errors():
+            return super(ProfiledColumnFamily, self).get_indexed_slices(*args, **self._read(kwargs))
+
+    def insert(self, *args, **kwargs):
+        with self._schema_errors():
+            return super(ProfiledColumnFamily, self).insert(*args, **self._write(kwargs))
+
+    def remove(self, *args, **kwargs):
+        with self._schema_errors():
+            return super(ProfiledColumnFamily, self).remove(*args, **self._write(kwargs))
+
+    def add(self, *args, **kwargs):
+        with self._schema_errors():
+            return super(ProfiledColumnFamily, self).add(*args, **self._write(kwargs))
+
+
+class HedgedColumnFamily(ProfiledColumnFamily):
+    """
+    Sends point reads through a HedgePolicy, to replicas of the column family bound to each host's own pool.
+    Writes and range reads go through the shared pool.
+    """
+
+    def __init__(self, policy, replicas, profiles, pool, name, **kwargs):
+        super(HedgedColumnFamily, self).__init__(profiles, pool, name, **kwargs)
+        self._policy = policy
+        self._replicas = replicas
+
+    def _hedge(self, method, args, kwargs):
+        # the override is only visible from this thread
+        kwargs = self._read(kwargs)
+        return self._policy.call(dict(
+            (host, partial(getattr(replica, method), *args, **kwargs))
+            for host, replica in self._replicas.iteritems()
+        ))
+
+    def get(self, *args, **kwargs):
+        return self._hedge('get', args, kwargs)
+
+    def multiget(self, *args, **kwargs):
+        return self._hedge('multiget', args, kwargs)
+
+    def get_count(self, *args, **kwargs):
+        return self._hedge('get_count', args, kwargs)
+
+
+class ProfiledMutator(Mutator):
+    """
+    Unless it is given a write level, sends at the strongest write level of the column families it writes to.
+    """
+
+    def __init__(self, pool, queue_size=0, write_consistency_level=None):
+        super(ProfiledMutator, self).__init__(pool, queue_size=queue_size,
+                                              write_consistency_level=write_consistency_level)
+        self._fixed_level = write_consistency_level
+        self._levels = set()
+
+    def insert(self, column_family, *args, **kwargs):
+        self._levels.add(column_family.write_consistency_level)
+        return super(ProfiledMutator, self).insert(column_family, *args, **kwargs)
+
+    def remove(self, column_family, *args, **kwargs):
+        self._levels.add(column_family.write_consistency_level)
+        return super(ProfiledMutator, self).remove(column_family, *args, **kwargs)
+
+    def send(self, write_consistency_level=None):
+        if write_consistency_level is None and self._fixed_level is None and self._levels:
+            write_consistency_level = max(self._levels, key=_LEVEL_ORDER.index)
+        return super(ProfiledMutator, self).send(write_consistency_level)
+
+
+class SchemaCatalog(object):
+    """
+    The column families of a keyspace, as loaded from the system manager.  The catalog is reloaded once it is older
+    than ttl seconds.  A column family which isn't in it also reloads it, in case it was created elsewhere, but no
+    more than once every miss_interval seconds, so looking up a missing column family over and over doesn't cost a
+    round trip each time.
+    """
+
+    def __init__(self, system_manager, keyspace, ttl=300, miss_interval=5, clock=time.time):
+        self.system_manager = system_manager
+        self.keyspace = keyspace
+        self.ttl = ttl
+        self.miss_interval = miss_interval
+        self._clock = clock
+        self._column_families = None
+        self._loaded_at = 0
+
+    def refresh(self):
+        self._column_families = self.system_manager.get_keyspace_column_families(self.keyspace)
+        self._loaded_at = self._clock()
+
+    def invalidate(self):
+        self._column_families = None
+
+    def add(self, name):
+        if self._column_families is not None:
+            self._column_families[name] = None
+
+    def __contains__(self, name):
+        age = self._clock() - self._loaded_at
+        if self._column_families is None or age >= self.ttl:
+            self.refresh()
+        elif name not in self._column_families and age >= self.miss_interval:
+            self.refresh()
+        return name in self._column_families
+
+
+def _size(value):
+    if value is None:
+        return 0
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_size(name) + _size(column) for name, column in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return sum(_size(item) for item in value)
+    return 8
+
+
+def _split_token_range(start_token, end_token, parts):
+    """
+    Splits the token range (start_token, end_token] into up to parts ranges.  Only the numeric tokens of the random
+    partitioners can be split, and a range which wraps around the ring is left whole.
+    """
+    try:
+        start, end = int(start_token), int(end_token)
+    except ValueError:
+        return [(start_token, end_token)]
+    if parts < 2 or start >= end:
+        return [(start_token, end_token)]
+    step = max((end - start) // parts, 1)
+    bounds = range(start, end, step)[:parts] + [end]
+    return [(str(first), str(last)) for first, last in zip(bounds, bounds[1:])]
+
+
+def _get_token_range(column_family, start_token, end_token, buffer_size=None, read_consistency_level=None):
+    """
+    Iterates over the rows of a column family in the token range (start_token, end_token], buffer_size rows at a
+    time.  The get_range of pycassa 1.4 only takes keys, so this makes the get_range_slices calls it would, starting
+    from a token and then from the last key of each page.  They are sent at read_consistency_level, or else at the
+    column family's read level.
+    """
+    if buffer_size is None:
+        buffer_size = column_family.buffer_size
+    if read_consistency_level is None:
+        read_consistency_level = column_family.read_consistency_level
+    parent = column_family._column_parent()
+    predicate = column_family._slice_predicate(None, '', '', False, 100, None)
+    key_range = KeyRange(start_token=start_token, end_token=end_token, count=buffer_size)
+    while True:
+        key_slices = column_family.pool.execute('get_range_slices', parent, predicate, key_range,
+                                                read_consistency_level)
+        if not key_slices:
+            return
+        for i, key_slice in enumerate(key_slices):
+            # every page after the first starts with the last row of the one before
+            if (i == 0 and key_range.start_key is not None) or not key_slice.columns:
+                continue
+            yield column_family._unpack_key(key_slice.key), column_family._cosc_to_dict(key_slice.columns, False)
+        if len(key_slices) < buffer_size:
+            return
+        key_range = KeyRange(start_key=key_slices[-1].key, end_token=end_token, count=buffer_size)
+
+
+class BackgroundMutator(object):
+    """
+    Collects mutations like a Mutator, but hands them over to a worker thread to be sent every flush_mutations
+    columns or flush_bytes bytes, whichever comes first, so the caller carries on building mutations while the
+    earlier ones are sent.  Once max_pending sub-batches are waiting to be sent the caller blocks.
+
+    send flushes what is left and waits for the worker to finish, then raises a BatchError if any sub-batch failed.
+    """
+
+    def __init__(self, pool, flush_mutations=1000, flush_bytes=1 << 20, max_pending=4, write_consistency_level=None):
+        self._pool = pool
+        self._write_consistency_level = write_consistency_level
+        self.flush_mutations = flush_mutations
+        self.flush_bytes = flush_bytes
+        self._queue = Queue(max_pending)
+        self._failures = []
+        self._batch = None
+        self._count = 0
+        self._bytes = 0
+        self._thread = threading.Thread(target=self._run, name='agamemnon-batch-sender')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def insert(self, column_family, key, columns, ttl=None):
+        self._current().insert(column_family, key, columns, ttl=ttl)
+        self._added(len(columns), _size(key) + _size(columns))
+
+    def remove(self, column_family, key, columns=None, super_column=None):
+        self._current().remove(column_family, key, columns=columns, super_column=super_column)
+        self._added(len(columns) if columns else 1, _size(key) + _size(columns) + _size(super_column))
+
+    def flush(self):
+        if self._batch is not None:
+            self._queue.put(self._batch)
+            self._batch = None
+            self._count = 0
+            self._bytes = 0
+
+    def send(self):
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+        if self._failures:
+            raise BatchError(self._failures)
+
+    def _current(self):
+        if self._batch is None:
+            self._batch = ProfiledMutator(self._pool, write_consistency_level=self._write_consistency_level)
+        return self._batch
+
+    def _added(self, count, size):
+        self._count += count
+        self._bytes += size
+        if self._count >= self.flush_mutations or self._bytes >= self.flush_bytes:
+            self.flush()
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            try:
+                batch.send()
+            except Exception, e:
+                log.exception("Failed to send a background sub-batch")
+                self._failures.append((batch, e))
+
 
 class CassandraDataStore(Delegate):
+    """
+    Whether a column family exists is answered from a SchemaCatalog, which is reloaded every schema_ttl seconds,
+    rather than by asking the cluster on every write.  The catalog is also reloaded, and the column family
+    forgotten, whenever cassandra rejects an operation with an InvalidRequestException.
+
+    Background batches are sent by a BackgroundMutator, configured by flush_mutations, flush_bytes and
+    max_pending_flushes.
+
+    Consistency levels are set per class of operation by the consistency option; see ConsistencyProfiles.
+
+    If hedge_percentile is given, and server_list has more than one server, point reads are hedged across the
+    servers, each of which gets a pool of its own; see HedgePolicy.
+    """
+
     def __init__(self, 
                  keyspace='agamemnon', 
                  server_list=['localhost:9160'], 
                  replication_factor=1,
                  create_keyspace = False,
+                 schema_ttl=300,
+                 flush_mutations=1000,
+                 flush_bytes=1 << 20,
+                 max_pending_flushes=4,
+                 consistency=None,
+                 hedge_percentile=None,
+                 hedge_min_delay=0.002,
+                 hedge_workers=8,
                 **kwargs):
         super(CassandraDataStore,self).__init__()
 
         self._keyspace=keyspace
         self._server_list=server_list
         self._replication_factor=replication_factor
+        self._flush_mutations = flush_mutations
+        self._flush_bytes = flush_bytes
+        self._max_pending_flushes = max_pending_flushes
+        self._consistency = ConsistencyProfiles(consistency)
+        self._hedging = None
+        if hedge_percentile is not None and len(server_list) > 1:
+            self._hedging = HedgePolicy(server_list, percentile=hedge_percentile, min_delay=hedge_min_delay,
+                                        workers=hedge_workers)
+        self._host_pools = {}
         self._pool_args = kwargs
 
         self._system_manager = pycassa.system_manager.SystemManager(server_list[0])
+        self._schema = SchemaCatalog(self._system_manager, keyspace, ttl=schema_ttl)
         if create_keyspace:
             self.create()
         else:
@@ -30,8 +437,14 @@ class CassandraDataStore(Delegate):
         self._pool = pycassa.pool.ConnectionPool(self._keyspace,
                                                  self._server_list,
                                                  self._pool_args)
+        if self._hedging is not None:
+            self._host_pools = dict(
+                (host, pycassa.pool.ConnectionPool(self._keyspace, [host], self._pool_args))
+                for host in self._server_list
+            )
 
         self._cf_cache = {}
+        self._schema.invalidate()
         self._index_cache = {}
         self._batch = None
         self.in_batch = False
@@ -44,6 +457,8 @@ class CassandraDataStore(Delegate):
             self.create_cf(RELATIONSHIP_INDEX, super=True)
         if not self.cf_exists(RELATIONSHIP_CF):
             self.create_cf(RELATIONSHIP_CF, super=False)
+        if not self.cf_exists(RELATIONSHIP_COUNTS):
+            self.create_cf(RELATIONSHIP_COUNTS, value_type=pycassa.system_manager.COUNTER_COLUMN_TYPE)
 
     @property
     def system_manager(self):
@@ -62,8 +477,13 @@ class CassandraDataStore(Delegate):
 
     def drop(self):
         self._system_manager.drop_keyspace(self._keyspace)
+        self._cf_cache = {}
+        self._schema.invalidate()
         self._pool.dispose()
         self._pool = None
+        for pool in self._host_pools.values():
+            pool.dispose()
+        self._host_pools = {}
 
     def truncate(self):
         try:
@@ -85,46 +505,120 @@ class CassandraDataStore(Delegate):
             args['super_column'] = super_column
         return self.get_cf(type).get_count(row, **args)
 
-    def create_cf(self, type, column_type=pycassa.system_manager.ASCII_TYPE, super=False, index_columns=list()):
-        self._system_manager.create_column_family(self._keyspace, type, super=super, comparator_type=column_type)
+    def create_cf(self, type, column_type=pycassa.system_manager.ASCII_TYPE, super=False, index_columns=list(),
+                  value_type=None):
+        if type in self._schema:
+            # opened directly: get_cf creates the column families it can't open
+            column_family = self._column_family(type)
+            self._cf_cache[type] = column_family
+            return column_family
+        options = {}
+        if value_type is not None:
+            options['default_validation_class'] = value_type
+        self._system_manager.create_column_family(self._keyspace, type, super=super, comparator_type=column_type,
+                                                  **options)
+        self._schema.add(type)
         for column in index_columns:
             self.create_secondary_index(type, column, column_type)
-        return cf.ColumnFamily(self._pool, type, autopack_names=False, autopack_values=False)
+        column_family = self._column_family(type)
+        self._cf_cache[type] = column_family
+        return column_family
+
+    def _column_family(self, type):
+        options = {'autopack_names': False, 'autopack_values': False, 'on_schema_error': self._schema_error}
+        if self._hedging is None:
+            return ProfiledColumnFamily(self._consistency, self._pool, type, **options)
+        replicas = dict(
+            (host, ProfiledColumnFamily(self._consistency, pool, type, **options))
+            for host, pool in self._host_pools.iteritems()
+        )
+        return HedgedColumnFamily(self._hedging, replicas, self._consistency, self._pool, type, **options)
+
+    def _schema_error(self, type=None):
+        """
+        Forgets a column family, or every one if it isn't known which, and reloads the catalog on its next use,
+        once cassandra has rejected an operation as it does those on a column family which has been dropped.
+        """
+        if type is None:
+            self._cf_cache = {}
+        else:
+            self._cf_cache.pop(type, None)
+        self._schema.invalidate()
+
+    @contextmanager
+    def _sending(self):
+        try:
+            yield
+        except InvalidRequestException:
+            # which of the column families of a batch it was rejected for isn't known
+            self._schema_error()
+            raise
+        except BatchError, e:
+            if any(isinstance(error, InvalidRequestException) for batch, error in e.failures):
+                self._schema_error()
+            raise
+
+    def consistency(self, read=None, write=None):
+        return self._consistency.override(read=read, write=write)
 
     def create_secondary_index(self, type, column, column_type=pycassa.system_manager.ASCII_TYPE):
         self._system_manager.create_index(self._keyspace, type, column, column_type,
                                           index_name='%s_%s_index' % (type, column))
     
     def cf_exists(self, type):
-        if type in self._cf_cache:
-            return True
-        try:
-            cf.ColumnFamily(self._pool, type, autopack_names=False, autopack_values=False)
-        except NotFoundException:
-            return False
-        return True
+        return type in self._cf_cache or type in self._schema
 
     def get_cf(self, type, create=True):
 
         column_family = None
         if type in self._cf_cache:
             return self._cf_cache[type]
-        try:
-            column_family = cf.ColumnFamily(self._pool, type, autopack_names=False, autopack_values=False)
-            self._cf_cache[type] = column_family
-        except NotFoundException:
-            if create:
-                column_family = self.create_cf(type)
+        if type in self._schema:
+            try:
+                column_family = self._column_family(type)
+                self._cf_cache[type] = column_family
+                return column_family
+            except NotFoundException:
+                # dropped since the catalog was loaded
+                self._schema.invalidate()
+        if create:
+            column_family = self.create_cf(type)
         return column_family
 
+    def scan(self, type, partitions=1):
+        """
+        Returns up to partitions iterators over the rows of a column family, to be read concurrently.  Each reads
+        some of the token ranges of the ring, which are split when there are fewer of them than partitions.
+        """
+        if not self.cf_exists(type):
+            return []
+        column_family = self.get_cf(type)
+        # the rows are read on whichever threads the caller reads them from, so the level in force is taken here
+        level = column_family.read_level()
+        ring = self._system_manager.describe_ring(self._keyspace)
+        parts = -(-partitions // len(ring))
+        token_ranges = [split for token_range in ring
+                        for split in _split_token_range(token_range.start_token, token_range.end_token, parts)]
+        return [
+            chain.from_iterable(_get_token_range(column_family, start_token, end_token, read_consistency_level=level)
+                                for start_token, end_token in token_ranges[partition::partitions])
+            for partition in xrange(min(partitions, len(token_ranges)))
+        ]
 
+    def insert(self, column_family, key, columns, ttl=None):
+        if self._batch is not None:
+            self._batch.insert(column_family, key, columns, ttl=ttl)
+        else:
+            with self._sending():
+                with ProfiledMutator(self._pool, write_consistency_level=self._consistency.write_override) as b:
+                    b.insert(column_family, key, columns, ttl=ttl)
 
-    def insert(self, column_family, key, columns):
+    def add(self, column_family, key, column, value=1):
+        # batched inserts into a counter column family are increments
         if self._batch is not None:
-            self._batch.insert(column_family, key, columns)
+            self._batch.insert(column_family, key, {column: value})
         else:
-            with Mutator(self._pool) as b:
-                b.insert(column_family, key, columns)
+            column_family.add(key, column, value)
 
     def remove(self,column_family, key, columns=None, super_column=None):
         if self._batch is not None:
@@ -132,18 +626,25 @@ class CassandraDataStore(Delegate):
         else:
             column_family.remove(key, columns=columns, super_column=super_column)
 
-    def start_batch(self, queue_size = 0):
+    def start_batch(self, queue_size = 0, background=False):
         if self._batch is None:
             self.in_batch = True
-            self._batch = Mutator(self._pool,queue_size)
+            if background:
+                self._batch = BackgroundMutator(self._pool, self._flush_mutations, self._flush_bytes,
+                                                self._max_pending_flushes, self._consistency.write_override)
+            else:
+                self._batch = ProfiledMutator(self._pool, queue_size, self._consistency.write_override)
         self.batch_count += 1
 
 
     def commit_batch(self):
         self.batch_count -= 1
         if not self.batch_count:
-            self._batch.send()
+            batch = self._batch
             self._batch = None
+            self.in_batch = False
+            with self._sending():
+                batch.send()
 
 def drop_keyspace(host_list, keyspace):
     system_manager = pycassa.SystemManager(json.loads(host_list)[0])
@@ -1,8 +1,16 @@
 
+from contextlib import contextmanager
+
+
 class Delegate(object):
     def __init__(self):
         self.plugins = []
 
+    @contextmanager
+    def consistency(self, read=None, write=None):
+        # only meaningful for replicated data stores
+        yield
+
     def load_plugins(self,plugin_dict):
         #TODO: this is busted
         for key,config in plugin_dict.items():
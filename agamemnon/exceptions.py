@@ -5,3 +5,30 @@ class NoTransactionError(Exception):
 class NodeNotFoundException(Exception):
     pass
 
+
+
+class ReadOnlyError(Exception):
+    pass
+
+
+class BatchError(Exception):
+    """
+    Raised when sub-batches of a background batch failed to send.  failures holds a (mutator, exception) pair for
+    each of them; the mutators still hold their mutations, so they can be sent again.
+    """
+
+    def __init__(self, failures):
+        super(BatchError, self).__init__('%d sub-batches failed to send' % len(failures))
+        self.failures = failures
+
+
+class PropagationError(Exception):
+    """
+    Raised by DataStore.flush when write-behind propagation of node attributes failed, and by save_node when
+    propagation without write-behind did.  failures holds a ((type, key), exception) pair for each node; the
+    write-behind updates stay in the journal, if there is one, and are retried when it is next opened.
+    """
+
+    def __init__(self, failures):
+        super(PropagationError, self).__init__('propagation failed for %d nodes' % len(failures))
+        self.failures = failures
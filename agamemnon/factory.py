@@ -2,33 +2,148 @@ from contextlib import contextmanager
 import string
 import uuid
 import datetime
+import threading
+from itertools import chain, islice
+import zlib
 from dateutil.parser import parse as date_parse
 from pycassa.cassandra.ttypes import NotFoundException
 from pycassa.util import OrderedDict
 from pycassa import index
-from agamemnon.graph_constants import RELATIONSHIP_KEY_PATTERN, OUTBOUND_RELATIONSHIP_CF, RELATIONSHIP_INDEX, ENDPOINT_NAME_TEMPLATE, INBOUND_RELATIONSHIP_CF, RELATIONSHIP_CF
+from agamemnon.graph_constants import RELATIONSHIP_KEY_PATTERN, OUTBOUND_RELATIONSHIP_CF, RELATIONSHIP_INDEX, ENDPOINT_NAME_TEMPLATE, INBOUND_RELATIONSHIP_CF, RELATIONSHIP_CF, RELATIONSHIP_COUNTS, RELATIONSHIP_COUNTS_MARKER, REFERENCE_SHARD_TEMPLATE
 import pycassa
-from agamemnon.cassandra import CassandraDataStore
+from agamemnon.cache import NodeCache
+from agamemnon.cassandra import CassandraDataStore, RELATIONSHIP_CFS
 from agamemnon.memory import InMemoryDataStore
-from agamemnon.exceptions import NodeNotFoundException
+from agamemnon.exceptions import NodeNotFoundException, PropagationError
+from agamemnon.prefetch import read_ahead, read_parallel
+from agamemnon.writebehind import WriteBehindQueue
 import agamemnon.primitives as prim
 import logging
 import yaml
 
 log = logging.getLogger(__name__)
 
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 class DataStore(object):
-    def __init__(self, delegate):
+    """
+    If prefetch is set, relationships are read that many pages ahead of the caller on a worker thread.
+
+    If node_cache, a NodeCache, is given, get_node and get_nodes read through it.
+
+    save_node reads and rewrites the relationships of a node propagation_page_size at a time.  If write_behind, a
+    WriteBehindQueue, is given, it does so on the queue's workers after it returns; flush waits for them, and
+    deleting a relationship waits for those of its nodes.
+
+    Every attribute of a node is copied onto its relationships, unless denormalized maps its type to the list of
+    the attributes which are.  The nodes read off the relationships of such types are PartialNodes.
+
+    With reference_shards set, the instance relationships of each reference node are spread over that many rows.
+    It mustn't be changed once relationships have been written with it.
+    """
+
+    def __init__(self, delegate, prefetch=0, node_cache=None, propagation_page_size=500, write_behind=None,
+                 denormalized=None, reference_shards=1):
         self.delegate = delegate
+        self.reference_shards = reference_shards
+        self.denormalized = dict(
+            (type, frozenset(attributes)) for type, attributes in (denormalized or {}).iteritems())
+        self.prefetch = prefetch
+        self.propagation_page_size = propagation_page_size
+        self.node_cache = node_cache
+        self.write_behind = write_behind
+        self._batches = threading.local()
+        self._reference_nodes = {}
         for plugin in self.delegate.plugins:
             plugin_object = self.delegate.__dict__[plugin]
             plugin_object.datastore = self
+        if write_behind is not None:
+            write_behind.start(self._propagate_attributes)
+
+    @contextmanager
+    def batch(self, queue_size = 0, background=False):
+        """
+        With background set, cassandra sends the batch in parts on a worker thread as it grows, and raises a
+        BatchError when the block exits if any of them failed.
+        """
+        self.delegate.start_batch(queue_size = queue_size, background=background)
+        self._batches.depth = getattr(self._batches, 'depth', 0) + 1
+        try:
+            yield
+        finally:
+            self._batches.depth -= 1
+            try:
+                self.delegate.commit_batch()
+            finally:
+                if not self._batches.depth:
+                    # nodes read while the batch was open were cached as they were before it
+                    for type, key in getattr(self._batches, 'invalidated', ()):
+                        self.node_cache.invalidate(type, key)
+                    self._batches.invalidated = set()
+                    self._batches.created = set()
+                    self._batches.deleted = set()
+
+    def _invalidate(self, type, key, ttl=None):
+        if self.node_cache is None or type in RELATIONSHIP_CFS:
+            return
+        self.node_cache.invalidate(type, key, ttl)
+        if getattr(self._batches, 'depth', 0):
+            if not hasattr(self._batches, 'invalidated'):
+                self._batches.invalidated = set()
+            self._batches.invalidated.add((type, key))
+
+    def _batched(self, name):
+        # the relationships created or deleted in the thread's open batch, which reads don't see until it is sent
+        if not hasattr(self._batches, name):
+            setattr(self._batches, name, set())
+        return getattr(self._batches, name)
+
+    def flush(self):
+        """
+        Waits until the attributes of every saved node have been propagated to its relationships.  Raises a
+        PropagationError if that failed for any of them.
+        """
+        if self.write_behind is not None:
+            self.write_behind.flush()
+
+    def consistency(self, read=None, write=None):
+        """
+        Overrides the read and write consistency levels, given as names such as 'ONE' or 'QUORUM', of every
+        operation in the block and the current thread.  A batch is sent at the write level in force when it started.
+        """
+        return self.delegate.consistency(read=read, write=write)
 
     @contextmanager
-    def batch(self, queue_size = 0):
-        self.delegate.start_batch(queue_size = queue_size)
-        yield
-        self.delegate.commit_batch()
+    def snapshot(self):
+        """
+        Yields a read-only DataStore over the graph as it is now.  Writes made while the snapshot is open are not
+        seen through it, and are not held up by it.  Only the in memory data store supports snapshots.
+        """
+        view = self.delegate.open_snapshot()
+        try:
+            yield DataStore(view, denormalized=self.denormalized, reference_shards=self.reference_shards)
+        finally:
+            view.release()
+
+    def truncate(self):
+        self._reference_nodes = {}
+        if self.node_cache is not None:
+            self.node_cache.clear()
+        self.delegate.truncate()
+
+    def drop(self):
+        self._reference_nodes = {}
+        if self.node_cache is not None:
+            self.node_cache.clear()
+        self.delegate.drop()
 
     def multiget(self, type, row_keys, **kwargs):
         column_family = self.delegate.get_cf(type)
@@ -43,8 +158,12 @@ class DataStore(object):
 
     def delete(self, type, key, **kwargs):
         self.delegate.remove(self.get_cf(type), key, **kwargs)
+        self._invalidate(type, key)
 
-    def insert(self, type, key, args, super_key=None):
+    def insert(self, type, key, args, super_key=None, ttl=None):
+        """
+        If ttl is given, the inserted columns expire after that many seconds.
+        """
         if not self.delegate.cf_exists(type):
             column_family = self.delegate.create_cf(type)
 
@@ -52,20 +171,30 @@ class DataStore(object):
             column_family = self.delegate.get_cf(type)
         serialized = self.serialize_columns(args)
         if super_key is None:
-            self.delegate.insert(column_family, key, serialized)
+            self.delegate.insert(column_family, key, serialized, ttl=ttl)
         else:
-            self.delegate.insert(column_family, key, {super_key: serialized})
+            self.delegate.insert(column_family, key, {super_key: serialized}, ttl=ttl)
+        # after the write, so that a read which raced with it isn't cached
+        self._invalidate(type, key, ttl)
 
     def get_outgoing_relationship_count(self, source_node, relationship_type):
+        count = self._degree(source_node.type, source_node.key, 'outgoing', relationship_type)
+        if count is not None:
+            return count
         column_start = '%s__' % relationship_type
-        source_key = RELATIONSHIP_KEY_PATTERN % (source_node.type, source_node.key)
-        try:
-            return self.delegate.get_count(OUTBOUND_RELATIONSHIP_CF, source_key, column_start=column_start,
-                                     column_finish='%s_`' % relationship_type)
-        except NotFoundException:
-            return 0
+        count = 0
+        for source_key in self._outbound_rows(source_node.type, source_node.key, relationship_type):
+            try:
+                count += self.delegate.get_count(OUTBOUND_RELATIONSHIP_CF, source_key, column_start=column_start,
+                                                 column_finish='%s_`' % relationship_type)
+            except NotFoundException:
+                pass
+        return count
 
     def get_incoming_relationship_count(self, target_node, relationship_type):
+        count = self._degree(target_node.type, target_node.key, 'incoming', relationship_type)
+        if count is not None:
+            return count
         column_start = '%s__' % relationship_type
         target_key = RELATIONSHIP_KEY_PATTERN % (target_node.type, target_node.key)
         try:
@@ -75,74 +204,172 @@ class DataStore(object):
             return 0
     
     def get_all_outgoing_relationship_count(self,source_node):
-        source_key = RELATIONSHIP_KEY_PATTERN % (source_node.type, source_node.key)
-        return self.delegate.get_count(OUTBOUND_RELATIONSHIP_CF, source_key)
+        count = self._degree(source_node.type, source_node.key, 'outgoing')
+        if count is not None:
+            return count
+        count = 0
+        for source_key in self._outbound_rows(source_node.type, source_node.key):
+            try:
+                count += self.delegate.get_count(OUTBOUND_RELATIONSHIP_CF, source_key)
+            except NotFoundException:
+                pass
+        return count
 
     def get_all_incoming_relationship_count(self, target_node):
+        count = self._degree(target_node.type, target_node.key, 'incoming')
+        if count is not None:
+            return count
         target_key = RELATIONSHIP_KEY_PATTERN % (target_node.type, target_node.key)
         return self.delegate.get_count(INBOUND_RELATIONSHIP_CF, target_key)
 
-    def get_all_outgoing_relationships(self, source_node, column_count=500):
-        source_key = RELATIONSHIP_KEY_PATTERN % (source_node.type, source_node.key)
+    def _degree(self, type, key, direction, rel_type=None):
+        """
+        Reads a node's relationship count off its degree counters.  Returns None, so that the caller counts the
+        relationships themselves, for nodes whose counter row lacks the marker written when the node is created, such
+        as those written before counters were kept, and for nodes which have ever had a relationship with a ttl,
+        since counters don't expire.
+
+        The outgoing counts of a reference node are summed over its shards.
+        """
+        column = direction if rel_type is None else '%s__%s' % (direction, rel_type)
+        expiring = 'expiring__%s' % column
+        if direction == 'outgoing':
+            rows = self._outbound_rows(type, key, rel_type)
+        else:
+            rows = [ENDPOINT_NAME_TEMPLATE % (type, key)]
         try:
-            column_start = None
-            while True:
-                args = {'column_count': column_count}
-                if column_start is not None:
-                    args['column_start'] = column_start
-                super_columns = self.get(OUTBOUND_RELATIONSHIP_CF, source_key, **args)
-                for super_column in super_columns.items():
-                    if super_column[0] == column_start: continue
-                    yield self.get_outgoing_relationship(super_column[1]['rel_type'], source_node, super_column)
-                if len(super_columns) < column_count:
-                    return
-                column_start = super_columns.items()[-1][0]
+            counts = self.delegate.get_cf(RELATIONSHIP_COUNTS).multiget(
+                rows, columns=[RELATIONSHIP_COUNTS_MARKER, column, expiring])
         except NotFoundException:
-            return
+            return None
+        if not counts.get(rows[0], {}).get(RELATIONSHIP_COUNTS_MARKER):
+            return None
+        if any(row_counts.get(expiring) for row_counts in counts.values()):
+            return None
+        return sum(row_counts.get(column, 0) for row_counts in counts.values())
+
+    def _mark_counted(self, type, key):
+        # a new node has no relationships yet, so its counters are complete from here on
+        self.delegate.add(self.delegate.get_cf(RELATIONSHIP_COUNTS), ENDPOINT_NAME_TEMPLATE % (type, key),
+                          RELATIONSHIP_COUNTS_MARKER, 1)
+
+    def _count_relationship(self, rel_type, source_type, source_key, target_type, target_key, value, ttl=None,
+                            source_row=None):
+        counts = self.delegate.get_cf(RELATIONSHIP_COUNTS)
+        for key, column, amount in self._relationship_counts(rel_type, source_type, source_key, target_type,
+                                                             target_key, value, ttl, source_row):
+            self.delegate.add(counts, key, column, amount)
+
+    def _relationship_counts(self, rel_type, source_type, source_key, target_type, target_key, value, ttl,
+                             source_row=None):
+        if source_row is None:
+            source_row = self._outbound_row(source_type, source_key, rel_type, target_key)
+        for key, direction in [(source_row, 'outgoing'),
+                               (ENDPOINT_NAME_TEMPLATE % (target_type, target_key), 'incoming')]:
+            for column in [direction, '%s__%s' % (direction, rel_type)]:
+                yield key, column, value
+                if ttl is not None:
+                    yield key, 'expiring__%s' % column, 1
+
+    def _outbound_row(self, source_type, source_key, rel_type, target_key):
+        """
+        Returns the row which holds a relationship on its source's side.  If reference_shards is set, the instance
+        relationships of a reference node are spread over that many rows, chosen by a hash of the key of the node
+        they point to.
+        """
+        row = ENDPOINT_NAME_TEMPLATE % (source_type, source_key)
+        if self.reference_shards > 1 and source_type == 'reference' and rel_type == 'instance':
+            if isinstance(target_key, unicode):
+                target_key = target_key.encode('utf-8')
+            row = REFERENCE_SHARD_TEMPLATE % (row, (zlib.crc32(target_key) & 0xffffffff) % self.reference_shards)
+        return row
+
+    def _holding_row(self, source_type, source_key, rel_type, target_key, rel_key):
+        """
+        Returns the row which holds an existing relationship on its source's side.  That is the one _outbound_row
+        picks, except for an instance relationship written before its reference node was sharded, which is still
+        in the reference node's own row.  Costs a read for the instance relationships of a sharded reference node.
+        """
+        row = self._outbound_row(source_type, source_key, rel_type, target_key)
+        base_row = ENDPOINT_NAME_TEMPLATE % (source_type, source_key)
+        if row != base_row:
+            try:
+                self.get(OUTBOUND_RELATIONSHIP_CF, base_row, columns=[rel_key])
+            except NotFoundException:
+                return row
+            return base_row
+        return row
+
+    def _outbound_rows(self, source_type, source_key, rel_type=None):
+        """
+        Returns every row which may hold a node's outgoing relationships of rel_type, or of any type.  For a sharded
+        reference node, that is its own row, which holds its other relationships and any instance relationships
+        written before it was sharded, and each of its shards.
+        """
+        row = ENDPOINT_NAME_TEMPLATE % (source_type, source_key)
+        if self.reference_shards > 1 and source_type == 'reference' and rel_type in (None, 'instance'):
+            return [row] + [REFERENCE_SHARD_TEMPLATE % (row, shard) for shard in xrange(self.reference_shards)]
+        return [row]
+
+    def _outbound_pages(self, source_node, count, prefetch, column_start=None, column_finish=None, rel_type=None):
+        """
+        Pages through the outgoing relationships of a node.  The shards of a reference node are read one after
+        another, or by up to 4 workers at once if pages are prefetched.
+        """
+        sources = [
+            self._relationship_pages(OUTBOUND_RELATIONSHIP_CF, source_key, count, column_start, column_finish)
+            for source_key in self._outbound_rows(source_node.type, source_node.key, rel_type)
+        ]
+        if len(sources) == 1:
+            return self._read_ahead(sources[0], prefetch)
+        if prefetch is None:
+            prefetch = self.prefetch
+        if not prefetch:
+            return chain(*sources)
+        return read_parallel(sources, min(len(sources), 4), prefetch)
+
+    def get_all_outgoing_relationships(self, source_node, column_count=500, prefetch=None):
+        for page in self._outbound_pages(source_node, column_count, prefetch):
+            group = prim.NodeGroup(self)
+            for relationship in [self.get_outgoing_relationship(super_column[1]['rel_type'], source_node,
+                                                                super_column, group)
+                                 for super_column in page]:
+                yield relationship
 
-    def get_all_incoming_relationships(self, target_node, column_count=500):
+    def get_all_incoming_relationships(self, target_node, column_count=500, prefetch=None):
         target_key = RELATIONSHIP_KEY_PATTERN % (target_node.type, target_node.key)
-        try:
-            column_start = None
-            while True:
-                args = {'column_count': column_count}
-                if column_start is not None:
-                    args['column_start'] = column_start
-                super_columns = self.get(INBOUND_RELATIONSHIP_CF, target_key, **args)
-                for super_column in super_columns.items():
-                    if super_column[0] == column_start: continue
-                    yield self.get_incoming_relationship(super_column[1]['rel_type'], target_node, super_column)
-                if len(super_columns) < column_count:
-                    return
-                column_start = super_columns.items()[-1][0]
-        except NotFoundException:
-            return
+        pages = self._relationship_pages(INBOUND_RELATIONSHIP_CF, target_key, column_count)
+        for page in self._read_ahead(pages, prefetch):
+            group = prim.NodeGroup(self)
+            for relationship in [self.get_incoming_relationship(super_column[1]['rel_type'], target_node,
+                                                                super_column, group)
+                                 for super_column in page]:
+                yield relationship
         
-    def get_outgoing_relationships(self, source_node, rel_type, count=500):
-        source_key = RELATIONSHIP_KEY_PATTERN % (source_node.type, source_node.key)
-        #Ok, this is weird.  So in order to get a column slice, you need to provide a start that is <= your first column
-        #id, and a finish which is >= your last column.  Since our columns are sorted by ascii, this means we need to go
-        #from rel_type_ to rel_type` because "`" is the char 1 greater than "_", so this will get anything which starts
-        #rel_type_.  Now I realize that this could problems when there is a "_" in the relationship name, so we will
-        #probably need a different delimiter.
-        #TODO: fix delimiter
-        try:
-            column_start = '%s__' % rel_type
-            while True:
-                super_columns = self.get(OUTBOUND_RELATIONSHIP_CF, source_key, column_start=column_start,
-                                     column_finish='%s_`' % rel_type, column_count=count)
-                for super_column in super_columns.items():
-                    if super_column[0] == column_start: continue
-                    yield self.get_outgoing_relationship(rel_type, source_node, super_column)
-                if len(super_columns) < count:
-                    return
-                column_start = super_columns.items()[-1][0]
-        except NotFoundException:
-            return
+    def get_outgoing_relationships(self, source_node, rel_type, count=500, prefetch=None):
+        for page in self._outbound_pages(source_node, count, prefetch, '%s__' % rel_type, '%s_`' % rel_type,
+                                         rel_type):
+            group = prim.NodeGroup(self)
+            for relationship in [self.get_outgoing_relationship(rel_type, source_node, super_column, group)
+                                 for super_column in page]:
+                yield relationship
 
-
-    def get_incoming_relationships(self, target_node, rel_type, count=500):
+    def get_incoming_relationships(self, target_node, rel_type, count=500, prefetch=None):
         target_key = RELATIONSHIP_KEY_PATTERN % (target_node.type, target_node.key)
+        pages = self._relationship_pages(INBOUND_RELATIONSHIP_CF, target_key, count, '%s__' % rel_type,
+                                         '%s_`' % rel_type)
+        for page in self._read_ahead(pages, prefetch):
+            group = prim.NodeGroup(self)
+            for relationship in [self.get_incoming_relationship(rel_type, target_node, super_column, group)
+                                 for super_column in page]:
+                yield relationship
+
+    def _relationship_pages(self, type, row_key, count, column_start=None, column_finish=None):
+        """
+        Yields the super columns of a row, a page of at most count at a time.
+
+        Each page starts at the last column of the previous one, which is skipped.
+        """
         #Ok, this is weird.  So in order to get a column slice, you need to provide a start that is <= your first column
         #id, and a finish which is >= your last column.  Since our columns are sorted by ascii, this means we need to go
         #from rel_type_ to rel_type` because "`" is the char 1 greater than "_", so this will get anything which starts
@@ -150,24 +377,35 @@ class DataStore(object):
         #probably need a different delimiter.
         #TODO: fix delimiter
         try:
-            column_start = '%s__' % rel_type
             while True:
-                super_columns = self.get(INBOUND_RELATIONSHIP_CF, target_key, column_start=column_start,
-                                     column_finish='%s_`' % rel_type, column_count=count)
-                for super_column in super_columns.items():
-                    if super_column[0] == column_start: continue
-                    yield self.get_incoming_relationship(rel_type, target_node, super_column)
+                args = {'column_count': count}
+                if column_start is not None:
+                    args['column_start'] = column_start
+                if column_finish is not None:
+                    args['column_finish'] = column_finish
+                super_columns = self.get(type, row_key, **args).items()
+                yield [super_column for super_column in super_columns if super_column[0] != column_start]
                 if len(super_columns) < count:
                     return
-                column_start = super_columns.items()[-1][0]
+                column_start = super_columns[-1][0]
         except NotFoundException:
             return
 
+    def _read_ahead(self, pages, prefetch=None):
+        """
+        Fetches up to prefetch pages ahead of the caller on a worker thread, or self.prefetch if it isn't given.
+        """
+        if prefetch is None:
+            prefetch = self.prefetch
+        if not prefetch:
+            return pages
+        return read_ahead(pages, prefetch)
 
-    def get_outgoing_relationship(self, rel_type, source_node, super_column):
+
+    def get_outgoing_relationship(self, rel_type, source_node, super_column, group=None):
         """
         Process the contents of a SuperColumn to extract the relationship and to_node properties and return
-        a constructed relationship
+        a constructed relationship.  A partial to_node is added to group, if one is given.
         """
         rel_key = super_column[0]
         target_node_key = None
@@ -185,14 +423,13 @@ class DataStore(object):
             else:
                 rel_attributes[column] = value
         return prim.Relationship(rel_key, source_node,
-                                 prim.Node(self, target_node_type, target_node_key, target_attributes), self
-                                 , rel_type,
-                                 rel_attributes)
+                                 self._endpoint_node(target_node_type, target_node_key, target_attributes, group),
+                                 self, rel_type, rel_attributes)
 
-    def get_incoming_relationship(self, rel_type, target_node, super_column):
+    def get_incoming_relationship(self, rel_type, target_node, super_column, group=None):
         """
         Process the contents of a SuperColumn to extract an incoming relationship and the associated from_node and
-        return a constructed relationship
+        return a constructed relationship.  A partial from_node is added to group, if one is given.
         """
         rel_key = super_column[0]
         source_node_key = None
@@ -209,28 +446,125 @@ class DataStore(object):
                 source_attributes[column[8:]] = value
             else:
                 rel_attributes[column] = value
-        return prim.Relationship(rel_key, prim.Node(self, source_node_type, source_node_key, source_attributes),
+        return prim.Relationship(rel_key,
+                                 self._endpoint_node(source_node_type, source_node_key, source_attributes, group),
                                  target_node,
                                  self, rel_type, rel_attributes)
 
+    def _endpoint_node(self, type, key, attributes, group=None):
+        """
+        Builds a node from the copies of its attributes kept with a relationship.  For types which only keep some of
+        their attributes there, it is a PartialNode, which reads the rest when it is first used.
+        """
+        denormalized = self.denormalized.get(type)
+        if denormalized is None:
+            return prim.Node(self, type, key, attributes)
+        attributes = dict((name, value) for name, value in attributes.iteritems() if name in denormalized)
+        if group is None:
+            group = prim.NodeGroup(self)
+        return prim.PartialNode(self, type, key, attributes, group)
+
+    def _copied_attributes(self, node):
+        """
+        Returns the attributes of a node which are copied onto its relationships.  A PartialNode isn't read for them,
+        since it already has them.
+        """
+        attributes = node.loaded_values if isinstance(node, prim.PartialNode) else node.attributes
+        return self._denormalized_attributes(node.type, attributes)
 
-    def delete_relationship(self, rel_type, rel_key, rel_id, from_type, from_key, to_type, to_key):
-        rel_from_key = ENDPOINT_NAME_TEMPLATE % (from_type, from_key)
+    def _denormalized_attributes(self, type, attributes):
+        """
+        Returns the attributes of a node of the given type which are copied onto its relationships.
+        """
+        denormalized = self.denormalized.get(type)
+        if denormalized is None:
+            return attributes
+        return dict((name, value) for name, value in attributes.iteritems() if name in denormalized)
+
+
+    def delete_relationship(self, rel_type, rel_key, rel_id, from_type, from_key, to_type, to_key, existed=None):
+        """
+        existed, if the caller knows whether the relationship exists, saves reading that before it is counted out.
+        """
+        if self.write_behind is not None:
+            # a propagation under way would write its copies back into the relationship once it was deleted
+            self.write_behind.wait(from_type, from_key)
+            self.write_behind.wait(to_type, to_key)
+        rel_from_key = self._holding_row(from_type, from_key, rel_type, to_key, rel_id)
         rel_to_key = ENDPOINT_NAME_TEMPLATE % (to_type, to_key)
 
         with self.batch():
+            # deleting a relationship which is already gone mustn't count it out twice
+            existed = self._relationship_exists(rel_type, rel_key, existed)
+            self._batched('created').discard((rel_type, rel_key))
+            self._batched('deleted').add((rel_type, rel_key))
             self.delete(INBOUND_RELATIONSHIP_CF, rel_to_key, super_column=rel_id)
             self.delete(OUTBOUND_RELATIONSHIP_CF, rel_from_key, super_column=rel_id)
             self.delete(RELATIONSHIP_INDEX, rel_to_key, super_column=from_key, columns=[rel_type])
             self.delete(RELATIONSHIP_INDEX, rel_from_key, super_column=to_key, columns=[rel_type])
             self.delete(RELATIONSHIP_CF, ENDPOINT_NAME_TEMPLATE % (rel_type, rel_key))
+            if existed:
+                self._count_relationship(rel_type, from_type, from_key, to_type, to_key, -1,
+                                         source_row=rel_from_key)
 
-    def create_relationship(self, rel_type, source_node, target_node, key=None, args=dict()):
+    def create_relationship(self, rel_type, source_node, target_node, key=None, args=dict(), ttl=None):
+        """
+        If ttl is given, the relationship expires after that many seconds.  In cassandra, the denormalized columns
+        which save_node later rewrites on the relationship stop expiring.
+        """
         if key is None:
             key = str(uuid.uuid4())
-            #node relationship types
+            existed = False
+        else:
+            # writing over an existing relationship mustn't count it twice
+            existed = None
+        return self._write_relationship(rel_type, source_node, target_node, key, args, ttl, existed)
+
+    def create_relationships(self, relationships, ttl=None, chunk_size=1000):
+        """
+        Creates relationships from an iterable of (rel_type, source_node, target_node) or
+        (rel_type, source_node, target_node, args) tuples, which is read chunk_size relationships at a time.  Each
+        chunk is written in one batch in which every row is written once, and the attributes of each node are
+        serialized once.  Returns the number of relationships created.
+        """
+        created = 0
+        for chunk in _chunks(relationships, chunk_size):
+            self._write_relationships([
+                (relationship[0], relationship[1], relationship[2],
+                 relationship[3] if len(relationship) > 3 else {}, str(uuid.uuid4()))
+                for relationship in chunk
+            ], ttl)
+            created += len(chunk)
+        return created
+
+    def save_relationship(self, relationship):
+        return self._write_relationship(relationship.type, relationship.source_node, relationship.target_node,
+                                        relationship.key, relationship.new_values, None, True)
+
+    def _relationship_exists(self, rel_type, key, existed=None):
+        """
+        Answers from the relationships created and deleted in the thread's open batch, which a read wouldn't see,
+        then from existed, and only then with a read.  So create_relationship only reads when it is given a key,
+        and delete_node never does.
+        """
+        if (rel_type, key) in self._batched('deleted'):
+            return False
+        if (rel_type, key) in self._batched('created'):
+            return True
+        if existed is not None:
+            return existed
+        try:
+            self.delegate.get_cf(RELATIONSHIP_CF).get(ENDPOINT_NAME_TEMPLATE % (rel_type, key), column_count=1)
+        except NotFoundException:
+            return False
+        return True
+
+    def _write_relationship(self, rel_type, source_node, target_node, key, args, ttl, existed):
         rel_key = RELATIONSHIP_KEY_PATTERN % (rel_type, key)
         with self.batch():
+            count = not self._relationship_exists(rel_type, key, existed)
+            self._batched('deleted').discard((rel_type, key))
+            self._batched('created').add((rel_type, key))
             #outbound_cf
             columns = {'rel_type': rel_type, 'rel_key': key}
             #add relationship attributes
@@ -239,30 +573,87 @@ class DataStore(object):
             #add target attributes
             columns['target__type'] = target_node.type.encode('ascii')
             columns['target__key'] = target_node.key.encode('ascii')
-            target_attributes = target_node.attributes
+            target_attributes = self._copied_attributes(target_node)
             for attribute_key in target_attributes.keys():
                 columns['target__%s' % attribute_key] = target_attributes[attribute_key]
             columns['source__type'] = source_node.type.encode('ascii')
             columns['source__key'] = source_node.key.encode('ascii')
-            source_attributes = source_node.attributes
+            source_attributes = self._copied_attributes(source_node)
             for attribute_key in source_attributes.keys():
                 columns['source__%s' % attribute_key] = source_attributes[attribute_key]
 
-            source_key = ENDPOINT_NAME_TEMPLATE % (source_node.type, source_node.key)
+            if count:
+                source_key = self._outbound_row(source_node.type, source_node.key, rel_type, target_node.key)
+            else:
+                # a relationship written over stays in the row which already holds it
+                source_key = self._holding_row(source_node.type, source_node.key, rel_type, target_node.key,
+                                               rel_key)
             target_key = ENDPOINT_NAME_TEMPLATE % (target_node.type, target_node.key)
             serialized = self.serialize_columns(columns)
-            self.insert(RELATIONSHIP_CF, ENDPOINT_NAME_TEMPLATE % (rel_type, key), serialized)
-            self.insert(OUTBOUND_RELATIONSHIP_CF, source_key, {rel_key: serialized})
-            self.insert(INBOUND_RELATIONSHIP_CF, target_key, {rel_key: serialized})
+            self.insert(RELATIONSHIP_CF, ENDPOINT_NAME_TEMPLATE % (rel_type, key), serialized, ttl=ttl)
+            self.insert(OUTBOUND_RELATIONSHIP_CF, source_key, {rel_key: serialized}, ttl=ttl)
+            self.insert(INBOUND_RELATIONSHIP_CF, target_key, {rel_key: serialized}, ttl=ttl)
 
             #            relationship_index_cf = self.delegate.get_cf(RELATIONSHIP_INDEX)
             # Add entries in the relationship index
-            self.insert(RELATIONSHIP_INDEX, source_key, {target_node.key: {rel_type: '%s__outgoing' % rel_key}})
-            self.insert(RELATIONSHIP_INDEX, target_key, {source_node.key: {rel_type: '%s__incoming' % rel_key}})
+            self.insert(RELATIONSHIP_INDEX, source_key, {target_node.key: {rel_type: '%s__outgoing' % rel_key}},
+                        ttl=ttl)
+            self.insert(RELATIONSHIP_INDEX, target_key, {source_node.key: {rel_type: '%s__incoming' % rel_key}},
+                        ttl=ttl)
+            if count:
+                self._count_relationship(rel_type, source_node.type, source_node.key, target_node.type,
+                                         target_node.key, 1, ttl, source_key)
 
         #created relationship object
         return prim.Relationship(rel_key, source_node, target_node, self, rel_type, rel_attr)
 
+    def _write_relationships(self, relationships, ttl):
+        """
+        Writes and counts new relationships, given as (rel_type, source_node, target_node, args, key) tuples, the
+        way _write_relationship does, with the columns of each row gathered into a single insert.
+        """
+        endpoints = {}
+        rows = OrderedDict()
+        counts = OrderedDict()
+        for rel_type, source_node, target_node, args, key in relationships:
+            rel_key = RELATIONSHIP_KEY_PATTERN % (rel_type, key)
+            columns = {'rel_type': rel_type, 'rel_key': key}
+            columns.update(args)
+            serialized = self.serialize_columns(columns)
+            serialized.update(self._endpoint_columns(endpoints, 'target', target_node))
+            serialized.update(self._endpoint_columns(endpoints, 'source', source_node))
+
+            source_key = self._outbound_row(source_node.type, source_node.key, rel_type, target_node.key)
+            target_key = ENDPOINT_NAME_TEMPLATE % (target_node.type, target_node.key)
+            rows[RELATIONSHIP_CF, ENDPOINT_NAME_TEMPLATE % (rel_type, key)] = serialized
+            rows.setdefault((OUTBOUND_RELATIONSHIP_CF, source_key), {})[rel_key] = serialized
+            rows.setdefault((INBOUND_RELATIONSHIP_CF, target_key), {})[rel_key] = serialized
+            rows.setdefault((RELATIONSHIP_INDEX, source_key), {}).setdefault(target_node.key, {})[rel_type] = \
+                '%s__outgoing' % rel_key
+            rows.setdefault((RELATIONSHIP_INDEX, target_key), {}).setdefault(source_node.key, {})[rel_type] = \
+                '%s__incoming' % rel_key
+            for row, column, value in self._relationship_counts(rel_type, source_node.type, source_node.key,
+                                                                target_node.type, target_node.key, 1, ttl):
+                counts[row, column] = counts.get((row, column), 0) + value
+        with self.batch():
+            self._batched('created').update((relationship[0], relationship[4]) for relationship in relationships)
+            # the columns are already serialized, and the relationship column families always exist
+            for (cf, row), columns in rows.iteritems():
+                self.delegate.insert(self.delegate.get_cf(cf), row, columns, ttl=ttl)
+            counter_cf = self.delegate.get_cf(RELATIONSHIP_COUNTS)
+            for (row, column), value in counts.iteritems():
+                self.delegate.add(counter_cf, row, column, value)
+
+    def _endpoint_columns(self, endpoints, prefix, node):
+        columns = endpoints.get((prefix, node.type, node.key))
+        if columns is None:
+            columns = {'%s__type' % prefix: node.type.encode('ascii'), '%s__key' % prefix: node.key.encode('ascii')}
+            attributes = self._copied_attributes(node)
+            for attribute_key in attributes.keys():
+                columns['%s__%s' % (prefix, attribute_key)] = attributes[attribute_key]
+            columns = endpoints[prefix, node.type, node.key] = self.serialize_columns(columns)
+        return columns
+
     def get_relationship(self, rel_type, rel_key):
         try:
             values = self.get(RELATIONSHIP_CF, ENDPOINT_NAME_TEMPLATE % (rel_type, rel_key)) 
@@ -279,7 +670,7 @@ class DataStore(object):
                 source_node_key = value
             elif column.startswith('source__'):
                 source_attributes[column[8:]] = value
-        source = prim.Node(self, source_node_type, source_node_key, source_attributes)
+        source = self._endpoint_node(source_node_type, source_node_key, source_attributes)
         rel_key = RELATIONSHIP_KEY_PATTERN % (rel_type, rel_key)
         return self.get_outgoing_relationship(rel_type, source, (rel_key, values))
 
@@ -292,149 +683,291 @@ class DataStore(object):
 
         """
         node_a_row_key = ENDPOINT_NAME_TEMPLATE % (node_a.type, node_a.key)
+        outbound_row_key = self._outbound_row(node_a.type, node_a.key, rel_type, node_b_key)
         rel_list = []
-        try:
-            rels = self.get(RELATIONSHIP_INDEX, node_a_row_key, super_column=node_b_key, columns=[rel_type])
-            for rel in rels.values():
-                if rel.endswith('__incoming'):
-                    rel_id = string.replace(rel, '__incoming', '')
-                    super_column = self.get(INBOUND_RELATIONSHIP_CF, node_a_row_key, columns=[rel_id]).items()[0]
-                    relationship = self.get_incoming_relationship(rel_type, node_a, super_column)
-                elif rel.endswith('__outgoing'):
-                    rel_id = string.replace(rel, '__outgoing', '')
-                    super_column = self.get(OUTBOUND_RELATIONSHIP_CF, node_a_row_key, columns=[rel_id]).items()[0]
-                    relationship = self.get_outgoing_relationship(rel_type, node_a, super_column)
-                else:
-                    continue
-
-                rel_list.append(relationship)
-        except NotFoundException:
-            pass
+        for row_key in set([node_a_row_key, outbound_row_key]):
+            try:
+                rels = self.get(RELATIONSHIP_INDEX, row_key, super_column=node_b_key, columns=[rel_type])
+                for rel in rels.values():
+                    if rel.endswith('__incoming'):
+                        rel_id = string.replace(rel, '__incoming', '')
+                        super_column = self.get(INBOUND_RELATIONSHIP_CF, node_a_row_key, columns=[rel_id]).items()[0]
+                        relationship = self.get_incoming_relationship(rel_type, node_a, super_column)
+                    elif rel.endswith('__outgoing'):
+                        rel_id = string.replace(rel, '__outgoing', '')
+                        super_column = self.get(OUTBOUND_RELATIONSHIP_CF, row_key, columns=[rel_id]).items()[0]
+                        relationship = self.get_outgoing_relationship(rel_type, node_a, super_column)
+                    else:
+                        continue
+
+                    rel_list.append(relationship)
+            except NotFoundException:
+                pass
         return rel_list
 
-    def create_node(self, type, key, args=None, reference=False):
+    def create_node(self, type, key, args=None, reference=False, ttl=None, blind=False):
+        """
+        If ttl is given, the node and its entry in the reference node for its type expire after that many
+        seconds.
+
+        With blind set, the node isn't read first: it and its entry in the reference node are written in one batch,
+        and the reference node is only read the first time a node of its type is created blind or by create_nodes.
+        Only that entry is read, to tell whether the node is new, so that a node created again isn't counted again.
+        A node which already exists gets args written over its attributes, but only the copies of them in its entry
+        in the reference node are updated, not those on its other relationships.
+        """
         if args is None:
             args = {}
+        if blind:
+            return self._create_new_node(type, key, args, reference, ttl, self._cached_reference_node, None)
         try:
             node = self.get_node(type, key)
             node.attributes.update(args)
-            self.save_node(node)
+            self.save_node(node, ttl=ttl)
             return node
         except NodeNotFoundException:
+            return self._create_new_node(type, key, args, reference, ttl, self.get_reference_node, False)
+
+    def _cached_reference_node(self, type):
+        """
+        Returns the reference node of a type, which is only read the first time.  The cache is cleared by truncate
+        and drop, but not by another process doing either, so it only serves the bulk paths.
+        """
+        reference_node = self._reference_nodes.get(type)
+        if reference_node is None:
+            reference_node = self._reference_nodes[type] = self.get_reference_node(type)
+        return reference_node
+
+    def _create_new_node(self, type, key, args, reference, ttl, get_reference_node, existed):
+        if not reference:
+            reference_node = get_reference_node(type)
+        with self.batch():
+            if existed is None:
+                existed = not reference and key in self._existing_instances(type, [key])
             #since node won't get created without args, we will include __id by default
             args["__id"] = key
             serialized = self.serialize_columns(args)
-            self.insert(type, key, serialized)
+            self.insert(type, key, serialized, ttl=ttl)
+            if not existed:
+                self._mark_counted(type, key)
             node = prim.Node(self, type, key, args)
             if not reference:
                 #this adds the created node to the reference node for this type of object
                 #that reference node functions as an index to easily access all nodes of a specific type
-                reference_node = self.get_reference_node(type)
-                reference_node.instance(node, key=key)
-            self.delegate.on_create(node)
-            return node
+                self._write_relationship('instance', reference_node, node, key, {}, ttl, existed)
+        self.delegate.on_create(node)
+        return node
+
+    def create_nodes(self, type, nodes, ttl=None, chunk_size=1000, blind=False):
+        """
+        Creates nodes from an iterable of (key, args) pairs, which is read chunk_size nodes at a time.  The nodes of
+        a chunk which already exist are found with one multiget and are updated as create_node would, or as it
+        would with blind set, when only their entries in the reference node are read.  The new ones are written in
+        one batch along with their entries in the reference node.  Returns the number of nodes created or updated.
+        """
+        reference_node = self._cached_reference_node(type)
+        written = 0
+        for chunk in _chunks(nodes, chunk_size):
+            pending = OrderedDict()
+            for key, args in chunk:
+                pending.setdefault(key, {}).update(args or {})
+            if not blind and self.delegate.cf_exists(type):
+                try:
+                    existing = self.get_nodes(type, pending.keys())
+                except NodeNotFoundException:
+                    existing = []
+                for node in existing:
+                    node.attributes.update(pending.pop(node.key))
+                    self.save_node(node, ttl=ttl)
+                    written += 1
+            created = []
+            with self.batch():
+                existing = self._existing_instances(type, pending.keys()) if blind else ()
+                for key, args in pending.iteritems():
+                    args["__id"] = key
+                    self.insert(type, key, args, ttl=ttl)
+                    node = prim.Node(self, type, key, args)
+                    if key in existing:
+                        self._write_relationship('instance', reference_node, node, key, {}, ttl, True)
+                        continue
+                    self._mark_counted(type, key)
+                    created.append(node)
+                self._write_relationships([
+                    ('instance', reference_node, node, {}, node.key)
+                    for node in created
+                ], ttl)
+            for node in created:
+                self.delegate.on_create(node)
+            written += len(pending)
+        return written
+
+    def _existing_instances(self, type, keys):
+        """
+        Returns those of keys which already have an entry in the reference node of type, as every node but a
+        reference node has once it is created, read with one multiget of the rows which may hold them.  Entries
+        written or deleted in the thread's open batch are taken into account.
+        """
+        existing = set(key for key in keys if ('instance', key) in self._batched('created'))
+        unknown = [RELATIONSHIP_KEY_PATTERN % ('instance', key) for key in keys
+                   if key not in existing and ('instance', key) not in self._batched('deleted')]
+        if unknown:
+            prefix = len(RELATIONSHIP_KEY_PATTERN % ('instance', ''))
+            rows = self.delegate.get_cf(OUTBOUND_RELATIONSHIP_CF).multiget(
+                self._outbound_rows('reference', type, 'instance'), columns=unknown)
+            for columns in rows.itervalues():
+                existing.update(rel_key[prefix:] for rel_key in columns)
+        return existing
 
     def delete_node(self, node):
         relationships = node.relationships
         self.delegate.on_delete(node)
         with self.batch():
            for rel in relationships:
-                rel.delete()
+                # they were just read, so they needn't be read again to be counted out
+                self.delete_relationship(rel.type, rel.key, rel.rel_key, rel.source_node.type, rel.source_node.key,
+                                         rel.target_node.type, rel.target_node.key, existed=True)
                 self.delete(node.type, node.key)
+           self._invalidate(node.type, node.key)
+        if node.type == 'reference':
+            self._reference_nodes.pop(node.key, None)
 
-    def save_node(self, node):
+    def save_node(self, node, ttl=None):
         """
-        This needs to update the entry in the type table as well as all of the relationships
+        This needs to update the entry in the type table as well as all of the relationships.  If ttl is given, the
+        node's own columns expire after that many seconds.
+
+        Only the attributes which differ between the node's old_values and new_values are written, and the
+        relationships are left alone when none of those which are copied onto them do.
         """
         with self.batch():
             log.debug("Saving node: {0}: {1}".format(node.type, node.key))
-            self.insert(node.type, node.key, self.serialize_columns(node.attributes))
+            self._invalidate(node.type, node.key)
+            changed = self._changed_attributes(node)
             columns_to_remove = []
             for key in node.old_values:
                 if not key in node.new_values:
                     columns_to_remove.append(key)
+            # a ttl applies to all of the node's columns, so they are all written again
+            columns = node.attributes if ttl is not None else changed
+            if columns:
+                self.insert(node.type, node.key, columns, ttl=ttl)
             if len(columns_to_remove) > 0:
                 self.remove(self.get_cf(node.type), node.key, columns=columns_to_remove)
-            source_key = ENDPOINT_NAME_TEMPLATE % (node.type, node.key)
-            target_key = ENDPOINT_NAME_TEMPLATE % (node.type, node.key)
-
-            try:
-                next_start_id = ""
-                num_columns = self.delegate.get_count(OUTBOUND_RELATIONSHIP_CF, source_key, column_start=next_start_id)
-                outbound_results = self.get(OUTBOUND_RELATIONSHIP_CF, source_key,
-                                            column_start=next_start_id, column_count=num_columns)
-            except NotFoundException:
-                log.debug("No outgoing relationships for {0}: {1}".format(node.type, node.key))
-                outbound_results = {}
+        # only the attributes which are copied onto relationships are propagated
+        changed = self._denormalized_attributes(node.type, changed)
+        denormalized = self.denormalized.get(node.type)
+        if denormalized is not None:
+            columns_to_remove = [column for column in columns_to_remove if column in denormalized]
+        if not changed and not columns_to_remove:
+            log.debug("No denormalized attributes of {0}: {1} changed".format(node.type, node.key))
+        elif self.write_behind is not None:
+            self.write_behind.put(node.type, node.key, self.serialize_columns(changed), columns_to_remove)
+        else:
             try:
-                next_start_id = ""
-                inbound_results = {}
-                num_columns = self.delegate.get_count(INBOUND_RELATIONSHIP_CF, target_key, column_start=next_start_id)
-                inbound_results = self.get(INBOUND_RELATIONSHIP_CF, target_key,
-                                        column_start=next_start_id, column_count=num_columns)
-            except NotFoundException:
-                log.debug("No incoming relationships for {0}: {1}".format(node.type, node.key))
-                inbound_results = {}
-
-            outbound_columns = {'source__type': node.type.encode('utf-8'), 'source__key': node.key.encode('utf-8')}
-            node_attributes = node.attributes
-            for attribute_key in node.attributes.keys():
-                outbound_columns['source__%s' % attribute_key] = node_attributes[attribute_key]
-            for key in outbound_results.keys():
-                target = outbound_results[key]
-                target_key = ENDPOINT_NAME_TEMPLATE % (target['target__type'], target['target__key'])
-                target.update(outbound_columns)
-                serialized = self.serialize_columns(target)
-                self.insert(OUTBOUND_RELATIONSHIP_CF, source_key, serialized, key)
-                self.insert(INBOUND_RELATIONSHIP_CF, target_key, serialized, key)
-                self.insert(RELATIONSHIP_CF, key, serialized)
-                if len(columns_to_remove):
-                    self.delete(OUTBOUND_RELATIONSHIP_CF, source_key, super_column=key,
-                            columns=['source__%s' % column for column in columns_to_remove])
-                    self.delete(INBOUND_RELATIONSHIP_CF, target_key, super_column=key,
-                            columns=['source__%s' % column for column in columns_to_remove])
-                    self.remove(self.get_cf(RELATIONSHIP_CF), key,
-                            columns=['source__%s' % column for column in columns_to_remove])
-            inbound_columns = {'target__type': node.type.encode('utf-8'), 'target__key': node.key.encode('utf-8')}
-            for attribute_key in node.attributes.keys():
-                inbound_columns['target__%s' % attribute_key] = node_attributes[attribute_key]
-            for key in inbound_results.keys():
-                source = inbound_results[key]
-                source_key = ENDPOINT_NAME_TEMPLATE % (source['source__type'], source['source__key'])
-                target_key = ENDPOINT_NAME_TEMPLATE % (node.type, node.key)
-                source.update(inbound_columns)
-                serialized = self.serialize_columns(source)
-                self.insert(OUTBOUND_RELATIONSHIP_CF, source_key, serialized, key)
-                self.insert(INBOUND_RELATIONSHIP_CF, target_key, serialized, key)
-                self.insert(RELATIONSHIP_CF, key, serialized)
-                if len(columns_to_remove):
-                    self.delete(OUTBOUND_RELATIONSHIP_CF, source_key, super_column=key,
-                            columns=['target__%s' % column for column in columns_to_remove])
-                    self.delete(INBOUND_RELATIONSHIP_CF, target_key, super_column=key,
-                            columns=['target__%s' % column for column in columns_to_remove])
-                    self.remove(self.get_cf(RELATIONSHIP_CF), key,
-                            columns=['target__%s' % column for column in columns_to_remove])
+                self._propagate_attributes(node.type, node.key, changed, columns_to_remove)
+            except Exception, e:
+                # the node's own row and the pages before the one which failed have been written
+                log.exception("Failed to propagate the attributes of {0}: {1}; the copies on some of its "
+                              "relationships are out of date".format(node.type, node.key))
+                raise PropagationError([((node.type, node.key), e)])
 
         # update plugins
         self.on_modify(node)
 
+    def _changed_attributes(self, node):
+        old_values = node.old_values
+        return dict(
+            (key, value)
+            for key, value in node.new_values.iteritems()
+            if key not in old_values or old_values[key] != value
+        )
+
+    def _propagate_attributes(self, type, key, changed, columns_to_remove):
+        """
+        Writes the changed attributes of a node into the denormalized copies of them kept with each of its
+        relationships, and removes the copies of the attributes which were removed.  The relationships are read
+        propagation_page_size at a time, and the copies of each page are written in a batch of their own, unless
+        the node is saved inside a batch the caller opened, so a failure part way through leaves the copies of
+        some pages updated and the rest not.
+        """
+        node_key = ENDPOINT_NAME_TEMPLATE % (type, key)
+        rows = [(OUTBOUND_RELATIONSHIP_CF, row_key, 'source', 'target') for row_key in self._outbound_rows(type, key)]
+        rows.append((INBOUND_RELATIONSHIP_CF, node_key, 'target', 'source'))
+        for cf, row_key, prefix, other in rows:
+            columns = self.serialize_columns(dict(
+                ('%s__%s' % (prefix, attribute_key), value) for attribute_key, value in changed.iteritems()))
+            removed = ['%s__%s' % (prefix, column) for column in columns_to_remove]
+            for page in self._relationship_pages(cf, row_key, self.propagation_page_size):
+                with self.batch():
+                    for rel_key, relationship in page:
+                        if prefix == 'source':
+                            source_key = row_key
+                            target_key = ENDPOINT_NAME_TEMPLATE % (relationship['target__type'],
+                                                                   relationship['target__key'])
+                        else:
+                            source_key = self._holding_row(relationship['source__type'], relationship['source__key'],
+                                                           relationship['rel_type'], key, rel_key)
+                            target_key = node_key
+                        if columns:
+                            self.insert(OUTBOUND_RELATIONSHIP_CF, source_key, columns, rel_key)
+                            self.insert(INBOUND_RELATIONSHIP_CF, target_key, columns, rel_key)
+                            self.insert(RELATIONSHIP_CF, rel_key, columns)
+                        if removed:
+                            self.delete(OUTBOUND_RELATIONSHIP_CF, source_key, super_column=rel_key, columns=removed)
+                            self.delete(INBOUND_RELATIONSHIP_CF, target_key, super_column=rel_key, columns=removed)
+                            self.remove(self.get_cf(RELATIONSHIP_CF), rel_key, columns=removed)
+
     def get_node(self, type, key):
+        if self.node_cache is not None:
+            values = self.node_cache.get(type, key)
+            if values is not None:
+                return prim.Node(self, type, key, values)
+            generation = self.node_cache.generation
         try:
             values = self.get(type, key)
         except NotFoundException:
             raise NodeNotFoundException()
+        if self.node_cache is not None:
+            self.node_cache.put(type, key, values, generation)
         return prim.Node(self, type, key, values)
 
     def get_nodes(self, type, keys):
-        try:
-            rows = self.multiget(type, keys)
-        except NotFoundException:
-            raise NodeNotFoundException()
-        return [ 
-            prim.Node(self, type, key, values)
-            for key, values in rows
+        """
+        Only the nodes which aren't cached are read, with a single multiget.
+        """
+        cached = {}
+        misses = keys
+        if self.node_cache is not None:
+            for key in keys:
+                values = self.node_cache.get(type, key)
+                if values is not None:
+                    cached[key] = values
+            misses = [key for key in keys if key not in cached]
+            generation = self.node_cache.generation
+        if misses:
+            try:
+                rows = self.multiget(type, misses)
+            except NotFoundException:
+                raise NodeNotFoundException()
+            for key, values in rows:
+                cached[key] = values
+                if self.node_cache is not None:
+                    self.node_cache.put(type, key, values, generation)
+        return [
+            prim.Node(self, type, key, cached[key])
+            for key in keys
+            if key in cached
         ]
 
+    def scan_nodes(self, type, workers=4, buffer_size=1000):
+        """
+        Yields every node of a type, in no particular order.  Rather than walking the type's reference node, the
+        type's rows are split into ranges, token ranges in cassandra, which worker threads read concurrently, up to
+        buffer_size nodes ahead of the caller.
+        """
+        for key, values in read_parallel(self.delegate.scan(type, workers), workers, buffer_size):
+            yield prim.Node(self, type, key, self.deserialize_value(values))
+
     def get_nodes_by_attr(self, type, attrs = {}, expressions=None, start_key='', row_count = 2147483647, **kwargs):
         if expressions is None:
             expressions = []
@@ -545,4 +1078,13 @@ def load_from_settings(settings):
     cls = getattr(module, cls_name)
     delegate = cls(**settings['backend_config'])
     delegate.load_plugins(settings['plugins'])
-    return DataStore(delegate)
+    node_cache = None
+    if settings.get('node_cache') is not None:
+        node_cache = NodeCache(**settings['node_cache'])
+    write_behind = None
+    if settings.get('write_behind') is not None:
+        write_behind = WriteBehindQueue(**settings['write_behind'])
+    return DataStore(delegate, prefetch=settings.get('prefetch', 0), node_cache=node_cache,
+                     propagation_page_size=settings.get('propagation_page_size', 500), write_behind=write_behind,
+                     denormalized=settings.get('denormalized'),
+                     reference_shards=settings.get('reference_shards', 1))
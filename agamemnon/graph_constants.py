@@ -20,8 +20,11 @@ RELATIONSHIP_INDEX = '__relationship__index__'
 OUTBOUND_RELATIONSHIP_CF = 'outbound__%s' % RELATIONSHIP_INDEX
 INBOUND_RELATIONSHIP_CF = 'inbound__%s' % RELATIONSHIP_INDEX
 RELATIONSHIP_CF = 'relationships'
+RELATIONSHIP_COUNTS = 'relationship__counts'
+RELATIONSHIP_COUNTS_MARKER = 'counted'
 RELATIONSHIP_KEY_PATTERN = '%s__%s'
 ENDPOINT_NAME_TEMPLATE = '%s__%s'
+REFERENCE_SHARD_TEMPLATE = '%s__shard__%d'
 ASCII = pycassa.ASCII_TYPE
 BYTES = pycassa.BYTES_TYPE
 TIME_UUID = pycassa.TIME_UUID_TYPE
@@ -0,0 +1,190 @@
+"""
+Hedged reads: a read which hasn't been answered within the usual latency of the host it was sent to is sent to a
+second host as well, and the first answer from either is used.
+"""
+import sys
+import threading
+import time
+from bisect import insort
+from collections import deque
+from heapq import heappop, heappush
+from itertools import count
+from Queue import Queue
+from pycassa.cassandra.ttypes import NotFoundException
+
+
+class LatencyTracker(object):
+    """
+    Keeps the last window latencies of each host.  Percentiles are read off a sorted copy of them, which is only
+    sorted again once resort_every more latencies have been recorded.
+    """
+
+    def __init__(self, window=1000, resort_every=50):
+        self.window = window
+        self.resort_every = resort_every
+        self._samples = {}
+        self._sorted = {}
+        self._unsorted = {}
+        self._lock = threading.Lock()
+
+    def record(self, host, seconds):
+        with self._lock:
+            samples = self._samples.get(host)
+            if samples is None:
+                samples = self._samples[host] = deque(maxlen=self.window)
+            samples.append(seconds)
+            self._unsorted[host] = self._unsorted.get(host, 0) + 1
+
+    def count(self, host):
+        return len(self._samples.get(host, ()))
+
+    def percentile(self, host, percentile):
+        """
+        Returns the given percentile of the host's latencies, or None if nothing has been recorded for it.
+        """
+        with self._lock:
+            samples = self._samples.get(host)
+            if not samples:
+                return None
+            ordered = self._sorted.get(host)
+            if ordered is None or self._unsorted[host] >= min(self.resort_every, len(ordered)):
+                ordered = self._sorted[host] = sorted(samples)
+                self._unsorted[host] = 0
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100.0))]
+
+    def ranked(self, hosts):
+        """
+        Orders hosts by their median latency.  Hosts without any latencies come first, so that they get tried.
+        """
+        ranked = []
+        for position, host in enumerate(hosts):
+            median = self.percentile(host, 50)
+            insort(ranked, (median if median is not None else -1, position, host))
+        return [host for median, position, host in ranked]
+
+
+class _Read(object):
+    def __init__(self, host, read, results):
+        self.host = host
+        self.read = read
+        self.results = results
+        self.sent = False
+        self.cancelled = False
+
+
+class HedgePolicy(object):
+    """
+    Sends each read to the fastest host.  If no answer has come back after the percentile of that host's
+    latencies, or after initial_delay until enough of them are known, the read is sent to the next fastest host as
+    well, and whichever answers first is returned.  If the first host fails, its read is hedged straight away.
+
+    Reads are run by a pool of worker threads; a read which finds every worker busy gets a thread of its own, so
+    that reads held up by a slow host don't hold up the others.  NotFoundException is an answer like any other, not
+    a failure.  Latencies are measured, and hedges scheduled, with clock.
+    """
+
+    def __init__(self, hosts, percentile=95, min_delay=0.002, initial_delay=0.05, workers=8, window=1000,
+                 min_samples=20, clock=time.time):
+        self.hosts = list(hosts)
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.initial_delay = initial_delay
+        self.min_samples = min_samples
+        self.tracker = LatencyTracker(window)
+        self._clock = clock
+        self._tasks = Queue()
+        self._timer = threading.Condition()
+        self._scheduled = []
+        self._sequence = count()
+        self._idle = workers
+        threads = [threading.Thread(target=self._run, name='agamemnon-hedge-%d' % i) for i in xrange(workers)]
+        threads.append(threading.Thread(target=self._schedule, name='agamemnon-hedge-timer'))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+    def delay(self, host):
+        if self.tracker.count(host) < self.min_samples:
+            return self.initial_delay
+        return max(self.min_delay, self.tracker.percentile(host, self.percentile))
+
+    def call(self, reads):
+        """
+        reads maps each host to a callable which performs the read against it.  Returns the first answer from
+        either host, and raises the first host's failure if both fail.
+        """
+        hosts = self.tracker.ranked([host for host in self.hosts if host in reads])
+        results = Queue()
+        primary = _Read(hosts[0], reads[hosts[0]], results)
+        hedge = _Read(hosts[1], reads[hosts[1]], results) if len(hosts) > 1 else None
+        with self._timer:
+            self._send(primary)
+            if hedge is not None:
+                heappush(self._scheduled, (self._clock() + self.delay(hosts[0]), next(self._sequence), hedge))
+                self._timer.notify()
+        failures = {}
+        while True:
+            read, value, error = results.get()
+            if error is None or issubclass(error[0], NotFoundException):
+                if hedge is not None:
+                    with self._timer:
+                        hedge.cancelled = True
+                        self._timer.notify()
+                if error is None:
+                    return value
+                raise error[0], error[1], error[2]
+            failures[read] = error
+            with self._timer:
+                if hedge is not None and primary in failures:
+                    self._send(hedge)
+                    self._timer.notify()
+                sent = 1 if hedge is None or not hedge.sent else 2
+            if len(failures) == sent:
+                error = failures[primary]
+                raise error[0], error[1], error[2]
+
+    def _read(self, read):
+        started = self._clock()
+        try:
+            value = read.read()
+            error = None
+        except Exception:
+            value = None
+            error = sys.exc_info()
+        if error is None or issubclass(error[0], NotFoundException):
+            self.tracker.record(read.host, self._clock() - started)
+        read.results.put((read, value, error))
+
+    def _send(self, read):
+        # called with the timer's lock held
+        if read.sent or read.cancelled:
+            return
+        read.sent = True
+        if self._idle:
+            self._idle -= 1
+            self._tasks.put(read)
+        else:
+            thread = threading.Thread(target=self._read, args=(read,), name='agamemnon-hedge-overflow')
+            thread.daemon = True
+            thread.start()
+
+    def _schedule(self):
+        with self._timer:
+            while True:
+                # hedges which have been sent or are no longer needed are dropped as soon as they come up
+                while self._scheduled and (self._scheduled[0][2].sent or self._scheduled[0][2].cancelled):
+                    heappop(self._scheduled)
+                if not self._scheduled:
+                    self._timer.wait()
+                    continue
+                remaining = self._scheduled[0][0] - self._clock()
+                if remaining > 0:
+                    self._timer.wait(remaining)
+                    continue
+                self._send(heappop(self._scheduled)[2])
+
+    def _run(self):
+        while True:
+            self._read(self._tasks.get())
+            with self._timer:
+                self._idle += 1
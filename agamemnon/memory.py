@@ -1,27 +1,239 @@
 import operator
+import os
+import threading
+import time
+import weakref
+from bisect import bisect_left, bisect_right, insort
+from collections import Mapping
+from contextlib import contextmanager
+from thread import get_ident
 from ordereddict import OrderedDict
 from pycassa.cassandra.ttypes import NotFoundException
 from pycassa.index import LT, LTE, EQ, GTE, GT
 from agamemnon.graph_constants import ASCII
 import logging
 from agamemnon.delegate import Delegate
+from agamemnon.exceptions import ReadOnlyError
+from agamemnon.persistence import MutationLog, plain, read_snapshot, write_snapshot
 
 log = logging.getLogger()
 
-class InMemoryDataStore(Delegate):
+_OPERATORS = {
+    LT: operator.lt,
+    LTE: operator.le,
+    EQ: operator.eq,
+    GTE: operator.ge,
+    GT: operator.gt,
+}
+
+# mutations, as they are queued in batches and written to the mutation log
+INSERT = 'i'
+REMOVE = 'r'
+CREATE_CF = 'c'
+CREATE_INDEX = 'x'
+DROP = 'd'
+ADD = 'a'
+
+# seconds covered by each slot of the expiry wheel
+EXPIRY_RESOLUTION = 1.0
+
+# str values up to this long are interned as they are stored, as they are mostly types, keys and flags which repeat
+# across many rows
+INTERN_LENGTH = 64
+
+SNAPSHOT_FILE = 'snapshot'
+LOG_FILE = 'mutations.log'
+
+
+class ReadWriteLock(object):
+    """
+    Allows many readers or a single writer.  Waiting writers hold back new readers so that they aren't starved, but a
+    thread which already holds the lock, for reading or writing, can always take it again for reading.
+    """
+
     def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = {}
+        self._writer = None
+        self._writer_count = 0
+        self._waiting_writers = 0
+
+    def acquire_read(self):
+        me = get_ident()
+        with self._condition:
+            if self._writer != me and me not in self._readers:
+                while self._writer is not None or self._waiting_writers:
+                    self._condition.wait()
+            self._readers[me] = self._readers.get(me, 0) + 1
+
+    def release_read(self):
+        me = get_ident()
+        with self._condition:
+            self._readers[me] -= 1
+            if not self._readers[me]:
+                del(self._readers[me])
+                self._condition.notify_all()
+
+    def acquire_write(self):
+        me = get_ident()
+        with self._condition:
+            if self._writer == me:
+                self._writer_count += 1
+                return
+            if me in self._readers:
+                raise RuntimeError("Can't upgrade a read lock to a write lock")
+            self._waiting_writers += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._condition.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = me
+            self._writer_count = 1
+
+    def release_write(self):
+        with self._condition:
+            self._writer_count -= 1
+            if not self._writer_count:
+                self._writer = None
+                self._condition.notify_all()
+
+    @contextmanager
+    def reading(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def writing(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+class MutationBatch(object):
+    """
+    The mutations queued by a batch, grouped by (column family, row).  Consecutive inserts into the same row are
+    merged into a single insert as they are queued, so each row is only touched once for every run of inserts when
+    the batch is applied.  Removals keep their place relative to the inserts of their row.
+    """
+
+    def __init__(self):
+        self.rows = OrderedDict()
+
+    def __len__(self):
+        return sum(len(mutations) for mutations in self.rows.itervalues())
+
+    def insert(self, cf_name, row, columns, deadline=None):
+        mutations = self.rows.setdefault((cf_name, row), [])
+        if mutations and mutations[-1][0] == INSERT and mutations[-1][4] == deadline:
+            merged = mutations[-1][3]
+            for name, value in columns.iteritems():
+                if isinstance(value, dict) and isinstance(merged.get(name), dict):
+                    # the queued super column may still be the caller's dict, so merge into a copy
+                    super_column = dict(merged[name])
+                    super_column.update(value)
+                    merged[name] = super_column
+                else:
+                    merged[name] = value
+        else:
+            # copied, because the same columns are often inserted into several rows
+            mutations.append((INSERT, cf_name, row, dict(columns), deadline))
+
+    def remove(self, cf_name, row, columns=None, super_column=None):
+        self.rows.setdefault((cf_name, row), []).append((REMOVE, cf_name, row, columns, super_column))
+
+    def add(self, cf_name, row, column, value):
+        # additions commute, so one is merged into any addition to the same column since the row's last other
+        # mutation
+        mutations = self.rows.setdefault((cf_name, row), [])
+        for i in xrange(len(mutations) - 1, -1, -1):
+            if mutations[i][0] != ADD:
+                break
+            if mutations[i][3] == column:
+                mutations[i] = (ADD, cf_name, row, column, mutations[i][4] + value)
+                return
+        mutations.append((ADD, cf_name, row, column, value))
+
+    def mutations(self):
+        return [mutation for mutations in self.rows.itervalues() for mutation in mutations]
+
+
+class InMemoryDataStore(Delegate):
+    """
+    Keeps the whole graph in memory.  If data_dir is given, every committed mutation is also appended to a log in
+    that directory and a snapshot of the tables is written every checkpoint_interval mutations, so the graph can be
+    restored on startup from the snapshot and the tail of the log.
+
+    The data store can be shared between threads.  Batches are kept per thread, and the tables are guarded by a
+    reader/writer lock, so reads run concurrently while each batch is applied atomically.
+
+    Column names and short values are interned, and super columns are stored as immutable CompactColumns, shared
+    between every row which holds the same columns.  In particular each relationship's columns are only kept once
+    for its outbound and inbound rows.
+
+    If compaction_interval is given, a background thread compacts the tables every compaction_interval seconds.
+
+    Columns inserted with a ttl are hidden from reads as soon as they expire, and removed by a sweep of each column
+    family's expiry wheel, which runs at most once every EXPIRY_RESOLUTION seconds from the write path and on every
+    compaction.
+
+    open_snapshot returns a read-only, point-in-time view of the tables.  Views don't hold any lock between reads:
+    instead, the first write to a row while views are open copies the row as it was for every view which hasn't
+    seen it change yet, and the copies are dropped when the last of those views is released.
+    """
+
+    def __init__(self, data_dir=None, checkpoint_interval=100000, fsync=False, compaction_interval=None):
         super(InMemoryDataStore,self).__init__()
         self.tables = OrderedDict()
-        self.transactions = []
-        self.batch_count = 0
-        self.in_batch = False
+        self.lock = ReadWriteLock()
+        self.pool = ColumnPool()
+        self._local = threading.local()
+        self._checkpoint_lock = threading.Lock()
+        self.data_dir = data_dir
+        self.checkpoint_interval = checkpoint_interval
+        self._mutation_log = None
+        self._seq = 0
+        self._mutations_since_checkpoint = 0
+        self._next_expiry = 0
+        self._expiring = False
+        # open snapshots, oldest first, and the number of commits so far, which tells when a new one is needed
+        self._epochs = []
+        self._epoch_lock = threading.Lock()
+        self._version = 0
+        if data_dir is not None:
+            self._recover(fsync)
+        self._compactor = None
+        if compaction_interval is not None:
+            self._compactor = Compactor(self, compaction_interval)
+            self._compactor.start()
+
+    @property
+    def transactions(self):
+        try:
+            return self._local.transactions
+        except AttributeError:
+            self._local.transactions = MutationBatch()
+            return self._local.transactions
+
+    @property
+    def batch_count(self):
+        return getattr(self._local, 'batch_count', 0)
+
+    @property
+    def in_batch(self):
+        return self.batch_count > 0
 
     def create(self):
         # Since data store is in memory, nothing needs to be done
         pass
 
     def drop(self):
-        self.tables = OrderedDict()
+        self._commit([(DROP,)])
 
     def truncate(self):
         self.drop()
@@ -31,170 +243,975 @@ class InMemoryDataStore(Delegate):
                                            column_finish=column_finish, super_column=super_column)
 
     def get_cf(self, cf_name):
-        if not cf_name in self.tables:
-            self.tables[cf_name] = self.create_cf(cf_name)
-        return self.tables[cf_name]
+        try:
+            return self.tables[cf_name]
+        except KeyError:
+            with self.lock.writing():
+                if not cf_name in self.tables:
+                    self.create_cf(cf_name)
+                return self.tables[cf_name]
 
-    def create_cf(self, type, column_type=ASCII, super=False, index_columns=list()):
-        self.tables[type] = ColumnFamily(type, column_type)
-        return self.tables[type]
+    def create_cf(self, type, column_type=ASCII, super=False, index_columns=list(), value_type=None):
+        with self.lock.writing():
+            self._commit([(CREATE_CF, type, column_type, list(index_columns))])
+            return self.tables[type]
     
     def create_secondary_index(self, type, column, column_type=None):
-        # DO NOTHING, for now we just do complete scans since memory is "fast enough"
-        pass
+        self.get_cf(type)
+        self._commit([(CREATE_INDEX, type, column)])
 
     def cf_exists(self, type):
-        return type in self.tables.keys()
+        return type in self.tables
 
-    def insert(self, cf, row, columns):
-        def execute():
-            cf.insert(row, columns)
+    def scan(self, type, partitions=1):
+        """
+        Splits the rows of a column family into partitions, to be read concurrently.  Rows removed while they are
+        read are skipped.
+        """
+        if not self.cf_exists(type):
+            return []
+        return self.get_cf(type).partitions(partitions)
 
+    def insert(self, cf, row, columns, ttl=None):
+        deadline = time.time() + ttl if ttl is not None else None
         if self.in_batch:
-            self.transactions.append(execute)
+            self.transactions.insert(cf.name, row, columns, deadline)
         else:
-            execute()
+            self._commit([(INSERT, cf.name, row, columns, deadline)])
 
     def remove(self, cf, row, columns=None, super_column=None):
-        def execute():
-            cf.remove(row, columns=columns, super_column=super_column)
-            
         if self.in_batch:
-            self.transactions.append(execute)
+            self.transactions.remove(cf.name, row, columns, super_column)
         else:
-            execute()
+            self._commit([(REMOVE, cf.name, row, columns, super_column)])
 
-    def start_batch(self, queue_size = 0):
-        self.in_batch = True
-        self.batch_count += 1
+    def add(self, cf, row, column, value=1):
+        """
+        Adds value to a counter column, which starts at 0.
+        """
+        if self.in_batch:
+            self.transactions.add(cf.name, row, column, value)
+        else:
+            self._commit([(ADD, cf.name, row, column, value)])
+
+    def start_batch(self, queue_size = 0, background=False):
+        self._local.batch_count = self.batch_count + 1
 
     def commit_batch(self):
-        self.batch_count -= 1
-        if not self.batch_count:
-            for item in self.transactions:
-                item()
-            self.transactions = []
-            self.in_batch = False
+        self._local.batch_count = self.batch_count - 1
+        if not self._local.batch_count:
+            transactions = self.transactions
+            self._local.transactions = MutationBatch()
+            self._commit(transactions.mutations())
+
+    def checkpoint(self):
+        """
+        Writes a snapshot of all tables and starts a new, empty mutation log.
+        """
+        if self._mutation_log is None:
+            return
+        # the read lock holds off writers, so the snapshot matches the log, but lets readers carry on
+        with self._checkpoint_lock:
+            with self.lock.reading():
+                write_snapshot(os.path.join(self.data_dir, SNAPSHOT_FILE), self._seq, self._snapshot_records())
+                self._mutation_log.reset()
+                self._mutations_since_checkpoint = 0
+
+    def compact(self):
+        self.expire()
+        for cf in self.tables.values():
+            cf.compact()
+
+    def expire(self):
+        """
+        Removes every expired column.  The removals go through the mutation log like any other, so that a column
+        which is written again after it expired is restored correctly.
+        """
+        with self.lock.writing():
+            if self._expiring:
+                return
+            self._expiring = True
+            try:
+                now = time.time()
+                self._next_expiry = now + EXPIRY_RESOLUTION
+                self._commit([
+                    (REMOVE, cf.name, row, [column], None)
+                    for cf in self.tables.values()
+                    for row, column in cf.pop_expired(now)
+                ])
+            finally:
+                self._expiring = False
+
+    def open_snapshot(self):
+        # the read lock keeps writers out, so the snapshot never sees half a batch
+        with self.lock.reading():
+            with self._epoch_lock:
+                if self._epochs and self._epochs[-1].version == self._version:
+                    epoch = self._epochs[-1]
+                else:
+                    epoch = Epoch(OrderedDict(self.tables), self._version)
+                    self._epochs.append(epoch)
+                epoch.readers += 1
+        return SnapshotView(self, epoch)
+
+    def release_snapshot(self, epoch):
+        with self.lock.reading():
+            with self._epoch_lock:
+                epoch.readers -= 1
+                if not epoch.readers:
+                    self._epochs.remove(epoch)
+
+    def close(self):
+        if self._compactor is not None:
+            self._compactor.stop()
+            self._compactor = None
+        if self._mutation_log is not None:
+            self._mutation_log.close()
+            self._mutation_log = None
+
+    def _commit(self, mutations):
+        """
+        Logs the mutations as a single record, so a batch is replayed all or nothing, and then applies them.
+        """
+        if not mutations:
+            return
+        with self.lock.writing():
+            self._version += 1
+            if self._mutation_log is not None:
+                self._seq += 1
+                self._mutation_log.append(self._seq, mutations)
+                self._mutations_since_checkpoint += len(mutations)
+            for mutation in mutations:
+                self._apply(mutation)
+        if self._mutation_log is not None and self._mutations_since_checkpoint >= self.checkpoint_interval:
+            self.checkpoint()
+        if time.time() >= self._next_expiry:
+            self.expire()
+
+    def _apply(self, mutation):
+        kind = mutation[0]
+        if self._epochs and (kind == INSERT or kind == REMOVE or kind == ADD):
+            self._preserve(self.tables[mutation[1]], mutation[2])
+        if kind == INSERT:
+            self.tables[mutation[1]].insert(mutation[2], mutation[3], deadline=mutation[4])
+        elif kind == REMOVE:
+            self.tables[mutation[1]].remove(mutation[2], columns=mutation[3], super_column=mutation[4])
+        elif kind == ADD:
+            self.tables[mutation[1]].add(mutation[2], mutation[3], mutation[4])
+        elif kind == CREATE_CF:
+            self.tables[mutation[1]] = ColumnFamily(mutation[1], mutation[2], lock=self.lock, pool=self.pool)
+            for column in mutation[3]:
+                self.tables[mutation[1]].create_index(column)
+        elif kind == CREATE_INDEX:
+            self.tables[mutation[1]].create_index(mutation[2])
+        elif kind == DROP:
+            self.tables = OrderedDict()
+            self.pool = ColumnPool()
+
+    def _preserve(self, cf, row):
+        """
+        Copies the row, as it is before it is first changed, into every open snapshot which doesn't have it yet.
+        Rows which haven't changed since a snapshot was opened are still current for it, so one copy serves all
+        of them.
+        """
+        epochs = [epoch for epoch in self._epochs if (cf, row) not in epoch.preserved]
+        if not epochs:
+            return
+        row_data, deadlines = cf._row(row)
+        if row_data is not None:
+            row_data = SortedColumns(
+                (name, value.copy() if isinstance(value, dict) else value) for name, value in row_data.iteritems())
+        if deadlines is not None:
+            deadlines = deadlines.copy()
+        for epoch in epochs:
+            epoch.preserve(cf, row, row_data, deadlines)
+
+    def _snapshot_records(self):
+        for name, cf in self.tables.items():
+            yield (CREATE_CF, name, cf.sort, [])
+            for row, columns in cf.data.iteritems():
+                deadlines = cf.deadlines.get(row)
+                if not deadlines:
+                    yield (INSERT, name, row, plain(columns), None)
+                    continue
+                by_deadline = {}
+                for column, value in columns.iteritems():
+                    by_deadline.setdefault(deadlines.get(column), {})[column] = plain(value)
+                for deadline, expiring_columns in by_deadline.iteritems():
+                    yield (INSERT, name, row, expiring_columns, deadline)
+            for column in cf.indexes:
+                yield (CREATE_INDEX, name, column)
+
+    def _recover(self, fsync):
+        if not os.path.isdir(self.data_dir):
+            os.makedirs(self.data_dir)
+        self._seq, records = read_snapshot(os.path.join(self.data_dir, SNAPSHOT_FILE))
+        for mutation in records:
+            self._apply(mutation)
+        self._mutation_log = MutationLog(os.path.join(self.data_dir, LOG_FILE), fsync=fsync)
+        for seq, mutations in self._mutation_log.read():
+            if seq <= self._seq:
+                continue
+            for mutation in mutations:
+                self._apply(mutation)
+            self._seq = seq
+            self._mutations_since_checkpoint += len(mutations)
+        log.info("Restored %d tables from %s" % (len(self.tables), self.data_dir))
+
+
+class Compactor(threading.Thread):
+    """
+    Compacts the tables of a data store in the background, until it is stopped.
+    """
+
+    def __init__(self, data_store, interval):
+        super(Compactor, self).__init__(name='agamemnon-compactor')
+        self.daemon = True
+        self.data_store = data_store
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while True:
+            self._stopped.wait(self.interval)
+            if self._stopped.is_set():
+                return
+            try:
+                self.data_store.compact()
+            except Exception:
+                log.exception("Compaction failed")
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def _get_columns(row_data, super_column=None):
+    if row_data is None:
+        raise KeyError
+    if super_column is None:
+        return row_data
+    return row_data[super_column]
+
+
+def _expired_columns(deadlines, now=None):
+    if not deadlines:
+        return ()
+    if now is None:
+        now = time.time()
+    return deadlines.expired(now)
+
+
+def _intern(value):
+    if type(value) is str and len(value) <= INTERN_LENGTH:
+        return intern(value)
+    return value
+
+
+def _detach(value):
+    # results are handed out after the read lock is released, so they mustn't share dicts with the tables
+    if isinstance(value, (dict, CompactColumns)):
+        return OrderedDict(value.iteritems())
+    return value
+
+
+class SortedColumns(dict):
+    """
+    A dict which keeps its column names in comparator order, so that slices can be located with a bisect instead of
+    sorting the whole row on every read.  Iteration always happens in column order, just like a cassandra row.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(SortedColumns, self).__init__()
+        self._keys = []
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, key, value):
+        if not dict.__contains__(self, key):
+            insort(self._keys, key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        del(self._keys[bisect_left(self._keys, key)])
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __reduce__(self):
+        return self.__class__, (dict(self),)
+
+    def update(self, *args, **kwargs):
+        other = dict(*args, **kwargs)
+        new_keys = [key for key in other if not dict.__contains__(self, key)]
+        dict.update(self, other)
+        if len(new_keys) == 1:
+            insort(self._keys, new_keys[0])
+        elif new_keys:
+            self._keys.extend(new_keys)
+            self._keys.sort()
+
+    def clear(self):
+        dict.clear(self)
+        self._keys = []
+
+    def pop(self, key, *default):
+        if dict.__contains__(self, key):
+            value = self[key]
+            del(self[key])
+            return value
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        if not self._keys:
+            raise KeyError('popitem(): dictionary is empty')
+        key = self._keys[-1]
+        return key, self.pop(key)
+
+    def setdefault(self, key, default=None):
+        if not dict.__contains__(self, key):
+            self[key] = default
+        return self[key]
+
+    def copy(self):
+        return self.__class__(self)
+
+    def keys(self):
+        return list(self._keys)
+
+    def iterkeys(self):
+        return iter(self._keys)
+
+    def values(self):
+        return [self[key] for key in self._keys]
+
+    def itervalues(self):
+        for key in self._keys:
+            yield self[key]
+
+    def items(self):
+        return [(key, self[key]) for key in self._keys]
+
+    def iteritems(self):
+        for key in self._keys:
+            yield key, self[key]
+
+    def column_range(self, column_start=None, column_finish=None):
+        """
+        Returns the (start, stop) positions in the sorted column names covering column_start to column_finish,
+        both inclusive.  Empty bounds are open, as they are in cassandra.
+        """
+        start = bisect_left(self._keys, column_start) if column_start else 0
+        stop = bisect_right(self._keys, column_finish) if column_finish else len(self._keys)
+        return start, max(start, stop)
+
+    def column_slice(self, column_start=None, column_finish=None):
+        keys = self._keys
+        start, stop = self.column_range(column_start, column_finish)
+        for i in xrange(start, stop):
+            yield keys[i]
+
+
+class Deadlines(dict):
+    """
+    The deadlines of a row's expiring columns, by column name, which also keeps them in deadline order, so that
+    the columns which have expired but haven't been swept yet are found without looking at those which haven't.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(Deadlines, self).__init__(*args, **kwargs)
+        self._order = sorted((deadline, column) for column, deadline in self.iteritems())
+
+    def __setitem__(self, column, deadline):
+        if dict.__contains__(self, column):
+            self._discard(column)
+        dict.__setitem__(self, column, deadline)
+        insort(self._order, (deadline, column))
+
+    def __delitem__(self, column):
+        self._discard(column)
+        dict.__delitem__(self, column)
+
+    def _discard(self, column):
+        del(self._order[bisect_left(self._order, (self[column], column))])
+
+    def expired(self, now):
+        expired = set()
+        for deadline, column in self._order:
+            if deadline > now:
+                break
+            expired.add(column)
+        return expired
+
+    def copy(self):
+        return self.__class__(self)
+
+
+class CompactColumns(object):
+    """
+    An immutable super column: a tuple of column names, in comparator order, and a tuple of their values.  Name
+    tuples are shared by every super column with the same names, and whole CompactColumns by every row which holds
+    the same columns, through a ColumnPool.  It reads like a SortedColumns; changes build a new one.
+    """
+    __slots__ = ('names', 'values', '__weakref__')
+
+    def __init__(self, names, values):
+        self.names = names
+        self.values = values
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __contains__(self, key):
+        position = bisect_left(self.names, key)
+        return position < len(self.names) and self.names[position] == key
+
+    def __getitem__(self, key):
+        position = bisect_left(self.names, key)
+        if position < len(self.names) and self.names[position] == key:
+            return self.values[position]
+        raise KeyError(key)
+
+    def __reduce__(self):
+        return self.__class__, (self.names, self.values)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def copy(self):
+        return self
+
+    def keys(self):
+        return list(self.names)
+
+    def iterkeys(self):
+        return iter(self.names)
+
+    def itervalues(self):
+        return iter(self.values)
+
+    def iteritems(self):
+        return iter(zip(self.names, self.values))
+
+    def items(self):
+        return zip(self.names, self.values)
+
+    def column_range(self, column_start=None, column_finish=None):
+        start = bisect_left(self.names, column_start) if column_start else 0
+        stop = bisect_right(self.names, column_finish) if column_finish else len(self.names)
+        return start, max(start, stop)
+
+    def column_slice(self, column_start=None, column_finish=None):
+        start, stop = self.column_range(column_start, column_finish)
+        return iter(self.names[start:stop])
+
+
+Mapping.register(CompactColumns)
+
+
+class ColumnPool(object):
+    """
+    Hands out a single CompactColumns for equal super columns, for as long as any row holds it, and a single tuple
+    for equal sets of column names.
+    """
+
+    def __init__(self):
+        self.names = {}
+        self.columns = weakref.WeakValueDictionary()
+
+    def compact(self, columns):
+        items = sorted((intern(name) if type(name) is str else name, _intern(value))
+                       for name, value in columns.iteritems())
+        names = tuple(name for name, value in items)
+        names = self.names.setdefault(names, names)
+        values = tuple(value for name, value in items)
+        key = (names, values)
+        try:
+            compact = self.columns.get(key)
+        except TypeError:
+            # unhashable values can't be shared
+            return CompactColumns(names, values)
+        if compact is None:
+            compact = self.columns[key] = CompactColumns(names, values)
+        return compact
+
+
+class ColumnIndex(object):
+    """
+    A secondary index over a single column.  Row keys are hashed by value for EQ lookups, and also kept in a list
+    sorted by value, so that LT/LTE/GT/GTE lookups and their sizes are answered with a bisect.
+    """
+
+    def __init__(self, column):
+        self.column = column
+        self.rows = {}
+        self.sorted_values = []
+        self.sorted_rows = []
+
+    def add(self, value, row):
+        rows = self.rows.setdefault(value, set())
+        if row in rows:
+            return
+        rows.add(row)
+        position = bisect_right(self.sorted_values, value)
+        self.sorted_values.insert(position, value)
+        self.sorted_rows.insert(position, row)
+
+    def discard(self, value, row):
+        rows = self.rows.get(value)
+        if rows is None or row not in rows:
+            return
+        rows.remove(row)
+        if not rows:
+            del(self.rows[value])
+        start = bisect_left(self.sorted_values, value)
+        stop = bisect_right(self.sorted_values, value)
+        position = self.sorted_rows.index(row, start, stop)
+        del(self.sorted_values[position])
+        del(self.sorted_rows[position])
+
+    def _range(self, op, value):
+        values = self.sorted_values
+        if op == LT:
+            return 0, bisect_left(values, value)
+        if op == LTE:
+            return 0, bisect_right(values, value)
+        if op == GT:
+            return bisect_right(values, value), len(values)
+        return bisect_left(values, value), len(values)
+
+    def count(self, op, value):
+        if op == EQ:
+            return len(self.rows.get(value, ()))
+        start, stop = self._range(op, value)
+        return stop - start
+
+    def lookup(self, op, value):
+        if op == EQ:
+            return list(self.rows.get(value, ()))
+        start, stop = self._range(op, value)
+        return self.sorted_rows[start:stop]
 
 
 class ColumnFamily(object):
-    def __init__(self, name, sort, super=False):
+    """
+    Reads take the read side of the lock.  insert and remove don't lock; the data store applies them while holding
+    the write side.
+    """
+
+    def __init__(self, name, sort, super=False, lock=None, pool=None):
         self.data = OrderedDict()
         self.sort = sort
         self.name = name
         self.super = super
+        self.indexes = {}
+        self.lock = lock if lock is not None else ReadWriteLock()
+        self.pool = pool if pool is not None else ColumnPool()
+        # rows which have lost columns, and the number of rows dropped, since the last compaction
+        self._churned = set()
+        self._dropped_rows = 0
+        # row -> Deadlines for every column which expires, and a hashed timing wheel of the same (row, column)
+        # pairs, bucketed by deadline, for pop_expired to sweep
+        self.deadlines = {}
+        self._wheel = {}
+
+    def create_index(self, column):
+        column_index = ColumnIndex(column)
+        for row, row_data in self.data.iteritems():
+            if column in row_data:
+                column_index.add(row_data[column], row)
+        self.indexes[column] = column_index
+
+    def _index_columns(self, row, row_data, columns):
+        for column in columns:
+            if column in self.indexes and column in row_data:
+                self.indexes[column].add(row_data[column], row)
+
+    def _unindex_columns(self, row, row_data, columns):
+        for column in columns:
+            if column in self.indexes and column in row_data:
+                self.indexes[column].discard(row_data[column], row)
+
+    def _row(self, row):
+        """
+        Returns the columns of the row, or None if it doesn't exist, along with their deadlines.
+        """
+        return self.data.get(row), self.deadlines.get(row)
+
+    def _row_keys(self):
+        return self.data.keys()
+
+    def pop_expired(self, now):
+        """
+        Sweeps the wheel up to now and returns the (row, column) pairs which have expired.  Entries which were
+        given a later deadline since they were bucketed are dropped, as they are also in a later bucket.
+        """
+        expired = []
+        current = int(now // EXPIRY_RESOLUTION)
+        for bucket in [bucket for bucket in self._wheel if bucket <= current]:
+            for row, column in self._wheel.pop(bucket):
+                deadline = self.deadlines.get(row, {}).get(column)
+                if deadline is not None and deadline <= now:
+                    expired.append((row, column))
+                elif deadline is not None and int(deadline // EXPIRY_RESOLUTION) <= current:
+                    self._wheel.setdefault(current + 1, set()).add((row, column))
+        return expired
 
     def get_count(self, row, columns=None, column_start=None, super_column=None, column_finish=None):
-        count = float("inf")
-        results = self.get(row, columns, column_start, super_column, column_finish, count)
-        return len(results)
+        with self.lock.reading():
+            row_data, deadlines = self._row(row)
+            try:
+                data_columns = _get_columns(row_data, super_column)
+            except KeyError:
+                raise NotFoundException
+            expired = _expired_columns(deadlines)
+            if super_column is not None:
+                if super_column in expired:
+                    raise NotFoundException
+                expired = ()
+            if columns is not None:
+                count = sum(1 for c in columns if c in data_columns and c not in expired)
+            else:
+                start, stop = data_columns.column_range(column_start, column_finish)
+                count = stop - start
+                for c in expired:
+                    if (not column_start or c >= column_start) and (not column_finish or c <= column_finish):
+                        count -= 1
+        if not count:
+            raise NotFoundException
+        return count
+
+    def partitions(self, count):
+        with self.lock.reading():
+            rows = self._row_keys()
+        size = max(1, -(-len(rows) // max(1, count)))
+        return [self._scan(rows[start:start + size]) for start in xrange(0, len(rows), size)]
+
+    def _scan(self, rows):
+        for row in rows:
+            try:
+                yield row, self.get(row)
+            except NotFoundException:
+                continue
 
     def multiget(self, row_keys, **kwargs):
-        return OrderedDict([
-            (row, self.get(row, **kwargs))
-            for row in row_keys
-        ])
-        
+        """
+        Like pycassa, leaves out the rows which aren't found.
+        """
+        results = OrderedDict()
+        with self.lock.reading():
+            for row in row_keys:
+                try:
+                    results[row] = self.get(row, **kwargs)
+                except NotFoundException:
+                    pass
+        return results
+
     def get(self, row, columns=None, column_start=None, super_column=None, column_finish=None, column_count=100):
+        with self.lock.reading():
+            return self._get(row, columns, column_start, super_column, column_finish, column_count)
+
+    def _get(self, row, columns, column_start, super_column, column_finish, column_count):
+        row_data, deadlines = self._row(row)
         try:
-            if super_column is None:
-                data_columns = self.data[row]
-            else:
-                data_columns = self.data[row][super_column]
+            data_columns = _get_columns(row_data, super_column)
+            expired = _expired_columns(deadlines)
+            if super_column is not None:
+                if super_column in expired:
+                    raise NotFoundException
+                expired = ()
             results = OrderedDict()
-            count = 0
             if columns is not None:
                 for c in columns:
-                    results[c] = data_columns[c]
+                    if c in data_columns and c not in expired:
+                        results[c] = _detach(data_columns[c])
             else:
-                for c in sorted(data_columns.keys()):
-                    if count > column_count:
+                for c in data_columns.column_slice(column_start, column_finish):
+                    if len(results) >= column_count:
                         break
-                    if column_start and cmp(c,column_start) < 0:
-                        continue
-                    if column_finish and cmp(c, column_finish) > 0:
-                        break
-
-                    results[c] = data_columns[c]
-                    count += 1
+                    if c not in expired:
+                        results[c] = _detach(data_columns[c])
             if not len(results):
                 raise NotFoundException
-            for key, value in results.items():
-                if isinstance(value, dict) and len(value) == 0:
-                    del(results[key])
-                if value is None:
-                    del(results[key])
             return results
         except KeyError:
             raise NotFoundException
 
-    def insert(self, row, columns, ttl=None):
-        if not row in self.data:
-            self.data[row] = OrderedDict()
+    def insert(self, row, columns, ttl=None, deadline=None):
+        """
+        Columns inserted with a ttl, or an absolute deadline, expire as a unit even if they are super columns.  A
+        column keeps its deadline when it is written again without one.
+        """
+        if ttl is not None:
+            deadline = time.time() + ttl
         if self.sort == ASCII:
-            sorted_columns = sorted(columns.iteritems(), key=operator.itemgetter(0))
-            for column in sorted_columns:
-                if column[0] not in self.data[row] or not isinstance(column[1], dict):
-                    self.data[row][column[0]] = column[1]
+            row = _intern(row)
+            row_data = self.data.get(row)
+            if row_data is None:
+                row_data = SortedColumns()
+            if self.indexes:
+                self._unindex_columns(row, row_data, columns)
+            for name, value in columns.iteritems():
+                if type(name) is str:
+                    name = intern(name)
+                if not isinstance(value, dict):
+                    row_data[name] = _intern(value)
+                elif name not in row_data:
+                    if len(value):
+                        row_data[name] = self.pool.compact(value)
                 else:
-                    self.data[row][column[0]].update(column[1])
+                    merged = dict(row_data[name].iteritems())
+                    merged.update(value)
+                    row_data[name] = self.pool.compact(merged)
+            if self.indexes:
+                self._index_columns(row, row_data, columns)
+            if len(row_data) and row not in self.data:
+                self.data[row] = row_data
+            if deadline is not None and row in self.data:
+                deadlines = self.deadlines.get(row)
+                if deadlines is None:
+                    deadlines = self.deadlines[row] = Deadlines()
+                bucket = self._wheel.setdefault(int(deadline // EXPIRY_RESOLUTION), set())
+                for name in columns:
+                    if name in row_data:
+                        deadlines[name] = deadline
+                        bucket.add((row, name))
 
-                #        if ttl is not None:
-                #            def delete():
-                #                for c in columns.keys():
-                #                    del(self.data[row][c])
-                #            Timer(ttl, delete, ()).start()
+    def add(self, row, column, value):
+        row = _intern(row)
+        row_data = self.data.get(row)
+        if row_data is None:
+            row_data = self.data[row] = SortedColumns()
+        row_data[intern(column) if type(column) is str else column] = row_data.get(column, 0) + value
 
     def remove(self, row, columns=None, super_column=None):
-        try:
-            if columns is None and super_column is None:
-                row_data = self.data[row]
-                for key, value in row_data.items():
-                    if isinstance(value, OrderedDict):
-                        value.clear()
-                    else:
-                        del(row_data[key])
-            elif columns is not None and super_column is None:
-                row_data = self.data[row]
+        """
+        Removed columns, super columns and rows are deleted outright, rather than left behind empty, so that the
+        sorted column names only ever hold live columns and counts can be read off their positions.  As in
+        cassandra, removing something which doesn't exist is not an error.
+        """
+        row_data = self.data.get(row)
+        if row_data is None:
+            return
+        if super_column is None:
+            if self.indexes:
+                self._unindex_columns(row, row_data, row_data.keys() if columns is None else columns)
+            if columns is None:
+                row_data.clear()
+            else:
                 for c in columns:
                     if c in row_data:
-                        value = row_data[c]
-                        if isinstance(value, OrderedDict):
-                            value.clear()
-                        else:
-                            del(row_data[c])
-            elif columns is None and super_column is not None:
-                for key, value in self.data[row][super_column].items():
-                    if isinstance(value, dict):
-                        value.clear()
-                    else:
-                        del(self.data[row][super_column][key])
+                        del(row_data[c])
+        elif super_column in row_data:
+            sc = row_data[super_column]
+            if columns is not None:
+                removed = set(columns)
+                sc = dict((c, v) for c, v in sc.iteritems() if c not in removed)
+            if columns is None or not sc:
+                del(row_data[super_column])
             else:
-                sc = self.data[row][super_column]
-                for c in columns:
-                    if c in sc:
-                        del(sc[c])
-        except KeyError:
-            raise NotFoundException
+                row_data[super_column] = self.pool.compact(sc)
+        deadlines = self.deadlines.get(row)
+        if deadlines:
+            if super_column is not None:
+                removed = [super_column]
+            else:
+                removed = deadlines.keys() if columns is None else columns
+            for c in removed:
+                if c in deadlines and c not in row_data:
+                    del(deadlines[c])
+            if not deadlines:
+                del(self.deadlines[row])
+        if len(row_data):
+            self._churned.add(row)
+        else:
+            del(self.data[row])
+            self._churned.discard(row)
+            self._dropped_rows += 1
+
+    def compact(self, rows_per_lock=1000):
+        """
+        Python dicts and lists never give memory back as items are deleted, so rows which have lost columns are
+        rebuilt at their current size, and so is the row dict once as many rows have been dropped as remain.  The
+        write lock is only held for rows_per_lock rows at a time.
+        """
+        with self.lock.writing():
+            churned = list(self._churned)
+            self._churned = set()
+        for start in xrange(0, len(churned), rows_per_lock):
+            with self.lock.writing():
+                for row in churned[start:start + rows_per_lock]:
+                    row_data = self.data.get(row)
+                    if row_data is not None:
+                        self.data[row] = row_data.copy()
+        with self.lock.writing():
+            if self._dropped_rows > len(self.data):
+                self.data = OrderedDict(self.data.iteritems())
+                self._dropped_rows = 0
 
     def get_indexed_slices(self, index_clause):
-        for i in self.data.items():
-            for expression in index_clause.expressions:
-                if expression.column_name not in i[1]:
+        with self.lock.reading():
+            return list(self._get_indexed_slices(index_clause))
+
+    def _get_indexed_slices(self, index_clause):
+        """
+        Looks up candidate rows through the index of the most selective indexed expression and checks the
+        expressions against those rows only.  Without any indexed expression every row is scanned.
+        """
+        expressions = list(index_clause.expressions)
+        candidates = None
+        best = None
+        for expression in expressions:
+            column_index = self.indexes.get(expression.column_name)
+            if column_index is None:
+                continue
+            count = column_index.count(expression.op, expression.value)
+            if best is None or count < best[0]:
+                best = (count, expression, column_index)
+        if best is not None:
+            count, expression, column_index = best
+            candidates = self._candidates(column_index, expression)
+        else:
+            candidates = self._row_keys()
+
+        found = 0
+        now = time.time()
+        for row in candidates:
+            if found >= index_clause.count:
+                return
+            row_data, deadlines = self._row(row)
+            if row_data is None:
+                continue
+            if deadlines:
+                expired = _expired_columns(deadlines, now)
+                row_data = OrderedDict((c, v) for c, v in row_data.iteritems() if c not in expired)
+            for expression in expressions:
+                if expression.column_name not in row_data:
                     break
-                value = i[1][expression.column_name]
-                comp = {
-                    LT: value.__lt__,
-                    LTE: value.__le__,
-                    EQ: value.__eq__,
-                    GTE: value.__ge__,
-                    GT: value.__gt__,
-                }[expression.op]
-
-                if not comp(expression.value):
-                    # break out of the expression loop and try next data item
+                if not _OPERATORS[expression.op](row_data[expression.column_name], expression.value):
                     break
             else:
                 # passed all expressions, this one is good
-                yield i[0], i[1]
-  
+                found += 1
+                yield row, _detach(row_data)
+
+    def _candidates(self, column_index, expression):
+        return column_index.lookup(expression.op, expression.value)
+
+
+class Epoch(object):
+    """
+    The state shared by the snapshots opened between two commits: the tables as they were, and the pre-images of
+    the rows which have been written since.
+    """
+
+    def __init__(self, tables, version):
+        self.tables = tables
+        self.version = version
+        self.readers = 0
+        self.preserved = {}
+        self.preserved_rows = {}
+
+    def preserve(self, cf, row, row_data, deadlines):
+        self.preserved[(cf, row)] = (row_data, deadlines)
+        self.preserved_rows.setdefault(cf, set()).add(row)
+
+
+class SnapshotView(Delegate):
+    """
+    A read-only delegate over a snapshot of an InMemoryDataStore.  It has to be released once it is no longer
+    needed, so that the rows preserved for it can be reclaimed.
+    """
+
+    def __init__(self, data_store, epoch):
+        super(SnapshotView, self).__init__()
+        self.data_store = data_store
+        self.epoch = epoch
+        self._column_families = {}
+        self._released = False
+
+    def get_cf(self, cf_name):
+        cf = self._column_families.get(cf_name)
+        if cf is None:
+            live_cf = self.epoch.tables.get(cf_name)
+            if live_cf is None:
+                live_cf = ColumnFamily(cf_name, ASCII)
+            cf = self._column_families[cf_name] = SnapshotColumnFamily(live_cf, self.epoch)
+        return cf
+
+    def cf_exists(self, type):
+        return type in self.epoch.tables
+
+    def scan(self, type, partitions=1):
+        if not self.cf_exists(type):
+            return []
+        return self.get_cf(type).partitions(partitions)
+
+    def get_count(self, type, row, columns=None, column_start=None, super_column=None, column_finish=None):
+        return self.get_cf(type).get_count(row, columns=columns, column_start=column_start,
+                                           column_finish=column_finish, super_column=super_column)
+
+    def start_batch(self, queue_size=0, background=False):
+        pass
+
+    def commit_batch(self):
+        pass
+
+    def _read_only(self, *args, **kwargs):
+        raise ReadOnlyError("Snapshots can't be written to")
+
+    create = drop = truncate = create_cf = create_secondary_index = insert = remove = add = _read_only
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.data_store.release_snapshot(self.epoch)
+
+
+class SnapshotColumnFamily(ColumnFamily):
+    """
+    Reads a column family as it was when its snapshot was opened, from the rows preserved for the snapshot and
+    the live rows which haven't changed since.
+    """
+
+    def __init__(self, cf, epoch):
+        self.cf = cf
+        self.epoch = epoch
+        self.name = cf.name
+        self.sort = cf.sort
+        self.super = cf.super
+        self.lock = cf.lock
+        self.indexes = cf.indexes
+
+    def _row(self, row):
+        preserved = self.epoch.preserved.get((self.cf, row))
+        if preserved is not None:
+            return preserved
+        return self.cf._row(row)
+
+    def _row_keys(self):
+        keys = self.cf.data.keys()
+        preserved_rows = self.epoch.preserved_rows.get(self.cf)
+        if preserved_rows:
+            keys.extend(row for row in preserved_rows if row not in self.cf.data)
+        return keys
+
+    def _candidates(self, column_index, expression):
+        # rows changed since the snapshot may have been indexed under a different value, so they are checked too
+        candidates = column_index.lookup(expression.op, expression.value)
+        preserved_rows = self.epoch.preserved_rows.get(self.cf)
+        if preserved_rows:
+            candidates = set(candidates)
+            candidates.update(preserved_rows)
+        return candidates
+
+    def _read_only(self, *args, **kwargs):
+        raise ReadOnlyError("Snapshots can't be written to")
+
+    create_index = insert = remove = add = compact = pop_expired = _read_only
@@ -0,0 +1,168 @@
+"""
+On-disk storage for the in memory data store: an append-only log of committed mutations plus periodic snapshots.
+
+Both files are a sequence of length prefixed, marshalled records.  Snapshots are read through mmap and unmarshalled
+one record at a time as they are loaded back into the store, so loading a large graph does not also copy the whole
+file into a string, and the log is only replayed past the sequence number recorded in the snapshot.
+"""
+from collections import Mapping
+import marshal
+import mmap
+import os
+import struct
+import zlib
+import logging
+
+log = logging.getLogger(__name__)
+
+SNAPSHOT_MAGIC = 'AGSNAP01'
+SNAPSHOT_HEADER = struct.Struct('>8sQ')
+SNAPSHOT_RECORD = struct.Struct('>I')
+LOG_RECORD = struct.Struct('>II')
+
+
+def plain(value):
+    """
+    Converts OrderedDicts, dict subclasses and other mappings into plain dicts so that they can be marshalled.
+    """
+    if isinstance(value, Mapping):
+        return dict((key, plain(column)) for key, column in value.iteritems())
+    return value
+
+
+def _map_file(f):
+    if not os.fstat(f.fileno()).st_size:
+        return None
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _replace(temp_path, path):
+    """
+    Moves temp_path over path and syncs the directory, so the rename itself survives a crash.
+    """
+    os.rename(temp_path, path)
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_snapshot(path, seq, records):
+    """
+    Writes the records to a temporary file and moves it over path once it is complete, so a crash never leaves a
+    partial snapshot behind.
+    """
+    temp_path = '%s.tmp' % path
+    with open(temp_path, 'wb') as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, seq))
+        for record in records:
+            data = marshal.dumps(record)
+            f.write(SNAPSHOT_RECORD.pack(len(data)))
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    _replace(temp_path, path)
+
+
+def read_snapshot(path):
+    """
+    Returns the sequence number of the last logged mutation included in the snapshot and an iterator over its
+    records.  A missing snapshot is the same as an empty one.
+    """
+    if not os.path.exists(path):
+        return 0, iter([])
+    f = open(path, 'rb')
+    data = _map_file(f)
+    if data is None:
+        f.close()
+        return 0, iter([])
+    magic, seq = SNAPSHOT_HEADER.unpack_from(data, 0)
+    if magic != SNAPSHOT_MAGIC:
+        data.close()
+        f.close()
+        raise IOError('%s is not an agamemnon snapshot' % path)
+
+    def records():
+        try:
+            offset = SNAPSHOT_HEADER.size
+            end = len(data)
+            while offset < end:
+                (length,) = SNAPSHOT_RECORD.unpack_from(data, offset)
+                offset += SNAPSHOT_RECORD.size
+                yield marshal.loads(data[offset:offset + length])
+                offset += length
+        finally:
+            data.close()
+            f.close()
+
+    return seq, records()
+
+
+class MutationLog(object):
+    """
+    Append-only log of (seq, mutations) records.  Every record carries a checksum; a torn record at the end of the
+    log, left by a crash in the middle of an append, is discarded when the log is read.
+    """
+
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self._file = open(path, 'ab')
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            data = _map_file(f)
+            if data is None:
+                return
+            try:
+                offset = 0
+                end = len(data)
+                while offset < end:
+                    if offset + LOG_RECORD.size > end:
+                        break
+                    length, checksum = LOG_RECORD.unpack_from(data, offset)
+                    record = data[offset + LOG_RECORD.size:offset + LOG_RECORD.size + length]
+                    if len(record) < length or zlib.crc32(record) & 0xffffffff != checksum:
+                        break
+                    yield marshal.loads(record)
+                    offset += LOG_RECORD.size + length
+            finally:
+                data.close()
+        if offset < end:
+            log.warning("Discarding %d bytes of torn records at the end of %s" % (end - offset, self.path))
+            self._file.truncate(offset)
+
+    def append(self, seq, mutations):
+        self._write(self._file, seq, mutations)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def rewrite(self, records):
+        """
+        Replaces the log with the given (seq, mutations) records.  They are written to a temporary file which is
+        moved over the log once it is complete, so a crash leaves either the old log or the new one.
+        """
+        temp_path = '%s.tmp' % self.path
+        with open(temp_path, 'wb') as f:
+            for seq, mutations in records:
+                self._write(f, seq, mutations)
+            f.flush()
+            os.fsync(f.fileno())
+        self._file.close()
+        _replace(temp_path, self.path)
+        self._file = open(self.path, 'ab')
+
+    def _write(self, f, seq, mutations):
+        data = marshal.dumps((seq, [tuple(plain(item) for item in mutation) for mutation in mutations]))
+        f.write(LOG_RECORD.pack(len(data), zlib.crc32(data) & 0xffffffff))
+        f.write(data)
+
+    def reset(self):
+        self._file.truncate(0)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
@@ -83,10 +83,7 @@ class FullTextSearch(object):
 
     def populate_index(self, type, index_name):
         #add all the currently existing nodes into the index
-        ref_node = self.datastore.get_reference_node(type)
-        node_list = [rel.target_node for rel in ref_node.instance.outgoing]
-
-        for node in node_list:
+        for node in self.datastore.scan_nodes(type):
             key = node.key
             index_dict = self.populate_index_document(node, index_name)
             try:
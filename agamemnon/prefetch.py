@@ -0,0 +1,89 @@
+"""
+Reads the pages of a paged query ahead of the caller, on a worker thread, so that the caller doesn't wait a full
+round trip between pages.  Several sources, such as the token ranges of a full scan, can be read at once by a pool of
+workers.
+"""
+import sys
+import threading
+from Queue import Queue, Full
+
+_DONE = object()
+
+
+class ReadAhead(object):
+    """
+    Iterates over the items of sources while workers read up to depth items ahead.  Each worker reads one source
+    at a time, so items of the same source keep their order, but items of different sources are interleaved.
+    Errors raised while reading are raised to the caller when it reaches them.  The workers stop once the caller
+    stops iterating.
+    """
+
+    def __init__(self, sources, depth, workers=1):
+        self._sources = list(sources)
+        self._sources.reverse()
+        self._lock = threading.Lock()
+        self._queue = Queue(depth)
+        self._stopped = threading.Event()
+        self._running = min(workers, len(self._sources)) or 1
+        self._threads = [
+            threading.Thread(target=self._run, name='agamemnon-read-ahead-%d' % i)
+            for i in xrange(self._running)
+        ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _next_source(self):
+        with self._lock:
+            if self._sources:
+                return self._sources.pop()
+            return None
+
+    def _run(self):
+        try:
+            source = self._next_source()
+            while source is not None:
+                for item in source:
+                    if not self._put((item, None)):
+                        return
+                source = self._next_source()
+        except Exception:
+            self._put((_DONE, sys.exc_info()))
+            return
+        with self._lock:
+            self._running -= 1
+            last = not self._running
+        if last:
+            self._put((_DONE, None))
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def __iter__(self):
+        try:
+            while True:
+                item, error = self._queue.get()
+                if item is _DONE:
+                    if error is not None:
+                        raise error[0], error[1], error[2]
+                    return
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        self._stopped.set()
+
+
+def read_ahead(pages, depth):
+    return iter(ReadAhead([pages], depth))
+
+
+def read_parallel(sources, workers, depth):
+    return iter(ReadAhead(sources, depth, workers))
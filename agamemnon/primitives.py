@@ -118,8 +118,7 @@ class Relationship(object):
                                             self.target_node.type, self.target_node.key)
 
     def commit(self):
-        self.data_store.create_relationship(self.type, self.source_node, self.target_node,
-                                            key=self.key, args=self.new_values)
+        self.data_store.save_relationship(self)
 
     def clear(self):
         self.new_values = {}
@@ -325,3 +324,74 @@ class Node(object):
         return other.type == self.type and other.key == self.key
 
 
+
+
+class NodeGroup(object):
+    """
+    The partial nodes read off one page of relationships.  The first time any of them is used, all of them are read
+    with one get_nodes per type.
+    """
+
+    def __init__(self, data_store):
+        self._data_store = data_store
+        self._nodes = []
+
+    def add(self, node):
+        self._nodes.append(node)
+
+    def hydrate(self):
+        nodes, self._nodes = self._nodes, []
+        by_type = {}
+        for node in nodes:
+            node._group = None
+            by_type.setdefault(node.type, {}).setdefault(node.key, []).append(node)
+        for type, keyed_nodes in by_type.iteritems():
+            for full_node in self._data_store.get_nodes(type, keyed_nodes.keys()):
+                for node in keyed_nodes[full_node.key]:
+                    node._old_values = full_node.old_values
+                    node._new_values = {}
+                    node._new_values.update(full_node.old_values)
+
+
+class PartialNode(Node):
+    """
+    A node read off a relationship which only keeps some of the node's attributes.  The rest are read, along with
+    those of the rest of its group, the first time its attributes are used.  A node which has been deleted keeps the
+    attributes it was read with.
+    """
+
+    def __init__(self, data_store, type, key, args, group):
+        self._group = None
+        Node.__init__(self, data_store, type, key, args)
+        self._group = group
+        group.add(self)
+
+    def _hydrate(self):
+        if self._group is not None:
+            self._group.hydrate()
+
+    @property
+    def old_values(self):
+        self._hydrate()
+        return self._old_values
+
+    @old_values.setter
+    def old_values(self, values):
+        self._old_values = values
+
+    @property
+    def new_values(self):
+        self._hydrate()
+        return self._new_values
+
+    @new_values.setter
+    def new_values(self, values):
+        self._new_values = values
+
+    @property
+    def loaded_values(self):
+        """
+        The attributes read so far, without reading the rest: the copies kept with the relationship the node was
+        read from until it is first used, and all of them after.
+        """
+        return self._new_values
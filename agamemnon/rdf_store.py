@@ -343,8 +343,8 @@ class AgamemnonStore(Store):
         ref_ref_node = self.data_store.get_reference_node()
         for ref in ref_ref_node.instance.outgoing:
             if ref.target_node.key in self._ignored_node_types: continue
-            for instance in ref.target_node.instance.outgoing:
-                yield instance.target_node
+            for node in self.data_store.scan_nodes(ref.target_node.key):
+                yield node
 
     def node_to_ident(self, node):
         if node.type == BNODE_NODE_TYPE:
@@ -1,12 +1,30 @@
 # -*- encoding: ISO-8859-5 -*-
 import random
+from collections import namedtuple
 from unittest import TestCase, SkipTest
-from agamemnon.exceptions import NodeNotFoundException
-from agamemnon.factory import load_from_file
-from agamemnon.primitives import updating_node
+from agamemnon.exceptions import BatchError, NodeNotFoundException, PropagationError, ReadOnlyError
+from agamemnon.cache import NodeCache
+from agamemnon.cassandra import BackgroundMutator, CassandraDataStore, ConsistencyProfiles, ProfiledColumnFamily, \
+    ProfiledMutator, SchemaCatalog, _get_token_range, _split_token_range
+from agamemnon.factory import DataStore, load_from_file, load_from_settings
+from agamemnon.graph_constants import OUTBOUND_RELATIONSHIP_CF, INBOUND_RELATIONSHIP_CF, RELATIONSHIP_CF, \
+    RELATIONSHIP_COUNTS, RELATIONSHIP_COUNTS_MARKER
+from agamemnon.hedging import HedgePolicy
+from agamemnon.memory import Deadlines
+from agamemnon.primitives import PartialNode, updating_node
+from agamemnon.persistence import MutationLog
+from agamemnon.writebehind import WriteBehindQueue
 from pycassa import TTransport
+from pycassa.cassandra.ttypes import ConsistencyLevel, InvalidRequestException, NotFoundException
+from pycassa import index
+from pycassa.batch import Mutator
+from pycassa.columnfamily import ColumnFamily
 from os import path
+import shutil
 import socket
+import tempfile
+import threading
+import time
 
 from nose.plugins.attrib import attr
 
@@ -179,6 +197,28 @@ class AgamemnonTests(object):
             self.assertTrue(node.key in ["e"])
             self.assertEqual(type(node["num"]), type(1.0))
 
+    def test_indexed_range_get(self):
+        self.ds.create_cf("ranked")
+        self.ds.create_secondary_index("ranked", "color")
+        self.ds.create_secondary_index("ranked", "rank")
+
+        for i, color in enumerate(["red", "black", "red", "red", "black", "red"]):
+            self.ds.create_node("ranked", "n%s" % i, {"color": color, "rank": "r%s" % i})
+
+        expressions = [index.create_index_expression("rank", "r2", index.GT)]
+        nodes = self.ds.get_nodes_by_attr("ranked", {"color": "red"}, expressions=expressions)
+        self.assertEqual(["n3", "n5"], sorted([node.key for node in nodes]))
+
+        expressions = [index.create_index_expression("rank", "r2", index.LTE)]
+        nodes = self.ds.get_nodes_by_attr("ranked", {"color": "red"}, expressions=expressions)
+        self.assertEqual(["n0", "n2"], sorted([node.key for node in nodes]))
+
+        node = self.ds.get_node("ranked", "n0")
+        node["color"] = "black"
+        node.commit()
+        nodes = self.ds.get_nodes_by_attr("ranked", {"color": "red"})
+        self.assertEqual(["n2", "n3", "n5"], sorted([node.key for node in nodes]))
+
     def test_update_relationship_indexes(self):
         self.ds.create_node("source", "A")
         self.ds.create_node("target", "B")
@@ -258,6 +298,404 @@ class AgamemnonTests(object):
         self.assertEqual(rel.target_node.attributes, node_b.attributes)
 
 
+    def test_relationship_paging(self):
+        source = self.ds.create_node('source', 'pager')
+        for i in xrange(25):
+            target = self.ds.create_node('target', 'target_%02d' % i)
+            source.pages(target, key='rel_%02d' % i)
+            source.other(target, key='other_%02d' % i)
+
+        for count in [2, 7, 25, 100]:
+            keys = [rel.key for rel in source.pages.get_outgoing(count=count)]
+            self.assertEqual(['rel_%02d' % i for i in xrange(25)], keys)
+            keys = [rel.key for rel in self.ds.get_outgoing_relationships(source, 'pages', count=count, prefetch=2)]
+            self.assertEqual(['rel_%02d' % i for i in xrange(25)], keys)
+        self.assertEqual(25, len([rel for rel in source.other.outgoing]))
+        self.assertEqual(50, len([rel for rel in source.relationships.outgoing]))
+        self.assertEqual(50, len(list(self.ds.get_all_outgoing_relationships(source, 7, prefetch=1))))
+        incoming = [rel.key for rel in self.ds.get_all_incoming_relationships(target, 2, prefetch=1)]
+        self.assertEqual(['other_24', 'rel_24', 'target_24'], sorted(incoming))
+
+    def test_degree_counters(self):
+        source = self.ds.create_node('counted', 'source')
+        targets = [self.ds.create_node('counted', str(i)) for i in xrange(5)]
+        for target in targets:
+            source.follows(target)
+        rel = source.likes(targets[0], key='like')
+        # counts come from the counters, and neither rewriting nor committing a relationship counts it again
+        source.likes(targets[0], key='like')
+        rel['weight'] = 2
+        rel.commit()
+        self.assertEqual(5, self.ds._degree('counted', 'source', 'outgoing', 'follows'))
+        self.assertEqual(5, len(source.follows.outgoing))
+        self.assertEqual(1, len(source.likes.outgoing))
+        self.assertEqual(6, len(source.relationships.outgoing))
+        # follows, likes and the instance relationship from the reference node
+        self.assertEqual(3, len(targets[0].relationships.incoming))
+        self.assertEqual(1, len(targets[0].follows.incoming))
+
+        list(source.follows.outgoing)[0].delete()
+        self.assertEqual(4, len(source.follows.outgoing))
+        self.assertEqual(5, len(source.relationships.outgoing))
+        rel.delete()
+        self.assertEqual(0, len(source.likes.outgoing))
+        # deleting it again doesn't count it out again
+        rel.delete()
+        self.assertEqual(0, self.ds._degree('counted', 'source', 'outgoing', 'likes'))
+        self.assertEqual(4, len(source.relationships.outgoing))
+
+        # relationships created and deleted within a batch are counted as the batch leaves them
+        with self.ds.batch():
+            batched = source.likes(targets[2])
+            batched.delete()
+            batched.delete()
+        self.assertEqual(0, self.ds._degree('counted', 'source', 'outgoing', 'likes'))
+        # and delete_node counts out a relationship from a node to itself once, though it is read twice
+        looped = self.ds.create_node('counted', 'looped')
+        looped.follows(looped)
+        self.ds.delete_node(looped)
+        self.assertEqual(0, self.ds._degree('counted', 'looped', 'outgoing', 'follows'))
+        self.assertEqual(0, self.ds._degree('counted', 'looped', 'incoming', 'follows'))
+
+        # a node whose relationships predate its counters is counted the slow way, even once it has new ones
+        counts = self.ds.delegate.get_cf(RELATIONSHIP_COUNTS)
+        self.ds.delegate.add(counts, 'counted__source', RELATIONSHIP_COUNTS_MARKER, -1)
+        source.likes(targets[1])
+        self.assertEqual(None, self.ds._degree('counted', 'source', 'outgoing', 'likes'))
+        self.assertEqual(1, len(source.likes.outgoing))
+        self.assertEqual(4, len(source.follows.outgoing))
+        self.assertEqual(5, len(source.relationships.outgoing))
+
+    def test_scan_nodes(self):
+        for i in xrange(30):
+            self.ds.create_node('scanned', 'node_%02d' % i, {'index': i})
+        for workers in [1, 4, 50]:
+            nodes = list(self.ds.scan_nodes('scanned', workers=workers, buffer_size=5))
+            self.assertEqual(['node_%02d' % i for i in xrange(30)], sorted(node.key for node in nodes))
+            self.assertEqual(range(30), sorted(node['index'] for node in nodes))
+        self.assertEqual([], list(self.ds.scan_nodes('never_created')))
+        # abandoning a scan part way through stops its workers
+        scan = self.ds.scan_nodes('scanned', workers=2, buffer_size=1)
+        scan.next()
+        scan.close()
+
+    def test_consistency_override(self):
+        with self.ds.consistency(write='QUORUM'):
+            source = self.ds.create_node('consistent', 'source')
+            source.related(self.ds.create_node('consistent', 'target'))
+            with self.ds.consistency(read='ONE'):
+                self.assertEqual('source', self.ds.get_node('consistent', 'source').key)
+                self.assertTrue('target' in source.related)
+        self.assertEqual(1, len(source.related.outgoing))
+
+    def test_background_batch(self):
+        # reference nodes created inside a batch can't be read back until it is committed
+        root = self.ds.create_node('loader', 'root')
+        self.ds.get_reference_node('loaded')
+        with self.ds.batch(background=True):
+            for i in xrange(50):
+                root.loaded(self.ds.create_node('loaded', 'node_%02d' % i, {'index': i}))
+        self.assertEqual(50, len(root.loaded.outgoing))
+        self.assertEqual(7, self.ds.get_node('loaded', 'node_07')['index'])
+
+    def test_blind_create_node(self):
+        for i in xrange(5):
+            self.ds.create_node('blind', 'node_%d' % i, {'index': i}, blind=True)
+        node = self.ds.get_node('blind', 'node_3')
+        self.assertEqual(3, node['index'])
+        self.assertEqual(1, len(node.instance.incoming))
+        reference_node = self.ds.get_reference_node('blind')
+        self.assertEqual(5, len(list(reference_node.instance.outgoing)))
+        self.assertEqual(5, len(reference_node.instance.outgoing))
+
+        # creating a node again, blind, doesn't count it again, even twice within one batch
+        self.ds.create_node('blind', 'node_3', {'index': 30}, blind=True)
+        with self.ds.batch():
+            self.ds.create_node('blind', 'node_5', blind=True)
+            self.ds.create_node('blind', 'node_5', blind=True)
+        self.assertEqual(30, self.ds.get_node('blind', 'node_3')['index'])
+        self.assertEqual(6, len(list(reference_node.instance.outgoing)))
+        self.assertEqual(6, len(reference_node.instance.outgoing))
+        counts = self.ds.delegate.get_cf(RELATIONSHIP_COUNTS).get('blind__node_3')
+        self.assertEqual(1, counts[RELATIONSHIP_COUNTS_MARKER])
+        self.assertEqual(1, counts['incoming__instance'])
+
+        # the cached reference node is forgotten when the store is truncated
+        self.ds.truncate()
+        self.ds.create_node('blind', 'node_5', blind=True)
+        instances = self.ds.get_reference_node('blind').instance.outgoing
+        self.assertEqual(['node_5'], [rel.target_node.key for rel in instances])
+        self.assertTrue('blind' in [rel.target_node.key for rel in self.ds.get_reference_node().instance.outgoing])
+        # and creating a node otherwise doesn't use it
+        self.ds.delegate.truncate()
+        self.ds.create_node('blind', 'node_6')
+        instances = self.ds.get_reference_node('blind').instance.outgoing
+        self.assertEqual(['node_6'], [rel.target_node.key for rel in instances])
+        self.assertTrue('blind' in [rel.target_node.key for rel in self.ds.get_reference_node().instance.outgoing])
+
+    def test_bulk_create(self):
+        self.ds.create_node('bulk', 'node_0', {'index': -1, 'old': True})
+        created = self.ds.create_nodes('bulk', (('node_%d' % i, {'index': i}) for i in xrange(10)), chunk_size=4)
+        self.assertEqual(10, created)
+        node = self.ds.get_node('bulk', 'node_0')
+        self.assertEqual(0, node['index'])
+        self.assertTrue(node['old'])
+        reference_node = self.ds.get_reference_node('bulk')
+        self.assertEqual(10, len(list(reference_node.instance.outgoing)))
+        self.assertEqual(10, len(reference_node.instance.outgoing))
+        self.assertEqual(1, len(self.ds.get_node('bulk', 'node_7').instance.incoming))
+        self.assertEqual(2, self.ds.create_nodes('bulk', [('node_10', {}), ('node_11', {})], blind=True))
+        self.assertEqual(12, len(reference_node.instance.outgoing))
+        self.assertEqual(2, self.ds.create_nodes('bulk', [('node_10', {'index': 10}), ('node_12', {})], blind=True))
+        self.assertEqual(13, len(reference_node.instance.outgoing))
+        self.assertEqual(13, len(list(reference_node.instance.outgoing)))
+        self.assertEqual(10, self.ds.get_node('bulk', 'node_10')['index'])
+
+        nodes = self.ds.get_nodes('bulk', ['node_%d' % i for i in xrange(10)])
+        pairs = [('follows', nodes[i], nodes[(i + j) % 10], {'weight': j}) for i in xrange(10) for j in (1, 2)]
+        self.assertEqual(20, self.ds.create_relationships(pairs, chunk_size=7))
+        node = self.ds.get_node('bulk', 'node_3')
+        outgoing = sorted((rel.target_node.key, rel['weight']) for rel in node.follows.outgoing)
+        self.assertEqual([('node_4', 1), ('node_5', 2)], outgoing)
+        self.assertEqual(2, len(node.follows.incoming))
+        self.assertEqual(2, self.ds.get_outgoing_relationship_count(node, 'follows'))
+        self.assertTrue(self.ds.has_relationship(node, 'node_5', 'follows'))
+
+    def test_save_node_writes_changes(self):
+        node = self.ds.create_node('diffed', 'node', {'name': 'node', 'color': 'red', 'size': 'big'})
+        other = self.ds.create_node('diffed', 'other', {'name': 'other'})
+        node.likes(other)
+        other.likes(node)
+        node = self.ds.get_node('diffed', 'node')
+        node['color'] = 'blue'
+        del node['size']
+        node.commit()
+        outgoing = list(node.likes.outgoing)[0]
+        self.assertEqual('blue', outgoing.source_node['color'])
+        self.assertEqual('node', outgoing.source_node['name'])
+        self.assertFalse('size' in outgoing.source_node)
+        incoming = list(other.likes.outgoing)[0]
+        self.assertEqual('blue', incoming.target_node['color'])
+        self.assertFalse('size' in incoming.target_node)
+        node = self.ds.get_node('diffed', 'node')
+        self.assertEqual('blue', node['color'])
+        self.assertFalse('size' in node)
+
+        propagated = []
+        self.ds._propagate_attributes = lambda *args: propagated.append(args)
+        node['color'] = 'blue'
+        node.commit()
+        self.assertEqual([], propagated)
+
+    def test_save_node_pages_relationships(self):
+        ds = DataStore(self.ds.delegate, propagation_page_size=3)
+        hub = ds.create_node('hub', 'hub', {'color': 'red'})
+        for i in xrange(10):
+            spoke = ds.create_node('spoke', 'spoke_%d' % i)
+            hub.connects(spoke)
+            spoke.connects(hub)
+        hub = ds.get_node('hub', 'hub')
+        hub['color'] = 'blue'
+        hub.commit()
+        self.assertEqual(['blue'] * 10, [rel.source_node['color'] for rel in hub.connects.outgoing])
+        self.assertEqual(['blue'] * 10, [rel.target_node['color'] for rel in hub.connects.incoming])
+        spoke = ds.get_node('spoke', 'spoke_4')
+        self.assertEqual('blue', list(spoke.connects.incoming)[0].source_node['color'])
+
+    def test_save_node_propagation_failure(self):
+        ds = DataStore(self.ds.delegate, propagation_page_size=3)
+        hub = ds.create_node('hub', 'hub', {'color': 'red'})
+        for i in xrange(10):
+            hub.connects(ds.create_node('spoke', 'spoke_%d' % i))
+        relationship_pages = ds._relationship_pages
+
+        def failing_pages(*args):
+            for number, page in enumerate(relationship_pages(*args)):
+                if number == 2:
+                    raise IOError('connection lost')
+                yield page
+        ds._relationship_pages = failing_pages
+        hub = ds.get_node('hub', 'hub')
+        hub['color'] = 'blue'
+        try:
+            hub.commit()
+        except PropagationError, e:
+            self.assertEqual([('hub', 'hub')], [node for node, error in e.failures])
+            self.assertTrue(isinstance(e.failures[0][1], IOError))
+        else:
+            self.fail('PropagationError not raised')
+        del ds._relationship_pages
+        # the node itself and the pages of copies before the one which failed were written
+        self.assertEqual('blue', ds.get_node('hub', 'hub')['color'])
+        copies = [list(ds.get_node('spoke', 'spoke_%d' % i).connects.incoming)[0].source_node['color']
+                  for i in xrange(10)]
+        self.assertTrue(0 < copies.count('blue') < 10)
+        self.assertEqual(10, copies.count('blue') + copies.count('red'))
+
+    def test_write_behind(self):
+        ds = DataStore(self.ds.delegate, write_behind=WriteBehindQueue(workers=2))
+        self.addCleanup(ds.write_behind.close)
+        hub = ds.create_node('behind', 'hub', {'color': 'red'})
+        for i in xrange(5):
+            hub.links(ds.create_node('behind', 'spoke_%d' % i))
+        hub = ds.get_node('behind', 'hub')
+        for color in ('green', 'blue'):
+            hub['color'] = color
+            hub.commit()
+        self.assertEqual('blue', ds.get_node('behind', 'hub')['color'])
+        ds.flush()
+        self.assertEqual(['blue'] * 5, [rel.source_node['color'] for rel in hub.links.outgoing])
+
+    def test_write_behind_delete(self):
+        ds = DataStore(self.ds.delegate, write_behind=WriteBehindQueue(workers=1))
+        self.addCleanup(ds.write_behind.close)
+        source = ds.create_node('behind_delete', 'source', {'color': 'red'})
+        rel = source.links(ds.create_node('behind_delete', 'target'))
+        pages = ds._relationship_pages
+
+        def slow_pages(*args):
+            # each page is only written back some time after it was read
+            for page in pages(*args):
+                time.sleep(0.2)
+                yield page
+        ds._relationship_pages = slow_pages
+        source['color'] = 'blue'
+        source.commit()
+        rel.delete()
+        ds.flush()
+        self.assertEqual([], list(source.links.outgoing))
+        self.assertEqual(['instance'], [rel.type for rel in ds.get_node('behind_delete', 'source').relationships])
+        self.assertEqual(['instance'], [rel.type for rel in ds.get_node('behind_delete', 'target').relationships])
+
+    def test_selective_denormalization(self):
+        ds = DataStore(self.ds.delegate, denormalized={'article': ['title']})
+        author = ds.create_node('author', 'author', {'name': 'author'})
+        for i in xrange(3):
+            author.wrote(ds.create_node('article', 'article_%d' % i,
+                                        {'title': 'title %d' % i, 'body': 'body %d' % i}))
+        rel = list(author.wrote.outgoing)[0]
+        copied = ds.get(OUTBOUND_RELATIONSHIP_CF, 'author__author', super_column=rel.rel_key)
+        self.assertEqual('title %s' % rel.target_node.key[-1], copied['target__title'])
+        self.assertFalse('target__body' in copied)
+
+        reads = []
+        get_nodes = ds.get_nodes
+        ds.get_nodes = lambda type, keys: reads.append(keys) or get_nodes(type, keys)
+        articles = [rel.target_node for rel in author.wrote.outgoing]
+        self.assertTrue(all(isinstance(article, PartialNode) for article in articles))
+        self.assertEqual([], reads)
+        cited = author.cites(articles[0])
+        self.assertEqual([], reads)
+        copied = ds.get(OUTBOUND_RELATIONSHIP_CF, 'author__author', super_column=cited.rel_key)
+        self.assertEqual(articles[0]['title'], copied['target__title'])
+        self.assertFalse('target__body' in copied)
+        self.assertEqual(['body 0', 'body 1', 'body 2'], sorted(article['body'] for article in articles))
+        self.assertEqual(1, len(reads))
+
+        propagated = []
+        ds._propagate_attributes = lambda *args: propagated.append(args)
+        article = ds.get_node('article', 'article_1')
+        article['body'] = 'changed'
+        article.commit()
+        self.assertEqual([], propagated)
+        article['title'] = 'changed'
+        article.commit()
+        self.assertEqual([('article', 'article_1', {'title': 'changed'}, [])], propagated)
+
+    def test_sharded_reference_index(self):
+        ds = DataStore(self.ds.delegate, reference_shards=4)
+        for i in xrange(20):
+            ds.create_node('sharded', 'node_%02d' % i, {'index': i})
+        reference_node = ds.get_reference_node('sharded')
+        self.assertEqual(['node_%02d' % i for i in xrange(20)],
+                         sorted(rel.target_node.key for rel in reference_node.instance.outgoing))
+        self.assertEqual(20, len(reference_node.instance.outgoing))
+        self.assertEqual(20, len(reference_node.relationships.outgoing))
+        self.assertEqual(20, len(list(ds.get_all_outgoing_relationships(reference_node, prefetch=2))))
+        shards = [len(self.ds.get(OUTBOUND_RELATIONSHIP_CF, 'reference__sharded__shard__%d' % shard))
+                  for shard in xrange(4)]
+        self.assertEqual(20, sum(shards))
+        self.assertTrue(max(shards) < 20)
+        self.assertEqual(1, len(ds.has_relationship(reference_node, 'node_07', 'instance')))
+
+        node = ds.get_node('sharded', 'node_07')
+        node['index'] = 'changed'
+        node.commit()
+        changed = ds.has_relationship(reference_node, 'node_07', 'instance')[0]
+        self.assertEqual('changed', changed.target_node['index'])
+        ds.delete_node(node)
+        self.assertEqual(19, len(reference_node.instance.outgoing))
+        self.assertEqual(19, len(list(reference_node.instance.outgoing)))
+
+        # a node with a ttl leaves its type to be counted row by row, some of which are empty
+        ds = DataStore(self.ds.delegate, reference_shards=8)
+        ds.create_node('expiring', 'node', {'index': 0}, ttl=1000)
+        reference_node = ds.get_reference_node('expiring')
+        self.assertEqual(1, ds.get_outgoing_relationship_count(reference_node, 'instance'))
+        self.assertEqual(1, ds.get_all_outgoing_relationship_count(reference_node))
+
+    def test_sharding_existing_reference_index(self):
+        for i in xrange(4):
+            self.ds.create_node('resharded', 'node_%d' % i, {'index': i})
+        ds = DataStore(self.ds.delegate, reference_shards=4)
+        reference_node = ds.get_reference_node('resharded')
+        node = ds.get_node('resharded', 'node_1')
+        node['index'] = 'changed'
+        node.commit()
+        rel = ds.has_relationship(reference_node, 'node_3', 'instance')[0]
+        rel['weight'] = 1
+        rel.commit()
+        ds.delete_node(ds.get_node('resharded', 'node_2'))
+
+        rows = ['reference__resharded'] + ['reference__resharded__shard__%d' % shard for shard in xrange(4)]
+        instances = []
+        for row in rows:
+            try:
+                instances.extend(self.ds.get(OUTBOUND_RELATIONSHIP_CF, row).values())
+            except NotFoundException:
+                pass
+        self.assertEqual(['node_0', 'node_1', 'node_3'],
+                         sorted(instance['target__key'] for instance in instances))
+        self.assertEqual(['node_0', 'node_1', 'node_3'],
+                         sorted(rel.target_node.key for rel in reference_node.instance.outgoing))
+        self.assertEqual(3, len(reference_node.instance.outgoing))
+        changed = ds.has_relationship(reference_node, 'node_1', 'instance')[0]
+        self.assertEqual('changed', changed.target_node['index'])
+        self.assertEqual(1, ds.has_relationship(reference_node, 'node_3', 'instance')[0]['weight'])
+        # node_2 was counted out of the row it was counted in
+        counts = self.ds.delegate.get_cf(RELATIONSHIP_COUNTS).get(rows[0], columns=['outgoing__instance'])
+        self.assertEqual(3, counts['outgoing__instance'])
+
+    def test_node_cache(self):
+        for key in ('a', 'b', 'c'):
+            self.ds.create_node('cached', key, {'name': key})
+        ds = DataStore(self.ds.delegate, node_cache=NodeCache(max_entries=2))
+        self.assertEqual('a', ds.get_node('cached', 'a')['name'])
+        self.assertEqual('a', ds.get_node('cached', 'a')['name'])
+        self.assertEqual(['a', 'b', 'c'], [node.key for node in ds.get_nodes('cached', ['a', 'b', 'c'])])
+        stats = ds.node_cache.stats()
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(3, stats['misses'])
+        self.assertEqual(1, stats['evictions'])
+        self.assertEqual(2, stats['entries'])
+        node = ds.get_node('cached', 'c')
+        node['name'] = 'changed'
+        node.commit()
+        self.assertEqual('changed', ds.get_node('cached', 'c')['name'])
+        self.assertEqual(3, ds.node_cache.stats()['hits'])
+        # rows written or deleted directly are invalidated too
+        ds.get_node('cached', 'a')
+        ds.insert('cached', 'a', {'name': 'inserted'})
+        self.assertEqual('inserted', ds.get_node('cached', 'a')['name'])
+        ds.delete('cached', 'a')
+        self.assertRaises(NodeNotFoundException, ds.get_node, 'cached', 'a')
+        # and a node written with a ttl isn't served once it has expired
+        ds.create_node('cached', 'd', {'name': 'd'}, ttl=0.3)
+        self.assertEqual('d', ds.get_node('cached', 'd')['name'])
+        self.assertEqual('d', ds.get_node('cached', 'd')['name'])
+        time.sleep(0.4)
+        self.assertRaises(NodeNotFoundException, ds.get_node, 'cached', 'd')
+
     def test_one_node_type_one_relationship_type(self):
         """
         Tests for one node type and one relationship type.
@@ -352,6 +790,862 @@ class InMemoryTests(TestCase, AgamemnonTests):
     def setUp(self):
         self.ds = load_from_file(TEST_CONFIG_FILE, 'memory_config_1')
 
+    def test_thread_local_batches(self):
+        source = self.ds.create_node("source", "A")
+        target = self.ds.create_node("target", "B")
+        started = threading.Event()
+        other_committed = threading.Event()
+        errors = []
+
+        def other_batch():
+            try:
+                started.wait()
+                with self.ds.batch():
+                    source.other(target, key="other")
+            except Exception, e:
+                errors.append(e)
+            finally:
+                other_committed.set()
+
+        thread = threading.Thread(target=other_batch)
+        thread.start()
+        with self.ds.batch():
+            source.mine(target, key="mine")
+            started.set()
+            other_committed.wait()
+            # the other thread's commit must not flush this thread's batch
+            self.assertEqual(1, len(source.other.outgoing))
+            self.assertEqual(0, len(source.mine.outgoing))
+        thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual(1, len(source.mine.outgoing))
+
+        counts = []
+
+        def reader():
+            try:
+                for i in xrange(50):
+                    counts.append(len(source.mine.outgoing))
+                    [rel for rel in source.relationships]
+            except Exception, e:
+                errors.append(e)
+
+        readers = [threading.Thread(target=reader) for i in xrange(4)]
+        for thread in readers:
+            thread.start()
+        for i in xrange(200):
+            source.churn(target, key=str(i))
+        for thread in readers:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual([1] * 200, counts)
+        self.assertEqual(200, len(source.churn.outgoing))
+
+    def test_coalesced_batches(self):
+        source = self.ds.create_node("source", "A")
+        targets = [self.ds.create_node("target", str(i)) for i in xrange(10)]
+        with self.ds.batch():
+            for target in targets:
+                source.related(target)
+            self.ds.insert("batched", "row", {"a": 1, "b": 2})
+            self.ds.insert("batched", "row", {"b": 3, "c": 4})
+            self.ds.delete("batched", "row", columns=["a"])
+            self.ds.insert("batched", "row", {"d": 5})
+            # four rows: the source's outbound, index and counter rows, plus the batched row
+            self.assertEqual(4, len([key for key in self.ds.transactions.rows if key[1] in ("source__A", "row")]))
+            self.assertEqual(2, len(self.ds.transactions.rows[(RELATIONSHIP_COUNTS, "source__A")]))
+            self.assertEqual(0, len(source.related.outgoing))
+        self.assertEqual(10, len(source.related.outgoing))
+        self.assertEqual({"b": 3, "c": 4, "d": 5}, dict(self.ds.get("batched", "row")))
+
+    def test_reclaim_removed_rows(self):
+        hub = self.ds.create_node("hub", "hub")
+        spokes = [self.ds.create_node("spoke", str(i)) for i in xrange(20)]
+        for spoke in spokes:
+            hub.spoke(spoke)
+        for spoke in spokes[:10]:
+            spoke.delete()
+
+        outbound = self.ds.get_cf(OUTBOUND_RELATIONSHIP_CF)
+        inbound = self.ds.get_cf(INBOUND_RELATIONSHIP_CF)
+        self.assertEqual(10, len(outbound.data["hub__hub"]))
+        self.assertFalse("spoke__0" in inbound.data)
+        self.assertFalse("0" in self.ds.get_cf("spoke").data)
+        self.assertTrue("hub__hub" in outbound._churned)
+
+        self.ds.compact()
+        self.assertFalse(outbound._churned)
+        self.assertEqual(10, len(hub.spoke.outgoing))
+        self.assertEqual([str(i) for i in xrange(10, 20)], sorted(rel.target_node.key for rel in hub.spoke.outgoing))
+
+    def test_ttl(self):
+        source = self.ds.create_node("source", "A")
+        target = self.ds.create_node("target", "B")
+        expiring = self.ds.create_node("target", "C", {"color": "red"}, ttl=0.5)
+        source.related(target)
+        self.ds.create_relationship("related", source, expiring, ttl=0.5)
+        self.ds.insert("source", "A", {"session": "abc"}, ttl=0.5)
+        self.assertEqual(2, len(source.related.outgoing))
+        self.assertEqual("abc", self.ds.get_node("source", "A")["session"])
+        self.assertEqual(2, len(self.ds.get_reference_node("target").instance.outgoing))
+
+        time.sleep(0.6)
+        # expired columns are hidden before they are swept
+        self.assertEqual(1, len(source.related.outgoing))
+        self.assertEqual(["B"], [rel.target_node.key for rel in source.related.outgoing])
+        self.assertFalse("C" in source.related)
+        self.assertRaises(NodeNotFoundException, self.ds.get_node, "target", "C")
+        self.assertEqual(None, self.ds.get_node("source", "A")["session"])
+
+        self.ds.expire()
+        self.assertFalse("C" in self.ds.get_cf("target").data)
+        self.assertEqual(1, len(self.ds.get_reference_node("target").instance.outgoing))
+        self.assertEqual(1, len(source.related.outgoing))
+
+    def test_deadlines(self):
+        deadlines = Deadlines((str(i), 100 + i) for i in xrange(1000))
+        deadlines['5'] = 1
+        deadlines['7'] = 2
+        del(deadlines['7'])
+        self.assertEqual(set(), deadlines.expired(0))
+        self.assertEqual(set(['5']), deadlines.expired(50))
+        self.assertEqual(set(['0', '1', '5']), deadlines.expired(101))
+        copied = deadlines.copy()
+        del(deadlines['5'])
+        self.assertEqual(set(['0']), deadlines.expired(100))
+        self.assertEqual(set(['0', '5']), copied.expired(100))
+
+    def test_snapshot(self):
+        self.ds.create_cf("indexed")
+        self.ds.create_secondary_index("indexed", "color")
+        root = self.ds.create_node("indexed", "0", {"color": "red"})
+        for i in xrange(1, 5):
+            root.related(self.ds.create_node("indexed", str(i), {"color": "black"}))
+
+        with self.ds.snapshot() as view:
+            with self.ds.snapshot() as other_view:
+                self.assertTrue(view.delegate.epoch is other_view.delegate.epoch)
+            root["color"] = "black"
+            root.commit()
+            self.ds.get_node("indexed", "4").delete()
+            self.ds.create_node("indexed", "5", {"color": "red"})
+            root.related(self.ds.get_node("indexed", "5"))
+
+            # the view still sees the graph as it was when it was opened
+            view_root = view.get_node("indexed", "0")
+            self.assertEqual("red", view_root["color"])
+            self.assertEqual(["1", "2", "3", "4"], sorted(rel.target_node.key for rel in view_root.related.outgoing))
+            self.assertRaises(NodeNotFoundException, view.get_node, "indexed", "5")
+            self.assertEqual(["0"], [node.key for node in view.get_nodes_by_attr("indexed", {"color": "red"})])
+            self.assertEqual(5, len(view.get_reference_node("indexed").instance.outgoing))
+            self.assertRaises(ReadOnlyError, view.create_node, "indexed", "6")
+
+            # while the live graph has moved on
+            self.assertEqual(["5"], [node.key for node in self.ds.get_nodes_by_attr("indexed", {"color": "red"})])
+            self.assertEqual(4, len(self.ds.get_node("indexed", "0").related.outgoing))
+            self.assertTrue(self.ds.delegate._epochs[0].preserved)
+        self.assertEqual([], self.ds.delegate._epochs)
+
+    def test_compact_storage(self):
+        source = self.ds.create_node("source", "A", {"color": "red"})
+        target = self.ds.create_node("target", "B")
+        rel = source.related(target, key="1", weight=2)
+        outbound = self.ds.get_cf(OUTBOUND_RELATIONSHIP_CF).data["source__A"]["related__1"]
+        inbound = self.ds.get_cf(INBOUND_RELATIONSHIP_CF).data["target__B"]["related__1"]
+        self.assertTrue(outbound is inbound)
+
+        # updates are shared again once both rows have them
+        rel["weight"] = 3
+        rel.commit()
+        outbound = self.ds.get_cf(OUTBOUND_RELATIONSHIP_CF).data["source__A"]["related__1"]
+        inbound = self.ds.get_cf(INBOUND_RELATIONSHIP_CF).data["target__B"]["related__1"]
+        self.assertTrue(outbound is inbound)
+        rel = list(source.related.outgoing)[0]
+        self.assertEqual(3, rel["weight"])
+        self.assertEqual("red", rel.source_node["color"])
+
+        other = self.ds.create_node("source", "C", {"color": "red"})
+        other.related(target, key="2", weight=2)
+        other_outbound = self.ds.get_cf(OUTBOUND_RELATIONSHIP_CF).data["source__C"]["related__2"]
+        self.assertTrue(outbound.names is other_outbound.names)
+
+        self.ds.delete(INBOUND_RELATIONSHIP_CF, "target__B", columns=["weight"], super_column="related__1")
+        self.assertFalse("weight" in self.ds.get(INBOUND_RELATIONSHIP_CF, "target__B", super_column="related__1"))
+        self.assertEqual(3, self.ds.get(OUTBOUND_RELATIONSHIP_CF, "source__A", super_column="related__1")["weight"])
+
+    def _load_persistent(self, data_dir, checkpoint_interval=100000):
+        return load_from_settings({
+            'backend': 'agamemnon.memory.InMemoryDataStore',
+            'backend_config': {'data_dir': data_dir, 'checkpoint_interval': checkpoint_interval},
+        })
+
+    def test_persistence(self):
+        data_dir = tempfile.mkdtemp()
+        try:
+            ds = self._load_persistent(data_dir, checkpoint_interval=40)
+            ds.create_cf("indexed")
+            ds.create_secondary_index("indexed", "color")
+            for i in xrange(20):
+                ds.create_node("indexed", str(i), {"color": "red" if i % 2 else "black", "integer": i})
+            root = ds.get_node("indexed", "0")
+            for i in xrange(1, 20):
+                root.related(ds.get_node("indexed", str(i)))
+            ds.get_node("indexed", "19").delete()
+            ds.close()
+
+            ds = self._load_persistent(data_dir)
+            root = ds.get_node("indexed", "0")
+            self.assertEqual(0, root["integer"])
+            self.assertEqual(18, len(root.related.outgoing))
+            self.assertEqual(19, len(ds.get_reference_node("indexed").instance.outgoing))
+            self.assertEqual(9, len(ds.get_nodes_by_attr("indexed", {"color": "red"})))
+            self.assertRaises(NodeNotFoundException, ds.get_node, "indexed", "19")
+
+            # a torn record at the end of the log is discarded
+            ds.checkpoint()
+            ds.create_node("indexed", "20")
+            ds.close()
+            with open(path.join(data_dir, 'mutations.log'), 'ab') as f:
+                f.write('\x00\x00\x01')
+            ds = self._load_persistent(data_dir)
+            self.assertEqual("20", ds.get_node("indexed", "20").key)
+            ds.create_node("indexed", "21")
+            ds.close()
+            ds = self._load_persistent(data_dir)
+            self.assertEqual("21", ds.get_node("indexed", "21").key)
+            ds.close()
+        finally:
+            shutil.rmtree(data_dir)
+
+
+class WriteBehindQueueTests(TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.journal = path.join(self.data_dir, 'journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_coalesces_and_replays(self):
+        queue = WriteBehindQueue(journal=self.journal)
+        queue.put('type', 'a', {'color': 'red', 'size': 'big'}, [])
+        queue.put('type', 'b', {'color': 'red'}, [])
+        queue.put('type', 'a', {'color': 'blue'}, ['size'])
+        queue.close()
+
+        propagated = []
+        queue = WriteBehindQueue(workers=1, journal=self.journal)
+        queue.start(lambda *args: propagated.append(args))
+        queue.flush()
+        self.assertEqual([('type', 'a', {'color': 'blue'}, ['size']), ('type', 'b', {'color': 'red'}, [])],
+                         propagated)
+        queue.close()
+
+        queue = WriteBehindQueue(journal=self.journal)
+        queue.start(lambda *args: propagated.append(args))
+        queue.flush()
+        self.assertEqual(2, len(propagated))
+        queue.close()
+
+    def _propagator(self, broken):
+        propagated = []
+        succeeded = threading.Event()
+
+        def propagate(type, key, changed, removed):
+            if key in broken:
+                raise ValueError(key)
+            propagated.append((type, key, changed, removed))
+            succeeded.set()
+        return propagate, propagated, succeeded
+
+    def test_failures(self):
+        broken = set(['a'])
+        propagate, propagated, succeeded = self._propagator(broken)
+        queue = WriteBehindQueue(journal=self.journal, retry_delay=0.01, max_retry_delay=0.05)
+        queue.start(propagate)
+        queue.put('type', 'a', {'color': 'red'}, [])
+        self.assertRaises(PropagationError, queue.flush)
+        # the node stays queued, and keeps failing flush, until it is propagated
+        try:
+            queue.flush()
+        except PropagationError, e:
+            self.assertEqual([('type', 'a')], [node for node, error in e.failures])
+        else:
+            self.fail('PropagationError not raised')
+        queue.put('type', 'a', {'size': 'big'}, [])
+        broken.clear()
+        self.assertTrue(succeeded.wait(5))
+        queue.flush()
+        self.assertEqual([('type', 'a', {'color': 'red', 'size': 'big'}, [])], propagated)
+        queue.close()
+
+    def test_failures_are_journaled(self):
+        propagate, propagated, succeeded = self._propagator(set(['a']))
+        queue = WriteBehindQueue(journal=self.journal, retry_delay=10)
+        queue.start(propagate)
+        queue.put('type', 'a', {'color': 'red'}, [])
+        self.assertRaises(PropagationError, queue.flush)
+        queue.close()
+
+        propagate, propagated, succeeded = self._propagator(set())
+        queue = WriteBehindQueue(journal=self.journal)
+        queue.start(propagate)
+        queue.flush()
+        self.assertEqual([('type', 'a', {'color': 'red'}, [])], propagated)
+        queue.close()
+
+    def test_compaction(self):
+        propagate, propagated, succeeded = self._propagator(set(['stuck']))
+        queue = WriteBehindQueue(workers=1, journal=self.journal, retry_delay=10, compact_every=5)
+        queue.start(propagate)
+        queue.put('type', 'stuck', {'color': 'red'}, [])
+        for i in xrange(50):
+            queue.put('type', str(i), {'index': str(i)}, [])
+        self.assertRaises(PropagationError, queue.flush)
+        self.assertEqual(50, len(propagated))
+        # the updates which were done were dropped from the journal as it went along
+        records = list(MutationLog(self.journal).read())
+        self.assertTrue(len(records) < 15)
+        queue.close()
+
+        propagate, propagated, succeeded = self._propagator(set())
+        queue = WriteBehindQueue(journal=self.journal)
+        queue.start(propagate)
+        queue.flush()
+        self.assertEqual([('type', 'stuck', {'color': 'red'}, [])], propagated)
+        queue.close()
+
+
+class NodeCacheTests(TestCase):
+    def setUp(self):
+        self.cache = NodeCache()
+
+    def test_invalidations_are_per_node(self):
+        generation = self.cache.generation
+        self.cache.invalidate('type', 'other')
+        self.cache.put('type', 'a', {'name': 'a'}, generation)
+        self.assertEqual({'name': 'a'}, self.cache.get('type', 'a'))
+        # a read which started before its node was written isn't cached
+        self.cache.invalidate('type', 'a')
+        self.cache.put('type', 'a', {'name': 'stale'}, generation)
+        self.assertEqual(None, self.cache.get('type', 'a'))
+
+    def test_forgotten_invalidations(self):
+        self.cache.invalidation_window = 2
+        generation = self.cache.generation
+        for key in ['x', 'y', 'z']:
+            self.cache.invalidate('type', key)
+        # x has been forgotten, so no read which started before it was invalidated is cached
+        self.cache.put('type', 'a', {'name': 'a'}, generation)
+        self.assertEqual(None, self.cache.get('type', 'a'))
+        self.cache.put('type', 'a', {'name': 'a'}, self.cache.generation)
+        self.assertEqual({'name': 'a'}, self.cache.get('type', 'a'))
+
+    def test_node_ttl(self):
+        self.cache.invalidate('type', 'a', ttl=0.1)
+        self.cache.put('type', 'a', {'name': 'a'}, self.cache.generation)
+        self.cache.put('type', 'b', {'name': 'b'}, self.cache.generation)
+        self.assertEqual({'name': 'a'}, self.cache.get('type', 'a'))
+        time.sleep(0.15)
+        self.assertEqual(None, self.cache.get('type', 'a'))
+        self.assertEqual({'name': 'b'}, self.cache.get('type', 'b'))
+        self.assertEqual(1, self.cache.stats()['expirations'])
+        # once the ttl has passed, it is forgotten
+        self.cache.put('type', 'a', {'name': 'a'}, self.cache.generation)
+        self.assertEqual({}, self.cache._expiries)
+
+
+class FakeMutator(object):
+    """
+    Stands in for the methods of pycassa's Mutator, recording what each mutator sends, and at which level, rather
+    than sending it.  A mutator which writes to the row 'fail' fails to send, and one which writes to the row
+    'rejected' is rejected as cassandra rejects writes to a column family which has been dropped.
+    """
+    sent = []
+
+    def __init__(self, pool, queue_size=0, write_consistency_level=None):
+        self.mutations = []
+        self.write_consistency_level = write_consistency_level or ConsistencyLevel.ONE
+
+    def insert(self, column_family, key, columns, ttl=None):
+        self.mutations.append((column_family.column_family, key, columns))
+
+    def remove(self, column_family, key, columns=None, super_column=None):
+        self.mutations.append((column_family.column_family, key, None))
+
+    def send(self, write_consistency_level=None):
+        if any(key == 'fail' for name, key, columns in self.mutations):
+            raise ValueError('failed to send')
+        if any(key == 'rejected' for name, key, columns in self.mutations):
+            raise InvalidRequestException()
+        FakeMutator.sent.append((write_consistency_level or self.write_consistency_level, self.mutations))
+
+
+class FakeColumnFamily(object):
+    """
+    Stands in for the methods of pycassa's ColumnFamily, recording the level each read or write would be sent at.
+    Reading the row 'rejected' is rejected as it is once the column family has been dropped.
+    """
+    levels = []
+
+    def __init__(self, pool, column_family, **kwargs):
+        self.column_family = column_family
+        self.read_consistency_level = ConsistencyLevel.ONE
+        self.write_consistency_level = ConsistencyLevel.ONE
+
+    def _record(self, kind, level):
+        FakeColumnFamily.levels.append((self.column_family, kind, level))
+
+    def get(self, key, read_consistency_level=None, **kwargs):
+        self._record('read', read_consistency_level or self.read_consistency_level)
+        if key == 'rejected':
+            raise InvalidRequestException()
+
+    def multiget(self, keys, read_consistency_level=None, **kwargs):
+        self._record('read', read_consistency_level or self.read_consistency_level)
+
+    def get_count(self, key, read_consistency_level=None, **kwargs):
+        self._record('read', read_consistency_level or self.read_consistency_level)
+
+    def get_range(self, read_consistency_level=None, **kwargs):
+        self._record('read', read_consistency_level or self.read_consistency_level)
+
+    def insert(self, key, columns, write_consistency_level=None, **kwargs):
+        self._record('write', write_consistency_level or self.write_consistency_level)
+
+    def remove(self, key, write_consistency_level=None, **kwargs):
+        self._record('write', write_consistency_level or self.write_consistency_level)
+
+    def add(self, key, column, value=1, write_consistency_level=None, **kwargs):
+        self._record('write', write_consistency_level or self.write_consistency_level)
+
+
+class FakePycassaTestCase(TestCase):
+    """
+    Replaces the methods of pycassa's Mutator and ColumnFamily with those of FakeMutator and FakeColumnFamily for
+    the duration of each test.
+    """
+
+    def setUp(self):
+        FakeMutator.sent = []
+        FakeColumnFamily.levels = []
+        self._originals = []
+        self._patch(Mutator, FakeMutator, ['__init__', 'insert', 'remove', 'send'])
+        self._patch(ColumnFamily, FakeColumnFamily,
+                    ['__init__', '_record', 'get', 'multiget', 'get_count', 'get_range', 'insert', 'remove', 'add'])
+
+    def _patch(self, cls, fake, names):
+        for name in names:
+            self._originals.append((cls, name, cls.__dict__.get(name)))
+            setattr(cls, name, fake.__dict__[name])
+
+    def tearDown(self):
+        for cls, name, method in reversed(self._originals):
+            if method is None:
+                delattr(cls, name)
+            else:
+                setattr(cls, name, method)
+
+
+class FakeColumnFamilyName(object):
+    write_consistency_level = ConsistencyLevel.ONE
+
+    def __init__(self, name):
+        self.column_family = name
+
+
+class BackgroundMutatorTests(FakePycassaTestCase):
+    def test_flushes_in_order(self):
+        nodes = FakeColumnFamilyName('nodes')
+        mutator = BackgroundMutator(None, flush_mutations=4, flush_bytes=1 << 20, max_pending=1)
+        for i in xrange(10):
+            mutator.insert(nodes, 'row_%d' % i, {'a': '1', 'b': '2'})
+        mutator.remove(nodes, 'row_0')
+        mutator.send()
+        self.assertEqual([2, 2, 2, 2, 2, 1], [len(mutations) for level, mutations in FakeMutator.sent])
+        rows = [key for level, mutations in FakeMutator.sent for name, key, columns in mutations]
+        self.assertEqual(['row_%d' % i for i in xrange(10)] + ['row_0'], rows)
+
+    def test_flush_bytes(self):
+        nodes = FakeColumnFamilyName('nodes')
+        mutator = BackgroundMutator(None, flush_mutations=1000, flush_bytes=100)
+        for i in xrange(5):
+            mutator.insert(nodes, 'row', {'column': 'x' * 60})
+        mutator.send()
+        self.assertEqual([2, 2, 1], [len(mutations) for level, mutations in FakeMutator.sent])
+
+    def test_failed_sub_batch(self):
+        nodes = FakeColumnFamilyName('nodes')
+        mutator = BackgroundMutator(None, flush_mutations=2)
+        for key in ['a', 'b', 'fail', 'c', 'd', 'e']:
+            mutator.insert(nodes, key, {'column': 'value'})
+        try:
+            mutator.send()
+        except BatchError, e:
+            self.assertEqual(1, len(e.failures))
+            failed, error = e.failures[0]
+            self.assertEqual([('nodes', 'fail', {'column': 'value'}), ('nodes', 'c', {'column': 'value'})],
+                             failed.mutations)
+            self.assertTrue(isinstance(error, ValueError))
+        else:
+            self.fail('BatchError not raised')
+        rows = [key for level, mutations in FakeMutator.sent for name, key, columns in mutations]
+        self.assertEqual(['a', 'b', 'd', 'e'], rows)
+
+
+class ConsistencyProfileTests(FakePycassaTestCase):
+    PROFILES = {
+        'default': {'read': 'QUORUM', 'write': 'QUORUM'},
+        'node': {'read': 'ONE'},
+        'relationship': {'write': 'ALL'},
+        'people': {'read': 'LOCAL_QUORUM'},
+    }
+
+    def setUp(self):
+        super(ConsistencyProfileTests, self).setUp()
+        self.profiles = ConsistencyProfiles(self.PROFILES)
+        self.things = ProfiledColumnFamily(self.profiles, None, 'things')
+        self.relationships = ProfiledColumnFamily(self.profiles, None, RELATIONSHIP_CF)
+
+    def test_levels(self):
+        self.assertEqual((ConsistencyLevel.ONE, ConsistencyLevel.QUORUM), self.profiles.levels('things'))
+        self.assertEqual((ConsistencyLevel.LOCAL_QUORUM, ConsistencyLevel.QUORUM), self.profiles.levels('people'))
+        self.assertEqual((ConsistencyLevel.QUORUM, ConsistencyLevel.ALL),
+                         self.profiles.levels(OUTBOUND_RELATIONSHIP_CF))
+        self.assertEqual((None, None), ConsistencyProfiles().levels('things'))
+
+    def test_column_family_levels(self):
+        unconfigured = ProfiledColumnFamily(ConsistencyProfiles(), None, 'things')
+        self.things.get('key')
+        self.things.insert('key', {'a': 'b'})
+        self.relationships.multiget(['key'])
+        self.relationships.add('key', 'column')
+        unconfigured.get('key')
+        unconfigured.remove('key')
+        self.assertEqual([
+            ('things', 'read', ConsistencyLevel.ONE),
+            ('things', 'write', ConsistencyLevel.QUORUM),
+            (RELATIONSHIP_CF, 'read', ConsistencyLevel.QUORUM),
+            (RELATIONSHIP_CF, 'write', ConsistencyLevel.ALL),
+            ('things', 'read', ConsistencyLevel.ONE),
+            ('things', 'write', ConsistencyLevel.ONE),
+        ], FakeColumnFamily.levels)
+
+    def test_override(self):
+        with self.profiles.override(read='ALL'):
+            with self.profiles.override(write='ANY'):
+                self.things.get_count('key')
+                self.things.remove('key')
+            self.things.get_range()
+            self.things.insert('key', {'a': 'b'})
+            # a level given to the call itself wins
+            self.things.get('key', read_consistency_level=ConsistencyLevel.TWO)
+            # and the override is only seen by the thread which made it
+            thread = threading.Thread(target=self.things.get, args=('key',))
+            thread.start()
+            thread.join()
+        self.things.get('key')
+        self.assertEqual([
+            ('read', ConsistencyLevel.ALL),
+            ('write', ConsistencyLevel.ANY),
+            ('read', ConsistencyLevel.ALL),
+            ('write', ConsistencyLevel.QUORUM),
+            ('read', ConsistencyLevel.TWO),
+            ('read', ConsistencyLevel.ONE),
+            ('read', ConsistencyLevel.ONE),
+        ], [(kind, level) for name, kind, level in FakeColumnFamily.levels])
+
+    def test_read_level(self):
+        self.assertEqual(ConsistencyLevel.ONE, self.things.read_level())
+        with self.profiles.override(read='ALL'):
+            self.assertEqual(ConsistencyLevel.ALL, self.things.read_level())
+        self.assertEqual(ConsistencyLevel.ONE, self.things.read_level())
+
+    def test_mutator_levels(self):
+        mutator = ProfiledMutator(None)
+        mutator.insert(self.things, 'key', {'a': 'b'})
+        mutator.send()
+        # a batch across column families is sent at the strongest of their levels
+        mutator = ProfiledMutator(None)
+        mutator.insert(self.things, 'key', {'a': 'b'})
+        mutator.remove(self.relationships, 'key')
+        mutator.send()
+        # unless it was given one
+        mutator = ProfiledMutator(None, write_consistency_level=ConsistencyLevel.ONE)
+        mutator.remove(self.relationships, 'key')
+        mutator.send()
+        with self.profiles.override(write='ANY'):
+            mutator = BackgroundMutator(None, write_consistency_level=self.profiles.write_override)
+            mutator.remove(self.relationships, 'key')
+            mutator.send()
+        self.assertEqual([ConsistencyLevel.QUORUM, ConsistencyLevel.ALL, ConsistencyLevel.ONE, ConsistencyLevel.ANY],
+                         [level for level, mutations in FakeMutator.sent])
+
+
+KeySlice = namedtuple('KeySlice', ['key', 'columns'])
+
+
+class FakeRangeColumnFamily(object):
+    """
+    Answers the get_range_slices calls of _get_token_range from a list of (token, key, columns) rows.
+    """
+    buffer_size = 2
+    read_consistency_level = ConsistencyLevel.ONE
+
+    def __init__(self, rows):
+        self.rows = sorted(rows)
+        self.pool = self
+        self.calls = 0
+
+    def execute(self, method, parent, predicate, key_range, level):
+        self.calls += 1
+        self.level = level
+        if key_range.start_key is None:
+            rows = [row for row in self.rows if int(key_range.start_token) < row[0] <= int(key_range.end_token)]
+        else:
+            start = [token for token, key, columns in self.rows if key == key_range.start_key][0]
+            rows = [row for row in self.rows if start <= row[0] <= int(key_range.end_token)]
+        return [KeySlice(key, columns.items()) for token, key, columns in rows[:key_range.count]]
+
+    def _column_parent(self, super_column=None):
+        return None
+
+    def _slice_predicate(self, columns, column_start, column_finish, column_reversed, column_count, super_column):
+        return None
+
+    def _unpack_key(self, key):
+        return key
+
+    def _cosc_to_dict(self, columns, include_timestamp):
+        return dict(columns)
+
+
+class TokenRangeTests(TestCase):
+    def test_split_token_range(self):
+        self.assertEqual([('0', '25'), ('25', '50'), ('50', '75'), ('75', '100')], _split_token_range('0', '100', 4))
+        self.assertEqual([('0', '3'), ('3', '6'), ('6', '10')], _split_token_range('0', '10', 3))
+        self.assertEqual([('0', '1'), ('1', '2')], _split_token_range('0', '2', 5))
+        # wrapping ranges and the tokens of the order preserving partitioners are left whole
+        self.assertEqual([('100', '0')], _split_token_range('100', '0', 4))
+        self.assertEqual([('6b6579', '6b657a')], _split_token_range('6b6579', '6b657a', 4))
+        ranges = _split_token_range('0', str(2 ** 127), 3)
+        self.assertEqual(3, len(ranges))
+        self.assertEqual('0', ranges[0][0])
+        self.assertEqual(str(2 ** 127), ranges[-1][1])
+        self.assertEqual([end for start, end in ranges[:-1]], [start for start, end in ranges[1:]])
+
+    def test_get_token_range(self):
+        column_family = FakeRangeColumnFamily(
+            [(token, 'row_%d' % token, {'token': str(token)}) for token in xrange(10)] + [(5.5, 'ghost', {})])
+        rows = list(_get_token_range(column_family, '2', '8'))
+        self.assertEqual(['row_%d' % token for token in xrange(3, 9)], sorted(key for key, columns in rows))
+        self.assertEqual({'token': '3'}, dict(rows)['row_3'])
+        # two rows a page, each page after the first starting from the last row of the one before
+        self.assertEqual(7, column_family.calls)
+        self.assertEqual([], list(_get_token_range(column_family, '20', '30')))
+        self.assertEqual(ConsistencyLevel.ONE, column_family.level)
+        list(_get_token_range(column_family, '2', '8', read_consistency_level=ConsistencyLevel.QUORUM))
+        self.assertEqual(ConsistencyLevel.QUORUM, column_family.level)
+
+
+class StubSystemManager(object):
+    def __init__(self, column_families):
+        self.column_families = column_families
+        self.loads = 0
+
+    def get_keyspace_column_families(self, keyspace):
+        self.loads += 1
+        return dict((name, None) for name in self.column_families)
+
+
+class SchemaCatalogTests(TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.system_manager = StubSystemManager(['nodes'])
+        self.catalog = SchemaCatalog(self.system_manager, 'keyspace', ttl=300, miss_interval=5,
+                                     clock=lambda: self.now)
+
+    def test_hit(self):
+        self.assertTrue('nodes' in self.catalog)
+        self.assertTrue('nodes' in self.catalog)
+        self.assertEqual(1, self.system_manager.loads)
+
+    def test_miss(self):
+        self.assertFalse('missing' in self.catalog)
+        for i in xrange(10):
+            self.assertFalse('missing' in self.catalog)
+        self.assertEqual(1, self.system_manager.loads)
+        self.system_manager.column_families.append('missing')
+        self.now += 5
+        self.assertTrue('missing' in self.catalog)
+        self.assertEqual(2, self.system_manager.loads)
+
+    def test_ttl(self):
+        self.assertTrue('nodes' in self.catalog)
+        self.now += 299
+        self.assertTrue('nodes' in self.catalog)
+        self.assertEqual(1, self.system_manager.loads)
+        self.system_manager.column_families.remove('nodes')
+        self.now += 1
+        self.assertFalse('nodes' in self.catalog)
+        self.assertEqual(2, self.system_manager.loads)
+
+    def test_add_and_invalidate(self):
+        self.assertFalse('created' in self.catalog)
+        self.catalog.add('created')
+        self.assertTrue('created' in self.catalog)
+        self.assertEqual(1, self.system_manager.loads)
+        self.catalog.invalidate()
+        self.assertFalse('created' in self.catalog)
+        self.assertEqual(2, self.system_manager.loads)
+
+
+class ColumnFamilyCacheTests(FakePycassaTestCase):
+    """
+    The column family cache of a CassandraDataStore, which isn't connected to anything.  Its catalog lists 'ghost',
+    which can't be opened, as a column family dropped elsewhere can't while the schema is in disagreement.
+    """
+
+    def setUp(self):
+        super(ColumnFamilyCacheTests, self).setUp()
+        self.system_manager = StubSystemManager(['nodes', 'ghost'])
+        self.store = CassandraDataStore.__new__(CassandraDataStore)
+        self.store._schema = SchemaCatalog(self.system_manager, 'keyspace')
+        self.store._cf_cache = {}
+        self.store._consistency = ConsistencyProfiles()
+        self.store._hedging = None
+        self.store._pool = None
+        self.store._batch = None
+        self.store.in_batch = False
+        self.store.batch_count = 0
+        column_family = self.store._column_family
+
+        def open_column_family(type):
+            if type == 'ghost':
+                raise NotFoundException()
+            return column_family(type)
+        self.store._column_family = open_column_family
+
+    def test_unopenable(self):
+        self.assertRaises(NotFoundException, self.store.get_cf, 'ghost')
+        self.assertRaises(NotFoundException, self.store.create_cf, 'ghost')
+        self.assertEqual(2, self.system_manager.loads)
+
+    def test_rejected_read(self):
+        nodes = self.store.get_cf('nodes')
+        self.assertTrue(nodes is self.store.get_cf('nodes'))
+        self.assertRaises(InvalidRequestException, nodes.get, 'rejected')
+        self.assertFalse(nodes is self.store.get_cf('nodes'))
+        self.assertEqual(2, self.system_manager.loads)
+
+    def test_rejected_batch(self):
+        nodes = self.store.get_cf('nodes')
+        self.store.start_batch()
+        self.store.insert(nodes, 'rejected', {'column': 'value'})
+        self.assertRaises(InvalidRequestException, self.store.commit_batch)
+        self.assertFalse(nodes is self.store.get_cf('nodes'))
+        self.assertEqual(2, self.system_manager.loads)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class HedgePolicyTests(TestCase):
+    """
+    Hedging across stub hosts, which answer, fail, or wait to be let go.  'slow' is tried first until latencies
+    are known.
+    """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.threads = {}
+
+    def _policy(self, initial_delay=10, **kwargs):
+        return HedgePolicy(['slow', 'fast'], initial_delay=initial_delay, workers=2, clock=self.clock, **kwargs)
+
+    def _host(self, name, seconds=0, error=None, wait_for=None):
+        def read():
+            self.threads[name] = threading.current_thread()
+            if wait_for is not None:
+                wait_for.wait(5)
+            self.clock.now += seconds
+            if error is not None:
+                raise error
+            return name
+        return read
+
+    def test_fast_host_is_not_hedged(self):
+        policy = self._policy()
+        self.assertEqual('slow', policy.call({'slow': self._host('slow'), 'fast': self._host('fast')}))
+        # it answered within the delay, so it wasn't hedged
+        self.assertEqual(['slow'], self.threads.keys())
+
+    def test_slow_host_is_hedged(self):
+        policy = self._policy(initial_delay=0)
+        hedged = threading.Event()
+        fast = self._host('fast')
+
+        def hedge():
+            try:
+                return fast()
+            finally:
+                hedged.set()
+        # the slow host only gives up once the hedge has answered
+        self.assertEqual('fast', policy.call({'slow': self._host('slow', error=IOError(), wait_for=hedged),
+                                              'fast': hedge}))
+        self.assertNotEqual(threading.current_thread(), self.threads['fast'])
+
+    def test_first_answer_is_taken(self):
+        policy = self._policy(initial_delay=0)
+        answered = threading.Event()
+        # the slow host would answer, but not until after the call has returned the hedge's answer
+        self.assertEqual('fast', policy.call({'slow': self._host('slow', wait_for=answered),
+                                              'fast': self._host('fast')}))
+        answered.set()
+
+    def test_busy_workers(self):
+        policy = HedgePolicy(['slow', 'fast'], workers=1, clock=self.clock)
+        released = threading.Event()
+        stuck = threading.Thread(target=policy.call, args=({'slow': self._host('slow', wait_for=released)},))
+        stuck.start()
+        self.addCleanup(stuck.join)
+        self.addCleanup(released.set)
+        while 'slow' not in self.threads:
+            time.sleep(0.01)
+        # the only worker is held up, so the next read gets a thread of its own
+        self.assertEqual('fast', policy.call({'fast': self._host('fast')}))
+
+    def test_failed_host_is_hedged_straight_away(self):
+        policy = self._policy()
+        started = time.time()
+        self.assertEqual('fast', policy.call({'slow': self._host('slow', error=IOError()), 'fast': self._host('fast')}))
+        self.assertTrue(time.time() - started < 5)
+
+    def test_latencies(self):
+        policy = self._policy(min_samples=1)
+        reads = {'slow': self._host('slow', 0.5), 'fast': self._host('fast')}
+        self.assertEqual('slow', policy.call(reads))
+        # a host without latencies is tried before any with
+        self.assertEqual('fast', policy.call(reads))
+        self.assertEqual(['fast', 'slow'], policy.tracker.ranked(['slow', 'fast']))
+        self.assertEqual(0.5, policy.delay('slow'))
+        self.assertEqual(policy.min_delay, policy.delay('fast'))
+
+    def test_failures(self):
+        policy = self._policy()
+        self.assertRaises(IOError, policy.call, {'slow': self._host('slow', error=IOError()),
+                                                 'fast': self._host('fast', error=ValueError())})
+        self.assertRaises(NotFoundException, policy.call, {'slow': self._host('slow', error=NotFoundException()),
+                                                           'fast': self._host('fast')})
+        self.assertRaises(NotFoundException, policy.call, {'slow': self._host('slow', error=IOError()),
+                                                           'fast': self._host('fast', error=NotFoundException())})
+        self.assertEqual('slow', policy.call({'slow': self._host('slow')}))
+
 
 @attr(backend="memory")
 @attr(plugin="elastic_search")
@@ -0,0 +1,221 @@
+"""
+Write-behind propagation of node attributes: save_node writes a node's own row straight away and queues the copies
+of its changed attributes kept with its relationships, which worker threads then write.  Updates to a node which is
+still queued are merged into one, so a node saved repeatedly is propagated once.
+"""
+import threading
+import time
+from collections import deque
+from heapq import heappop, heappush
+from itertools import chain
+import logging
+from agamemnon.exceptions import PropagationError
+from agamemnon.persistence import MutationLog
+
+log = logging.getLogger(__name__)
+
+QUEUED = 'q'
+DONE = 'd'
+
+
+def _merge(entry, changed, removed, seqs):
+    pending_changed, pending_removed, pending_seqs = entry
+    for column in removed:
+        pending_changed.pop(column, None)
+        pending_removed.add(column)
+    for column, value in changed.iteritems():
+        pending_removed.discard(column)
+        pending_changed[column] = value
+    pending_seqs.extend(seqs)
+
+
+class WriteBehindQueue(object):
+    """
+    Queues node updates for worker threads to propagate.  If journal is given, the path of a file, every update is
+    logged there before it is queued and marked done once it is propagated, and updates which weren't propagated
+    when the process stopped are queued again when the queue is next started.  The journal is emptied whenever
+    the queue is, and otherwise rewritten with only the updates still to be propagated every compact_every
+    updates.
+
+    A node which fails to propagate stays queued and is tried again after retry_delay seconds, twice as long after
+    each further failure up to max_retry_delay.
+    """
+
+    def __init__(self, workers=2, journal=None, fsync=False, retry_delay=1, max_retry_delay=60,
+                 compact_every=1000):
+        self.workers = workers
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.compact_every = compact_every
+        self._journal = MutationLog(journal, fsync=fsync) if journal is not None else None
+        # the journal is written under its own lock, which is taken before the condition, never after
+        self._journal_lock = threading.Lock()
+        self._condition = threading.Condition()
+        self._pending = {}
+        self._ready = deque()
+        self._active = {}
+        self._failing = {}
+        self._retries = []
+        self._seq = 0
+        self._done = 0
+        self._stopped = False
+        self._propagate = None
+        self._threads = []
+
+    def start(self, propagate):
+        """
+        Starts the workers, which call propagate(type, key, changed, removed) for each node.
+        """
+        self._propagate = propagate
+        if self._journal is not None:
+            queued = {}
+            for seq, records in self._journal.read():
+                for record in records:
+                    if record[0] == QUEUED:
+                        queued[seq] = record[1:]
+                    else:
+                        for done in record[1]:
+                            queued.pop(done, None)
+            self._journal.reset()
+            for seq in sorted(queued):
+                self.put(*queued[seq])
+            if queued:
+                log.info("Requeued %d node updates from the journal" % len(queued))
+        self._threads = [
+            threading.Thread(target=self._run, name='agamemnon-write-behind-%d' % i)
+            for i in xrange(self.workers)
+        ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def put(self, type, key, changed, removed):
+        """
+        Queues the serialized attributes which changed and the names of those which were removed.
+        """
+        node = (type, key)
+        with self._journal_lock:
+            self._seq += 1
+            if self._journal is not None:
+                self._journal.append(self._seq, [(QUEUED, type, key, changed, list(removed))])
+            with self._condition:
+                entry = self._pending.get(node)
+                if entry is None:
+                    entry = self._pending[node] = ({}, set(), [])
+                    if node not in self._active:
+                        self._ready.append(node)
+                _merge(entry, changed, removed, [self._seq])
+                self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    self._retry_due()
+                    if self._ready or self._stopped:
+                        break
+                    self._condition.wait(self._retries[0][0] - time.time() if self._retries else None)
+                if not self._ready:
+                    return
+                node = self._ready.popleft()
+                entry = self._active[node] = self._pending.pop(node)
+            changed, removed, seqs = entry
+            try:
+                self._propagate(node[0], node[1], changed, list(removed))
+            except Exception, e:
+                log.exception("Failed to propagate the attributes of {0}: {1}".format(*node))
+                self._failed(node, entry, e)
+            else:
+                self._succeeded(node, seqs)
+
+    def _retry_due(self):
+        # called with the condition held
+        now = time.time()
+        while self._retries and self._retries[0][0] <= now:
+            due, node = heappop(self._retries)
+            failing = self._failing.get(node)
+            if failing is not None and failing[2] == due and node in self._pending:
+                self._ready.append(node)
+
+    def _failed(self, node, entry, error):
+        with self._condition:
+            del self._active[node]
+            attempts = self._failing[node][0] + 1 if node in self._failing else 1
+            due = time.time() + min(self.retry_delay * 2 ** (attempts - 1), self.max_retry_delay)
+            self._failing[node] = (attempts, error, due)
+            heappush(self._retries, (due, node))
+            # any update made while it was being propagated goes on top of the one which failed
+            newer = self._pending.pop(node, None)
+            self._pending[node] = entry
+            if newer is not None:
+                _merge(entry, newer[0], newer[1], newer[2])
+            self._condition.notify_all()
+
+    def _succeeded(self, node, seqs):
+        with self._journal_lock:
+            if self._journal is not None:
+                self._journal.append(self._seq, [(DONE, seqs)])
+            with self._condition:
+                del self._active[node]
+                self._failing.pop(node, None)
+                if node in self._pending:
+                    # updated again while it was being propagated
+                    self._ready.append(node)
+                idle = not self._pending and not self._active
+                records = None
+                self._done += 1
+                if self._journal is not None and not idle and self._done >= self.compact_every:
+                    # one record for each update still to be propagated, under the last seq merged into it
+                    records = [
+                        (max(seqs), [(QUEUED, node_type, node_key, changed, list(removed))])
+                        for (node_type, node_key), (changed, removed, seqs)
+                        in chain(self._active.iteritems(), self._pending.iteritems())
+                    ]
+                self._condition.notify_all()
+            if self._journal is not None and (idle or records is not None):
+                self._done = 0
+                if idle:
+                    self._journal.reset()
+                else:
+                    self._journal.rewrite(sorted(records))
+
+    def _busy(self, node):
+        return node in self._active or (node in self._pending and node not in self._failing)
+
+    def wait(self, type=None, key=None):
+        """
+        Waits until the given node, or every node, has been propagated or has failed to be.
+        """
+        with self._condition:
+            if type is None:
+                while self._ready or self._active:
+                    self._condition.wait()
+            else:
+                while self._busy((type, key)):
+                    self._condition.wait()
+
+    def flush(self):
+        """
+        Waits until every queued update has been propagated or has failed to be, and raises a PropagationError if
+        any node has failed and not yet been propagated since.
+        """
+        self.wait()
+        with self._condition:
+            failures = [(node, failing[1]) for node, failing in self._failing.iteritems()]
+        if failures:
+            raise PropagationError(failures)
+
+    def close(self):
+        """
+        Propagates what is queued, if the workers were started, and stops them.  Updates which are still failing
+        are left in the journal.
+        """
+        if self._threads:
+            self.wait()
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        if self._journal is not None:
+            self._journal.close()